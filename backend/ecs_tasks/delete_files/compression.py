@@ -0,0 +1,168 @@
+"""
+Streaming compression codecs for JSON objects. The codec of an object is
+detected from the extension of its key or, failing that, from the magic
+bytes at the start of the object, and the new object is written with the
+same codec.
+"""
+import bz2
+import zlib
+from gzip import GzipFile
+
+import pyarrow as pa
+import snappy
+
+DEFAULT_COMPRESSION_LEVEL = 6
+EXTENSIONS = {
+    ".gz": "gzip",
+    ".gzip": "gzip",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+    ".bz2": "bz2",
+    ".sz": "snappy",
+}
+MAGIC_BYTES = {
+    b"\x1f\x8b": "gzip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+    b"BZh": "bz2",
+    b"\xff\x06\x00\x00sNaPpY": "snappy",
+}
+MAGIC_BYTES_LENGTH = max(len(magic) for magic in MAGIC_BYTES)
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def get_compression_from_key(key):
+    for extension, compression in EXTENSIONS.items():
+        if key.lower().endswith(extension):
+            return compression
+    return None
+
+
+def get_compression_from_magic_bytes(input_file):
+    """
+    Peeks at the start of a seekable or buffered file to recognise the codec
+    which compressed it, returning None for uncompressed files
+    """
+    if input_file.seekable():
+        position = input_file.tell()
+        header = input_file.read(MAGIC_BYTES_LENGTH)
+        input_file.seek(position)
+    elif hasattr(input_file, "peek"):
+        header = input_file.peek(MAGIC_BYTES_LENGTH)[:MAGIC_BYTES_LENGTH]
+    else:
+        return None
+    for magic, compression in MAGIC_BYTES.items():
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def iter_gzip_members(input_file, chunk_size):
+    """
+    Decompresses a gzip stream made of one or more concatenated members,
+    yielding (compressed, data, member_end) tuples where compressed are the
+    bytes of the stream decompressed into data, so that the compressed bytes
+    of a member can be copied as they are. At most chunk_size bytes are read
+    or decompressed at once.
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    started = False
+    compressed = b""
+    while True:
+        if not compressed:
+            compressed = input_file.read(chunk_size)
+            if not compressed:
+                break
+        if not started and not compressed.strip(b"\x00"):
+            # Null padding after the last member, as skipped by GzipFile
+            compressed = b""
+            continue
+        started = True
+        data = decompressor.decompress(compressed, chunk_size)
+        if decompressor.eof:
+            rest = decompressor.unused_data
+        else:
+            rest = decompressor.unconsumed_tail
+        yield compressed[: len(compressed) - len(rest)], data, decompressor.eof
+        if decompressor.eof:
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+            started = False
+        compressed = rest
+    if started:
+        data = decompressor.flush()
+        if not decompressor.eof:
+            raise EOFError(
+                "Compressed file ended before the end-of-stream marker was reached"
+            )
+        yield b"", data, True
+
+
+class SnappyFramedReader:
+    """
+    Decompresses a stream in the Snappy framing format. Reads may return more
+    than the requested size, as whole frames are decompressed at once.
+    """
+
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.decompressor = snappy.StreamDecompressor()
+
+    def read(self, size=-1):
+        while True:
+            compressed = self.input_file.read(size)
+            if not compressed:
+                self.decompressor.flush()
+                return b""
+            data = self.decompressor.decompress(compressed)
+            if data:
+                return data
+
+
+class SnappyFramedWriter:
+    """
+    Compresses the data written to it in the Snappy framing format
+    """
+
+    def __init__(self, out_stream):
+        self.out_stream = out_stream
+        self.compressor = snappy.StreamCompressor()
+
+    def write(self, data):
+        data = bytes(data)
+        self.out_stream.write(self.compressor.add_chunk(data))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def open_input(input_file, compression):
+    """
+    Returns a file-like object decompressing the input file on the fly
+    """
+    if compression == "gzip":
+        return GzipFile(None, "rb", fileobj=input_file)
+    if compression == "bz2":
+        return bz2.BZ2File(input_file, "rb")
+    if compression == "zstd":
+        # pyarrow 2.0 only accepts native files as the compressed stream
+        return pa.CompressedInputStream(pa.PythonFile(input_file, mode="r"), "zstd")
+    if compression == "snappy":
+        return SnappyFramedReader(input_file)
+    return input_file
+
+
+def open_output(out_stream, compression, compression_level):
+    """
+    Returns a file-like object compressing the data written to it on the fly
+    into the output stream, which has to be closed once everything is written.
+    The compression level only applies to gzip.
+    """
+    if compression == "gzip":
+        return GzipFile(None, "wb", compression_level, fileobj=out_stream)
+    if compression == "bz2":
+        return bz2.BZ2File(out_stream, "wb")
+    if compression == "zstd":
+        return pa.CompressedOutputStream(pa.PythonFile(out_stream, mode="w"), "zstd")
+    if compression == "snappy":
+        return SnappyFramedWriter(out_stream)
+    return out_stream
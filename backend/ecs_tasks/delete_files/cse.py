@@ -2,12 +2,13 @@ import base64
 import json
 import logging
 import os
-from io import BytesIO
+import threading
+import time
+from io import BufferedReader, RawIOBase
 
 from cryptography.hazmat.primitives.ciphers import Cipher
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.ciphers.algorithms import AES
-from cryptography.hazmat.primitives.ciphers.modes import CBC
+from cryptography.hazmat.primitives.ciphers.modes import CBC, GCM
 from cryptography.hazmat.primitives.padding import PKCS7
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,8 @@ HEADER_MATDESC = "x-amz-matdesc"
 HEADER_TAG_LEN = "x-amz-tag-len"
 HEADER_UE_CLENGHT = "x-amz-unencrypted-content-length"
 HEADER_WRAP_ALG = "x-amz-wrap-alg"
+GCM_TAG_LENGTH = 16
+READ_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 def is_kms_cse_encrypted(s3_metadata):
@@ -36,57 +39,293 @@ def is_kms_cse_encrypted(s3_metadata):
     return False
 
 
-def get_encryption_aes_key(key, kms_client):
-    encryption_context = {"kms_cmk_id": key}
-    response = kms_client.generate_data_key(
-        KeyId=key, EncryptionContext=encryption_context, KeySpec="AES_256"
-    )
-    return (
-        response["Plaintext"],
-        encryption_context,
-        base64.b64encode(response["CiphertextBlob"]).decode(),
-    )
+def get_encryption_aes_key(key, kms_client, data_key_pool=None):
+    def generate():
+        encryption_context = {"kms_cmk_id": key}
+        response = kms_client.generate_data_key(
+            KeyId=key, EncryptionContext=encryption_context, KeySpec="AES_256"
+        )
+        return (
+            response["Plaintext"],
+            encryption_context,
+            base64.b64encode(response["CiphertextBlob"]).decode(),
+        )
+
+    if data_key_pool is None:
+        return generate()
+    return data_key_pool.get(key, generate)
+
+
+class DataKeyPool:
+    """
+    Data keys generated by KMS ahead of time for each CMK, so that generating
+    a data key leaves the critical path of rewriting an object. Whenever
+    fewer than size keys are left for a CMK, a background thread requests
+    new keys, and each key is handed out at most max_reuse times. As pool
+    workers process a single message each, the keys can be kept in a dict
+    shared by the workers with a lock, created by a multiprocessing Manager.
+    The background threads are daemonic so that workers don't wait for them:
+    the keys generated while the object is rewritten are already shared when
+    the worker exits, and the pool is topped up by the next workers.
+    """
+
+    def __init__(
+        self, size, max_reuse=1, keys=None, lock=None, namespace=None, refills=None
+    ):
+        self.size = size
+        self.max_reuse = max_reuse
+        self.keys = {} if keys is None else keys
+        self.lock = threading.Lock() if lock is None else lock
+        self.namespace = namespace
+        self.refills = [] if refills is None else refills
+
+    def scope(self, namespace):
+        """
+        Returns a view of the pool sharing its keys only with the views of
+        the same namespace, such as the role used to call KMS
+        """
+        return DataKeyPool(
+            self.size, self.max_reuse, self.keys, self.lock, namespace, self.refills
+        )
+
+    def get(self, cmk_id, generate):
+        pool_key = (self.namespace, cmk_id)
+        data_key = None
+        with self.lock:
+            keys = self.keys.get(pool_key, [])
+            if keys:
+                (data_key, uses), keys = keys[0], keys[1:]
+                if uses > 1:
+                    keys.insert(0, (data_key, uses - 1))
+                self.keys[pool_key] = keys
+        if data_key is None:
+            logger.info("No pre-generated data key available")
+            data_key = generate()
+            if self.max_reuse > 1:
+                self.add(pool_key, data_key, self.max_reuse - 1)
+        if self.is_short(pool_key):
+            refill = threading.Thread(
+                target=self.refill, args=(pool_key, generate), daemon=True
+            )
+            refill.start()
+            self.refills.append(refill)
+        return data_key
+
+    def is_short(self, pool_key):
+        return len(self.keys.get(pool_key, [])) < self.size
+
+    def add(self, pool_key, data_key, uses):
+        with self.lock:
+            keys = self.keys.get(pool_key, [])
+            if len(keys) >= self.size:
+                return False
+            self.keys[pool_key] = keys + [(data_key, uses)]
+            return True
+
+    def refill(self, pool_key, generate):
+        try:
+            while self.is_short(pool_key):
+                if not self.add(pool_key, generate(), self.max_reuse):
+                    return
+        except Exception as e:
+            logger.warning("Unable to pre-generate data keys: %s", str(e))
+
+    def join(self):
+        """
+        Waits for the background refills started by this process
+        """
+        while self.refills:
+            self.refills.pop().join()
+
+
+def get_decryption_aes_key(key, material_description, kms_client, data_key_cache=None):
+    def unwrap():
+        return kms_client.decrypt(
+            CiphertextBlob=key, EncryptionContext=material_description
+        )["Plaintext"]
+
+    if data_key_cache is None:
+        return unwrap()
+    return data_key_cache.get(key, material_description, unwrap)
+
+
+class DataKeyCache:
+    """
+    Cache of the data keys unwrapped by KMS, keyed by the wrapped key and the
+    encryption context, so that the objects sharing a data key cost a single
+    Decrypt call. Entries expire after ttl seconds, and the entries closest
+    to expiry are evicted beyond max_size entries. As pool workers process a
+    single message each, the entries and the hit counts can be kept in dicts
+    shared by the workers, created by a multiprocessing Manager.
+    """
+
+    def __init__(self, max_size, ttl, entries=None, counts=None, namespace=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = {} if entries is None else entries
+        self.counts = {} if counts is None else counts
+        self.namespace = namespace
+
+    def scope(self, namespace):
+        """
+        Returns a view of the cache sharing its entries only with the views
+        of the same namespace, such as the role used to call KMS, so that a
+        data key is only returned to callers authorised to unwrap it
+        """
+        return DataKeyCache(
+            self.max_size, self.ttl, self.entries, self.counts, namespace
+        )
+
+    def get(self, key, material_description, unwrap):
+        cache_key = (
+            self.namespace,
+            key,
+            json.dumps(material_description, sort_keys=True),
+        )
+        now = time.monotonic()
+        entry = self.entries.get(cache_key)
+        if entry and entry[1] > now:
+            self.record("Hits")
+            return entry[0]
+        plaintext = unwrap()
+        self.record("Misses")
+        self.evict(now)
+        self.entries[cache_key] = (plaintext, now + self.ttl)
+        return plaintext
+
+    def evict(self, now):
+        if len(self.entries) < self.max_size:
+            return
+        for cache_key, (_, expires_at) in list(self.entries.items()):
+            if expires_at <= now:
+                self.entries.pop(cache_key, None)
+        while self.entries and len(self.entries) >= self.max_size:
+            cache_key, _ = min(self.entries.items(), key=lambda item: item[1][1])
+            self.entries.pop(cache_key, None)
 
+    def record(self, outcome):
+        self.counts[outcome] = self.counts.get(outcome, 0) + 1
 
-def get_decryption_aes_key(key, material_description, kms_client):
-    return kms_client.decrypt(
-        CiphertextBlob=key, EncryptionContext=material_description
-    )["Plaintext"]
+    def get_statistics(self):
+        """
+        Returns the number of hits and misses of the lookups so far, shared
+        by every view of the cache
+        """
+        return self.counts.get("Hits", 0), self.counts.get("Misses", 0)
 
 
-def encrypt(buf, s3_metadata, kms_client):
+def encrypt(s3_metadata, kms_client, data_key_pool=None):
     """
     Method to encrypt an S3 object with KMS based Client-side encryption (CSE).
     The original object's metadata (previously used to decrypt the content) is
     used to infer some parameters such as the algorithm originally used to encrypt
     the previous version (which is left unchanged) and to store the new envelope,
     including the initialization vector (IV).
+    The content is encrypted while it's written, so that the new object can be
+    uploaded part by part. The returned metadata lacks the unencrypted content
+    length, which is only known once the writer is closed: the complete
+    metadata is then returned by the get_metadata method of the writer. The
+    data key is taken from the data_key_pool when given.
+    :returns tuple containing the metadata of the new object and a function
+        wrapping the stream the new object is written to in an EncryptingWriter
     """
     logger.info("Encrypting Object with CSE-KMS")
-    content = buf.read()
     alg = s3_metadata.get(HEADER_ALG, None)
     matdesc = json.loads(s3_metadata[HEADER_MATDESC])
     aes_key, matdesc_metadata, key_metadata = get_encryption_aes_key(
-        matdesc["kms_cmk_id"], kms_client
+        matdesc["kms_cmk_id"], kms_client, data_key_pool
     )
-    s3_metadata[HEADER_UE_CLENGHT] = str(len(content))
+    s3_metadata = {k: v for k, v in s3_metadata.items() if k != HEADER_UE_CLENGHT}
     s3_metadata[HEADER_WRAP_ALG] = "kms"
     s3_metadata[HEADER_KEY] = key_metadata
     s3_metadata[HEADER_ALG] = alg
     if alg == ALG_GCM:
         s3_metadata[HEADER_TAG_LEN] = str(AES_BLOCK_SIZE)
-        result, iv = encrypt_gcm(aes_key, content)
+        iv = os.urandom(12)
+        cipher = Cipher(AES(aes_key), GCM(iv))
+        padding = None
     else:
-        result, iv = encrypt_cbc(aes_key, content)
+        iv = os.urandom(16)
+        cipher = Cipher(AES(aes_key), CBC(iv))
+        padding = PKCS7(AES.block_size)
     s3_metadata[HEADER_IV] = base64.b64encode(iv).decode()
-    return BytesIO(result), s3_metadata
 
+    def wrap(out_stream):
+        return EncryptingWriter(
+            out_stream,
+            s3_metadata,
+            cipher.encryptor(),
+            padding.padder() if padding else None,
+        )
 
-def decrypt(file_input, s3_metadata, kms_client):
+    return s3_metadata, wrap
+
+
+class EncryptingWriter:
+    """
+    Writable stream encrypting the content written to it into another
+    stream, without holding more than a block. Closing the writer writes the
+    last block (and the GCM authentication tag) but doesn't close the
+    wrapped stream.
+    """
+
+    def __init__(self, out_stream, s3_metadata, encryptor, padder=None):
+        self.out_stream = out_stream
+        self.s3_metadata = s3_metadata
+        self.encryptor = encryptor
+        self.padder = padder
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed stream")
+        size = memoryview(data).nbytes
+        if self.padder:
+            data = self.padder.update(data)
+        self.out_stream.write(self.encryptor.update(data))
+        self.position += size
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        final = self.padder.finalize() if self.padder else b""
+        final = self.encryptor.update(final) + self.encryptor.finalize()
+        if not self.padder:
+            # AES/GCM appends the authentication tag to the ciphertext
+            final += self.encryptor.tag
+        self.out_stream.write(final)
+
+    def get_metadata(self):
+        """
+        Returns the metadata of the encrypted object, including the
+        unencrypted content length which is only known once closed
+        """
+        if not self.closed:
+            raise ValueError("Metadata is only complete once the stream is closed")
+        return {**self.s3_metadata, HEADER_UE_CLENGHT: str(self.position)}
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+
+def decrypt(file_input, s3_metadata, kms_client, data_key_cache=None):
     """
     Method to decrypt an S3 object with KMS based Client-side encryption (CSE).
     The object's metadata is used to fetch the encryption envelope such as 
     the KMS key ID and the algorithm. 
+    The returned file-like object decrypts the object while it's read, so
+    that neither the whole ciphertext nor the whole plaintext is held in
+    memory. With AES/GCM, the authentication tag is only verified once the
+    end of the object is read, at which point an invalid tag raises an error.
     """
     logger.info("Decrypting Object with CSE-KMS")
     alg = s3_metadata.get(HEADER_ALG, None)
@@ -94,45 +333,69 @@ def decrypt(file_input, s3_metadata, kms_client):
     material_description = json.loads(s3_metadata[HEADER_MATDESC])
     key = s3_metadata[HEADER_KEY]
     decryption_key = base64.b64decode(key)
-    aes_key = get_decryption_aes_key(decryption_key, material_description, kms_client)
-    content = file_input.read()
-    decrypted = (
-        decrypt_gcm(content, aes_key, iv)
-        if alg == ALG_GCM
-        else decrypt_cbc(content, aes_key, iv)
+    aes_key = get_decryption_aes_key(
+        decryption_key, material_description, kms_client, data_key_cache
     )
-    return BytesIO(decrypted)
-
-
-# AES/CBC/PKCS5Padding
-
-
-def encrypt_cbc(aes_key, content):
-    iv = os.urandom(16)
-    padder = PKCS7(AES.block_size).padder()
-    padded_result = padder.update(content) + padder.finalize()
-    aescbc = Cipher(AES(aes_key), CBC(iv)).encryptor()
-    result = aescbc.update(padded_result) + aescbc.finalize()
-    return result, iv
-
-
-def decrypt_cbc(content, aes_key, iv):
-    aescbc = Cipher(AES(aes_key), CBC(iv)).decryptor()
-    padded_result = aescbc.update(content) + aescbc.finalize()
-    unpadder = PKCS7(AES.block_size).unpadder()
-    return unpadder.update(padded_result) + unpadder.finalize()
+    if alg == ALG_GCM:
+        reader = DecryptingReader(
+            file_input,
+            Cipher(AES(aes_key), GCM(iv, min_tag_length=GCM_TAG_LENGTH)).decryptor(),
+            tag_length=GCM_TAG_LENGTH,
+        )
+    else:
+        reader = DecryptingReader(
+            file_input,
+            Cipher(AES(aes_key), CBC(iv)).decryptor(),
+            unpadder=PKCS7(AES.block_size).unpadder(),
+        )
+    return BufferedReader(reader)
 
 
-# AES/GCM/NoPadding
+class DecryptingReader(RawIOBase):
+    """
+    Raw stream decrypting the ciphertext read from a file in chunks. The
+    last bytes of the ciphertext are held back when they are the GCM
+    authentication tag, and the PKCS7 padding of CBC is removed at the end.
+    """
 
+    def __init__(self, file_input, decryptor, unpadder=None, tag_length=0):
+        self.file_input = file_input
+        self.decryptor = decryptor
+        self.unpadder = unpadder
+        self.tag_length = tag_length
+        self.tail = b""
+        self.plaintext = memoryview(b"")
+        self.finished = False
 
-def encrypt_gcm(aes_key, content):
-    iv = os.urandom(12)
-    aesgcm = AESGCM(aes_key)
-    result = aesgcm.encrypt(iv, content, None)
-    return result, iv
+    def readable(self):
+        return True
 
+    def decrypt_next_chunk(self):
+        ciphertext = self.file_input.read(READ_CHUNK_SIZE)
+        if not ciphertext:
+            self.finished = True
+            if self.tag_length:
+                if len(self.tail) < self.tag_length:
+                    raise ValueError("Encrypted object is missing its tag")
+                plaintext = self.decryptor.finalize_with_tag(self.tail)
+            else:
+                plaintext = self.decryptor.finalize()
+            if self.unpadder:
+                plaintext = self.unpadder.update(plaintext) + self.unpadder.finalize()
+            return plaintext
+        if self.tag_length:
+            ciphertext = self.tail + ciphertext
+            self.tail = ciphertext[-self.tag_length :]
+            ciphertext = ciphertext[: -self.tag_length]
+        plaintext = self.decryptor.update(ciphertext)
+        if self.unpadder:
+            plaintext = self.unpadder.update(plaintext)
+        return plaintext
 
-def decrypt_gcm(content, aes_key, iv):
-    aesgcm = AESGCM(aes_key)
-    return aesgcm.decrypt(iv, content, None)
+    def readinto(self, b):
+        while not self.plaintext and not self.finished:
+            self.plaintext = memoryview(self.decrypt_next_chunk())
+        size = min(len(b), len(self.plaintext))
+        b[:size] = self.plaintext[:size]
+        self.plaintext = self.plaintext[size:]
+        return size
@@ -1,20 +1,253 @@
-from gzip import GzipFile
-from io import BytesIO
 import json
-from collections import Counter
+import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
-from boto_utils import json_lines_iterator
+from boto_utils import json_loads
+from compression import (
+    DEFAULT_COMPRESSION_LEVEL,
+    get_compression_from_magic_bytes,
+    iter_gzip_members,
+    open_input,
+    open_output,
+)
+from pyarrow import BufferOutputStream
 
-from pyarrow import BufferOutputStream, CompressedOutputStream
+from utils import map_in_order
 
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_PASSTHROUGH_MEMBER_SIZE = 16 * READ_CHUNK_SIZE
+MAX_PATTERN_LENGTH = 64
+# Characters which may be escaped in JSON strings
+ESCAPABLE_CHARACTERS = re.compile(r'["\\/\x00-\x1f]')
+# Lines which may contain a string or a number equal to a MatchId without
+# containing it verbatim
+UNICODE_ESCAPE = re.escape(b"\\u")
+NUMBER_WITH_EXPONENT = rb"[0-9][eE][-+]?[0-9]"
+# Numbers with 16 significant digits or more may round to an integer MatchId
+LONG_NUMBER = rb"(?:[0-9]\.?){15}[0-9]"
+INTEGER = re.compile(r"-?(?:0|[1-9][0-9]*)")
 
-def initialize(input_file, out_stream, compressed):
-    if compressed:
-        bytestream = BytesIO(input_file.read())
-        input_file = GzipFile(None, "rb", fileobj=bytestream)
-    gzip_stream = CompressedOutputStream(out_stream, "gzip") if compressed else None
-    writer = gzip_stream if compressed else out_stream
-    return input_file, writer
+
+def initialize(input_file, out_stream, compression, compression_level, chunk_size):
+    """
+    Returns the chunks of lines of the object, each with the gzip member it
+    was read from (or None), and the writer of the kept lines. Compressed
+    objects are decompressed and compressed on the fly with the codec of the
+    object, without ever holding the whole object in memory. When the codec
+    isn't known from the object key, it's detected from the magic bytes.
+    """
+    compression = compression or get_compression_from_magic_bytes(input_file)
+    if compression == "gzip":
+        chunks = iter_member_chunks(input_file, chunk_size)
+        return chunks, GzipMemberWriter(out_stream, compression_level)
+    input_file = open_input(input_file, compression)
+    writer = open_output(out_stream, compression, compression_level)
+    chunks = ((chunk, None) for chunk in iter_chunks(input_file, chunk_size))
+    return chunks, LinesWriter(writer, out_stream)
+
+
+def iter_chunks(input_file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yields the content of a file in chunks of complete lines, each chunk
+    ending with a newline, so that only the current chunk and a partial line
+    are held in memory whatever the size of the file. A newline is added at
+    the end of the file when it's missing.
+    """
+    remainder = b""
+    while True:
+        chunk = input_file.read(chunk_size)
+        if not chunk:
+            break
+        buf = remainder + chunk if remainder else chunk
+        end = buf.rfind(b"\n") + 1
+        if end:
+            yield buf[:end]
+        remainder = buf[end:]
+    if remainder:
+        yield remainder + b"\n"
+
+
+class GzipMember:
+    """
+    Compressed bytes of a gzip member, kept while the member may be copied
+    as it is to the new object: the member has to start and end on line
+    boundaries and be small enough to be held in memory
+    """
+
+    def __init__(self, passthrough=True):
+        self.passthrough = passthrough
+        self.compressed = []
+        self.size = 0
+
+    def add(self, compressed, data_size):
+        self.size += len(compressed) + data_size
+        if self.size > MAX_PASSTHROUGH_MEMBER_SIZE:
+            self.passthrough = False
+        if self.passthrough:
+            self.compressed.append(compressed)
+        else:
+            self.compressed = []
+
+
+def iter_member_chunks(input_file, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yields the content of a gzip file made of concatenated members (as
+    produced by Kinesis Data Firehose) in chunks of complete lines, with the
+    member each chunk was decompressed from. A line which continues in the
+    next member is added to the first chunk of the next member, and neither
+    member can be copied as it is.
+    """
+    member = GzipMember()
+    remainder = b""
+    for compressed, data, member_end in iter_gzip_members(input_file, chunk_size):
+        member.add(compressed, len(data))
+        buf = remainder + data if remainder else data
+        end = buf.rfind(b"\n") + 1
+        if end:
+            yield buf[:end], member
+        remainder = buf[end:]
+        if member_end:
+            if remainder:
+                member.passthrough = False
+                member.compressed = []
+            member = GzipMember(passthrough=not remainder)
+    if remainder:
+        yield remainder + b"\n", member
+
+
+def find_candidate_lines(chunk, prefilter):
+    """
+    Yields the (start, end) offsets of the lines of a chunk which may contain
+    a MatchId according to the prefilter, or of every line if there's no
+    prefilter. The end offset is the one of the newline ending the line.
+    """
+    pos = 0
+    while pos < len(chunk):
+        if prefilter:
+            match = prefilter.search(chunk, pos)
+            if not match:
+                return
+            start = chunk.rfind(b"\n", pos, match.start()) + 1 or pos
+        else:
+            start = pos
+        end = chunk.find(b"\n", start)
+        yield start, end
+        pos = end + 1
+
+
+def parse_line(line, line_number):
+    try:
+        return json_loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(
+            "Serialization error when parsing JSON lines: {}".format(
+                str(e).replace("line 1", "line {}".format(line_number)),
+            )
+        )
+
+
+def get_trie_pattern(literals):
+    """
+    Returns a regex matching any of the literals, with their common prefixes
+    factored so that the regex engine doesn't try each literal in turn at
+    every position. As any match is enough, literals which have a shorter
+    literal as prefix are dropped.
+    """
+    trie = {}
+    for literal in literals:
+        node = trie
+        for byte in literal:
+            if node.get(None):
+                break
+            node = node.setdefault(byte, {})
+        else:
+            node.clear()
+            node[None] = True
+
+    def build(node):
+        if node.get(None):
+            return b""
+        alternatives = []
+        for byte, child in sorted(node.items()):
+            run = bytearray([byte])
+            while len(child) == 1 and None not in child:
+                ((byte, child),) = child.items()
+                run.append(byte)
+            alternatives.append(re.escape(bytes(run)) + build(child))
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return b"(?:" + b"|".join(alternatives) + b")"
+
+    return build(trie) if trie else None
+
+
+def get_match_id_literals(match_id):
+    """
+    Returns the byte strings at least one of which appears in the raw line
+    when it has a value equal to the MatchId, unless the value is written
+    with unicode escapes or with an exponent (see build_prefilter). Returns
+    None when there are no such byte strings.
+    """
+    if isinstance(match_id, str):
+        fragment = max(ESCAPABLE_CHARACTERS.split(match_id), key=len)
+        if not fragment:
+            return None
+        if fragment == match_id:
+            # Quoted so that the regex engine only tries the MatchIds at quotes
+            fragment = '"{}"'.format(match_id)
+        return [fragment.encode("utf-8")[:MAX_PATTERN_LENGTH]]
+    if isinstance(match_id, (int, float)) and abs(match_id) < 2 ** 53:
+        if not float(match_id).is_integer():
+            return None
+        literals = [str(int(match_id)).encode("utf-8")]
+        # True == 1
+        return literals + [b"true"] if match_id == 1 else literals
+    return None
+
+
+def build_prefilter(to_delete):
+    """
+    Returns a compiled regex which finds every line that may contain one of
+    the MatchIds, so that lines which can't match are written back without
+    being parsed. Returns None if some MatchId can't be prefiltered, in which
+    case every line has to be parsed.
+    Values which are falsy never match (see is_match), and composite MatchIds
+    only match when each of their values is found, so looking for any of
+    their values is enough.
+    """
+    literals = set()
+    extras = set()
+    for column in to_delete:
+        if column["Type"] == "Simple":
+            match_ids = column["MatchIds"]
+        elif any(len(match_id) == 0 for match_id in column["MatchIds"]):
+            return None
+        else:
+            match_ids = [value for match_id in column["MatchIds"] for value in match_id]
+        for match_id in map(normalise, match_ids):
+            if not match_id:
+                continue
+            match_id_literals = get_match_id_literals(match_id)
+            if match_id_literals is None:
+                return None
+            literals.update(match_id_literals)
+            extras.add(UNICODE_ESCAPE)
+            if not isinstance(match_id, str):
+                extras.update([NUMBER_WITH_EXPONENT, LONG_NUMBER])
+    return compile_prefilter(frozenset(literals), frozenset(extras))
+
+
+@lru_cache(maxsize=1)
+def compile_prefilter(literals, extras):
+    """
+    Compiling the regex takes a few seconds for thousands of MatchIds, so it
+    is reused for the objects which share the same MatchIds
+    """
+    trie_pattern = get_trie_pattern(literals)
+    patterns = sorted(extras) + ([trie_pattern] if trie_pattern else [])
+    return re.compile(b"|".join(patterns) if patterns else b"(?!)")
 
 
 def find_key(key, obj):
@@ -32,50 +265,291 @@ def find_key(key, obj):
             return found_key
 
 
-def get_value(key, obj):
+def compile_key_path(key):
     """
-    Method to find a value given a nested key in an object. Example:
+    Returns a function finding the value of a nested key in an object. Example:
     key="user.Id"
     obj='{"user":{"id": 1234}}'
     result=1234
+    The spelling of each key found in the data (for instance customerId for
+    customerid) is remembered, so that the objects of the following records
+    are accessed directly, and only scanned by find_key when the spelling
+    differs.
     """
-    for segment in key.split("."):
-        current_key = find_key(segment, obj)
-        if not current_key:
-            return None
-        obj = obj[current_key]
-    return obj
-
-
-def delete_matches_from_json_file(input_file, to_delete, compressed=False):
-    deleted_rows = 0
-    with BufferOutputStream() as out_stream:
-        input_file, writer = initialize(input_file, out_stream, compressed)
-        content = input_file.read().decode("utf-8")
-        total_rows = 0
-        for parsed, line in json_lines_iterator(content, include_unparsed=True):
-            total_rows += 1
-            should_delete = False
-            for column in to_delete:
-                if column["Type"] == "Simple":
-                    record = get_value(column["Column"], parsed)
-                    if record and record in column["MatchIds"]:
-                        should_delete = True
-                        break
-                else:
-                    matched = []
-                    for col in column["Columns"]:
-                        record = get_value(col, parsed)
-                        if record:
-                            matched.append(record)
-                    if matched in column["MatchIds"]:
-                        should_delete = True
-                        break
-            if should_delete:
-                deleted_rows += 1
-            else:
-                writer.write(bytes(line + "\n", "utf-8"))
-        if compressed:
-            writer.close()
-        stats = Counter({"ProcessedRows": total_rows, "DeletedRows": deleted_rows})
-        return out_stream, stats
+    segments = key.split(".")
+    spellings = list(segments)
+
+    def get_value(obj):
+        for i, segment in enumerate(segments):
+            if not isinstance(obj, dict):
+                return None
+            spelling = spellings[i]
+            if spelling not in obj:
+                spelling = find_key(segment, obj)
+                if not spelling:
+                    return None
+                spellings[i] = spelling
+            obj = obj[spelling]
+        return obj
+
+    return get_value
+
+
+def normalise(value):
+    """
+    Athena casts the values of the JSON objects to the type of the column, so
+    that 12345 and "12345" are the same identifier
+    """
+    if type(value) is str and INTEGER.fullmatch(value):
+        return int(value)
+    return value
+
+
+def build_match_id_set(column):
+    """
+    Returns the normalised MatchIds of a column as a set, with tuples for the
+    Composite columns, so that looking up a record doesn't depend on the
+    number of MatchIds
+    """
+    if column["Type"] == "Simple":
+        return {normalise(match_id) for match_id in column["MatchIds"]}
+    return {tuple(map(normalise, match_id)) for match_id in column["MatchIds"]}
+
+
+def is_in(value, match_ids):
+    try:
+        return value in match_ids
+    except TypeError:
+        # Unhashable values (objects or arrays) can't be MatchIds
+        return False
+
+
+def compile_columns(to_delete):
+    """
+    Compiles the key paths and builds the MatchId sets of the Simple and
+    Composite columns, so that they are built only once per file instead of
+    once per line
+    """
+    return [
+        {
+            **column,
+            "MatchIds": build_match_id_set(column),
+            "Getters": [
+                compile_key_path(key)
+                for key in (
+                    [column["Column"]]
+                    if column["Type"] == "Simple"
+                    else column["Columns"]
+                )
+            ],
+        }
+        for column in to_delete
+    ]
+
+
+def is_match(parsed, to_delete):
+    for column in to_delete:
+        if column["Type"] == "Simple":
+            record = column["Getters"][0](parsed)
+            if record and is_in(normalise(record), column["MatchIds"]):
+                return True
+        else:
+            matched = []
+            for get_value in column["Getters"]:
+                record = get_value(parsed)
+                if record:
+                    matched.append(normalise(record))
+            if is_in(tuple(matched), column["MatchIds"]):
+                return True
+    return False
+
+
+def search_chunk(chunk, line_number, prefilter, to_delete):
+    """
+    Returns the (start, end) offsets of the lines of a chunk which match a
+    MatchId, line_number being the number of the first line of the chunk
+    """
+    deleted = []
+    counted_to = 0
+    for start, end in find_candidate_lines(chunk, prefilter):
+        line_number += chunk.count(b"\n", counted_to, start)
+        counted_to = start
+        parsed = parse_line(chunk[start:end], line_number)
+        if is_match(parsed, to_delete):
+            deleted.append((start, end))
+    return deleted
+
+
+def write_kept_lines(writer, view, deleted):
+    """
+    Writes the runs of lines of a chunk between the deleted lines as slices
+    of the chunk rather than line by line
+    """
+    kept_from = 0
+    for start, end in deleted:
+        if start > kept_from:
+            writer.write(view[kept_from:start])
+        kept_from = end + 1
+    if kept_from < len(view):
+        writer.write(view[kept_from:])
+
+
+class LinesWriter:
+    """
+    Writes the kept lines of each chunk to the output stream, through the
+    encoder of the compression codec if any
+    """
+
+    def __init__(self, writer, out_stream):
+        self.writer = writer
+        self.out_stream = out_stream
+
+    def write(self, view, deleted, member=None):
+        write_kept_lines(self.writer, view, deleted)
+
+    def close(self):
+        if self.writer is not self.out_stream:
+            self.writer.close()
+
+
+class GzipMemberWriter:
+    """
+    Writes the kept lines of a gzip file made of concatenated members. The
+    compressed bytes of the members without any deleted line are copied as
+    they are, while the lines of the other members are recompressed into new
+    members, so that rewriting a large file to delete a few lines costs
+    little more than copying it. The chunks of a member are held until the
+    end of the member is known, unless the member can't be copied.
+    """
+
+    def __init__(self, out_stream, compression_level):
+        self.out_stream = out_stream
+        self.compression_level = compression_level
+        self.writer = None
+        self.member = None
+        self.modified = False
+        self.pending = []
+        self.written = False
+
+    def write(self, view, deleted, member=None):
+        if member is not self.member:
+            self.end_member()
+            self.member = member
+            self.modified = False
+        self.modified = self.modified or bool(deleted)
+        self.pending.append((view, deleted))
+        if self.modified or not member.passthrough:
+            self.recompress_pending()
+
+    def recompress_pending(self):
+        if self.writer is None:
+            self.writer = open_output(self.out_stream, "gzip", self.compression_level)
+        for view, deleted in self.pending:
+            write_kept_lines(self.writer, view, deleted)
+        self.pending = []
+
+    def end_recompressed_member(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.written = True
+
+    def end_member(self):
+        if self.member is None:
+            return
+        if self.member.passthrough and not self.modified:
+            self.end_recompressed_member()
+            for compressed in self.member.compressed:
+                self.out_stream.write(compressed)
+            self.pending = []
+            self.written = True
+        else:
+            self.recompress_pending()
+        self.member = None
+
+    def close(self):
+        self.end_member()
+        if not self.written and self.writer is None:
+            # Empty files are written as a single empty member
+            self.recompress_pending()
+        self.end_recompressed_member()
+
+
+worker_state = {}
+
+
+def init_worker(to_delete):
+    """
+    Builds the prefilter and the columns once in each worker process. With
+    forked processes, the prefilter compiled by the parent is reused.
+    """
+    worker_state["prefilter"] = build_prefilter(to_delete)
+    worker_state["to_delete"] = compile_columns(to_delete)
+
+
+def search_chunk_in_worker(item):
+    chunk, line_number = item
+    return search_chunk(
+        chunk, line_number, worker_state["prefilter"], worker_state["to_delete"]
+    )
+
+
+def delete_matches_from_json_file(
+    input_file,
+    to_delete,
+    compression=None,
+    out_stream=None,
+    max_workers=1,
+    compression_level=DEFAULT_COMPRESSION_LEVEL,
+):
+    """
+    Deletes matches from a JSON lines file, streaming it line by line from
+    input_file (through the decoder of its compression codec) to out_stream, or
+    to an in-memory buffer when out_stream isn't given. Lines which don't
+    contain any of the MatchIds are written back without being parsed, and
+    the runs of lines between two deleted lines are written as slices of the
+    input chunk rather than line by line. Compressed objects are written back
+    with the same codec, gzip using the given compression level (1 is the
+    fastest, 9 the smallest). The gzip members without any deleted line are
+    copied without being recompressed (see GzipMemberWriter).
+    With max_workers greater than 1, chunks are searched concurrently by a
+    pool of processes, as parsing is CPU bound, and written in their original
+    order. Only the chunks waiting to be searched or written are held in
+    memory.
+    """
+    if out_stream is None:
+        out_stream = BufferOutputStream()
+    read_chunks, writer = initialize(
+        input_file, out_stream, compression, compression_level, READ_CHUNK_SIZE
+    )
+    prefilter = build_prefilter(to_delete)
+    columns = compile_columns(to_delete)
+    stats = Counter({"ProcessedRows": 0, "DeletedRows": 0})
+    chunks = deque()
+
+    def number_chunks():
+        for chunk, member in read_chunks:
+            chunks.append((chunk, member))
+            yield chunk, stats["ProcessedRows"] + 1
+            stats["ProcessedRows"] += chunk.count(b"\n")
+
+    if max_workers > 1:
+        results = map_in_order(
+            search_chunk_in_worker,
+            number_chunks(),
+            max_workers,
+            executor_class=ProcessPoolExecutor,
+            initializer=init_worker,
+            initargs=(to_delete,),
+        )
+    else:
+        results = (
+            search_chunk(chunk, line_number, prefilter, columns)
+            for chunk, line_number in number_chunks()
+        )
+    for deleted in results:
+        chunk, member = chunks.popleft()
+        writer.write(memoryview(chunk), deleted, member)
+        stats["DeletedRows"] += len(deleted)
+    writer.close()
+    return out_stream, stats
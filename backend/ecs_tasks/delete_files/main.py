@@ -5,7 +5,8 @@ import sys
 import signal
 import time
 import logging
-from multiprocessing import Pool, cpu_count
+from contextlib import ExitStack
+from multiprocessing import Manager, Pool, cpu_count, get_context
 from operator import itemgetter
 
 import boto3
@@ -15,7 +16,8 @@ from boto_utils import get_session, json_lines_iterator, parse_s3_url
 from botocore.exceptions import ClientError
 from pyarrow.lib import ArrowException
 
-from cse import decrypt, encrypt, is_kms_cse_encrypted
+from compression import get_compression_from_key
+from cse import DataKeyCache, DataKeyPool, decrypt, encrypt, is_kms_cse_encrypted
 from events import sanitize_message, emit_failure_event, emit_deletion_event
 from json_handler import delete_matches_from_json_file
 from parquet_handler import delete_matches_from_parquet_file
@@ -24,8 +26,9 @@ from s3 import (
     DeleteOldVersionsError,
     fetch_manifest,
     IntegrityCheckFailedError,
+    open_object_version,
     rollback_object_version,
-    save,
+    save_stream,
     validate_bucket_versioning,
     verify_object_versions_integrity,
 )
@@ -37,6 +40,17 @@ handler = logging.StreamHandler(stream=sys.stdout)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+PARQUET_ROW_GROUP_WORKERS = int(os.getenv("PARQUET_ROW_GROUP_WORKERS", 1))
+JSON_CHUNK_WORKERS = int(os.getenv("JSON_CHUNK_WORKERS", 1))
+GZIP_COMPRESSION_LEVEL = int(os.getenv("GZIP_COMPRESSION_LEVEL", 6))
+DATA_KEY_CACHE_SIZE = int(os.getenv("DATA_KEY_CACHE_SIZE", 1000))
+DATA_KEY_CACHE_TTL = int(os.getenv("DATA_KEY_CACHE_TTL", 300))
+DATA_KEY_POOL_SIZE = int(os.getenv("DATA_KEY_POOL_SIZE", 0))
+DATA_KEY_MAX_REUSE = int(os.getenv("DATA_KEY_MAX_REUSE", 1))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 1))
+DOWNLOAD_PART_SIZE = int(os.getenv("DOWNLOAD_PART_SIZE", 16 * 1024 * 1024))
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "S3F2")
+
 
 def handle_error(
     sqs_msg,
@@ -73,11 +87,40 @@ def validate_message(message):
             raise ValueError("Malformed message. Missing key: %s", k)
 
 
-def delete_matches_from_file(input_file, to_delete, file_format, compressed=False):
+def delete_matches_from_file(
+    input_file,
+    to_delete,
+    file_format,
+    compression=None,
+    writer_options=None,
+    out_stream=None,
+):
     logger.info("Generating new file without matches")
     if file_format == "json":
-        return delete_matches_from_json_file(input_file, to_delete, compressed)
-    return delete_matches_from_parquet_file(input_file, to_delete)
+        return delete_matches_from_json_file(
+            input_file,
+            to_delete,
+            compression,
+            out_stream,
+            JSON_CHUNK_WORKERS,
+            GZIP_COMPRESSION_LEVEL,
+        )
+    return delete_matches_from_parquet_file(
+        input_file,
+        to_delete,
+        writer_options,
+        out_stream,
+        max_workers=PARQUET_ROW_GROUP_WORKERS,
+    )
+
+
+def check_deleted_rows(stats, object_path):
+    if stats["DeletedRows"] == 0:
+        raise ValueError(
+            "The object {} was processed successfully but no rows required deletion".format(
+                object_path
+            )
+        )
 
 
 def build_matches(cols, manifest_object):
@@ -113,7 +156,9 @@ def build_matches(cols, manifest_object):
     )
 
 
-def execute(queue_url, message_body, receipt_handle):
+def execute(
+    queue_url, message_body, receipt_handle, data_key_cache=None, data_key_pool=None
+):
     logger.info("Message received")
     queue = get_queue(queue_url)
     msg = queue.Message(receipt_handle)
@@ -143,33 +188,63 @@ def execute(queue_url, message_body, receipt_handle):
         # Download the object in-memory and convert to PyArrow NativeFile
         logger.info("Downloading and opening %s object in-memory", object_path)
         metadata = s3.metadata(object_path, refresh=True)
-        with s3.open(object_path, "rb") as f:
+        with ExitStack() as stack:
+            f = stack.enter_context(s3.open(object_path, "rb"))
             source_version = f.version_id
             logger.info("Using object version %s as source", source_version)
-            # Write new file in-memory
-            compressed = object_path.endswith(".gz")
-            is_encrypted = is_kms_cse_encrypted(metadata)
-            input_file = decrypt(f, metadata, kms_client) if is_encrypted else f
-            out_sink, stats = delete_matches_from_file(
-                input_file, match_ids, file_format, compressed
-            )
-        if stats["DeletedRows"] == 0:
-            raise ValueError(
-                "The object {} was processed successfully but no rows required deletion".format(
-                    object_path
+            if DOWNLOAD_WORKERS > 1:
+                # Read the source version with concurrent byte-range GETs
+                f = stack.enter_context(
+                    open_object_version(
+                        client,
+                        input_bucket,
+                        input_key,
+                        source_version,
+                        DOWNLOAD_PART_SIZE,
+                        DOWNLOAD_WORKERS,
+                    )
                 )
-            )
-        with pa.BufferReader(out_sink.getvalue()) as output_buf:
-            if is_encrypted:
-                output_buf, metadata = encrypt(output_buf, metadata, kms_client)
-            new_version = save(
-                s3,
-                client,
-                output_buf,
-                input_bucket,
-                input_key,
-                metadata,
-                source_version,
+            compression = get_compression_from_key(object_path)
+            writer_options = body.get("ParquetWriterOptions")
+            input_file = f
+            encrypt_stream = None
+            if is_kms_cse_encrypted(metadata):
+                if data_key_cache is not None:
+                    data_key_cache = data_key_cache.scope(body.get("RoleArn"))
+                input_file = decrypt(f, metadata, kms_client, data_key_cache)
+                if file_format == "parquet":
+                    # Parquet files are read at random offsets
+                    input_file = pa.BufferReader(input_file.read())
+                if data_key_pool is not None:
+                    data_key_pool = data_key_pool.scope(body.get("RoleArn"))
+                metadata, encrypt_stream = encrypt(metadata, kms_client, data_key_pool)
+
+            # Upload new file to S3 while it's being written (and encrypted)
+            def write(upload_stream):
+                out_stream = upload_stream
+                if encrypt_stream:
+                    out_stream = encrypt_stream(upload_stream)
+                _, stats = delete_matches_from_file(
+                    input_file,
+                    match_ids,
+                    file_format,
+                    compression,
+                    writer_options,
+                    out_stream,
+                )
+                out_stream.close()
+                check_deleted_rows(stats, object_path)
+                if encrypt_stream and not upload_stream.set_metadata(
+                    out_stream.get_metadata()
+                ):
+                    logger.info(
+                        "Object uploaded in multiple parts without its "
+                        "unencrypted content length"
+                    )
+                return stats
+
+            new_version, stats = save_stream(
+                client, input_bucket, input_key, metadata, write, source_version,
             )
         logger.info("New object version: %s", new_version)
         verify_object_versions_integrity(
@@ -226,9 +301,43 @@ def execute(queue_url, message_body, receipt_handle):
         handle_error(msg, message_body, err_message)
 
 
-def kill_handler(msgs, process_pool):
+def emit_data_key_cache_metrics(data_key_cache):
+    """
+    Logs the hit rate of the KMS data key cache shared by the pool workers
+    and publishes it as a CloudWatch metric, once for the lifetime of the task
+    """
+    hits, misses = data_key_cache.get_statistics()
+    if hits + misses == 0:
+        return
+    hit_rate = 100 * hits / (hits + misses)
+    logger.info(
+        "KMS data key cache hit rate: %.1f%% (%s hits, %s misses)",
+        hit_rate,
+        hits,
+        misses,
+    )
+    try:
+        boto3.client("cloudwatch").put_metric_data(
+            Namespace=METRICS_NAMESPACE,
+            MetricData=[
+                {
+                    "MetricName": "DataKeyCacheHitRate",
+                    "Value": hit_rate,
+                    "Unit": "Percent",
+                },
+                {"MetricName": "DataKeyCacheHits", "Value": hits, "Unit": "Count"},
+                {"MetricName": "DataKeyCacheMisses", "Value": misses, "Unit": "Count"},
+            ],
+        )
+    except ClientError as e:
+        logger.warning("Unable to publish data key cache metrics: %s", str(e))
+
+
+def kill_handler(msgs, process_pool, data_key_cache=None):
     logger.info("Received shutdown signal. Cleaning up %s messages", str(len(msgs)))
     process_pool.terminate()
+    if data_key_cache is not None:
+        emit_data_key_cache_metrics(data_key_cache)
     for msg in msgs:
         try:
             handle_error(msg, msg.body, "SIGINT/SIGTERM received during processing")
@@ -237,6 +346,25 @@ def kill_handler(msgs, process_pool):
     sys.exit(1 if len(msgs) > 0 else 0)
 
 
+class NonDaemonicProcess(get_context("fork").Process):
+    """
+    Pool worker allowed to start the processes searching JSON chunks, which
+    daemonic processes can't do
+    """
+
+    @property
+    def daemon(self):
+        return False
+
+    @daemon.setter
+    def daemon(self, value):
+        pass
+
+
+class NonDaemonicContext(type(get_context("fork"))):
+    Process = NonDaemonicProcess
+
+
 def get_queue(queue_url, **resource_kwargs):
     if not resource_kwargs.get("endpoint_url") and os.getenv("AWS_DEFAULT_REGION"):
         resource_kwargs["endpoint_url"] = "https://sqs.{}.amazonaws.com".format(
@@ -250,9 +378,29 @@ def main(queue_url, max_messages, wait_time, sleep_time):
     logger.info("CPU count for system: %s", cpu_count())
     messages = []
     queue = get_queue(queue_url)
-    with Pool(maxtasksperchild=1) as pool:
-        signal.signal(signal.SIGINT, lambda *_: kill_handler(messages, pool))
-        signal.signal(signal.SIGTERM, lambda *_: kill_handler(messages, pool))
+    create_pool = NonDaemonicContext().Pool if JSON_CHUNK_WORKERS > 1 else Pool
+    with Manager() as manager, create_pool(maxtasksperchild=1) as pool:
+        # Shared by the pool workers, which each process a single message
+        data_key_cache = (
+            DataKeyCache(
+                DATA_KEY_CACHE_SIZE, DATA_KEY_CACHE_TTL, manager.dict(), manager.dict(),
+            )
+            if DATA_KEY_CACHE_SIZE > 0
+            else None
+        )
+        data_key_pool = (
+            DataKeyPool(
+                DATA_KEY_POOL_SIZE, DATA_KEY_MAX_REUSE, manager.dict(), manager.Lock()
+            )
+            if DATA_KEY_POOL_SIZE > 0
+            else None
+        )
+        signal.signal(
+            signal.SIGINT, lambda *_: kill_handler(messages, pool, data_key_cache)
+        )
+        signal.signal(
+            signal.SIGTERM, lambda *_: kill_handler(messages, pool, data_key_cache)
+        )
         while 1:
             logger.info("Fetching messages...")
             messages = queue.receive_messages(
@@ -262,7 +410,10 @@ def main(queue_url, max_messages, wait_time, sleep_time):
                 logger.info("No messages. Sleeping")
                 time.sleep(sleep_time)
             else:
-                processes = [(queue_url, m.body, m.receipt_handle) for m in messages]
+                processes = [
+                    (queue_url, m.body, m.receipt_handle, data_key_cache, data_key_pool)
+                    for m in messages
+                ]
                 pool.starmap(execute, processes)
                 messages = []
 
@@ -1,15 +1,59 @@
 import logging
+import threading
+from bisect import bisect_left
 from collections import Counter
 
 import numpy as np
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 
+from parquet_metadata import (
+    I64,
+    LIST,
+    MAGIC,
+    ROW_GROUP_COLUMNS,
+    ROW_GROUP_FILE_OFFSET,
+    ROW_GROUP_ORDINAL,
+    STRUCT,
+    get_chunk_range,
+    get_column_chunks,
+    get_row_groups,
+    is_schema_compatible,
+    is_self_contained,
+    read_footer,
+    relocate_column_chunk,
+    serialize_footer,
+)
+from parquet_pages import (
+    EncodedValues,
+    encode_plain_values,
+    may_contain_encoded_values,
+)
+from utils import map_in_order
+
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+# ParquetWriterOptions of the data mapper and the matching Arrow writer options
+WRITER_OPTIONS = {
+    "Compression": "compression",
+    "CompressionLevel": "compression_level",
+    "UseDictionary": "use_dictionary",
+    "DataPageSize": "data_page_size",
+    "Version": "version",
+    "DataPageVersion": "data_page_version",
+    "WriteStatistics": "write_statistics",
+}
+WRITER_CODECS = {"UNCOMPRESSED": "NONE", "LZ4_RAW": "LZ4"}
+SUPPORTED_CODECS = ["NONE", "SNAPPY", "GZIP", "BROTLI", "LZ4", "ZSTD"]
+LEVEL_CODECS = ["GZIP", "BROTLI", "ZSTD"]
+DEFAULT_CODEC = "SNAPPY"
+
 logger = logging.getLogger(__name__)
 
 
-def load_parquet(f):
-    return pq.ParquetFile(f, memory_map=False)
+def load_parquet(f, metadata=None):
+    return pq.ParquetFile(f, memory_map=False, metadata=metadata)
 
 
 def case_insensitive_getter(from_array, value):
@@ -24,93 +68,694 @@ def case_insensitive_getter(from_array, value):
     return next(x for x in from_array if value.lower() == x.lower())
 
 
-def get_row_indexes_to_delete_for_composite(table, identifiers, to_delete):
+def resolve_field(schema, identifier):
     """
-    Iterates over the values of a particular group of columns and returns a
-    numpy mask identifying the rows to delete. The column identifier is a
-    list of simple or complex identifiers, like ["user_first_name", "user.last_name"]
+    Resolves a simple or complex column identifier like "user.info.id"
+    against an Arrow schema, returning the (case insensitive) name of the
+    top level column, the indexes of the nested fields leading to the leaf
+    and the leaf type.
     """
-    indexes = []
-    data = {}
-    for identifier in identifiers:
-        column_first_level = identifier.split(".")[0].lower()
-        if not column_first_level in data:
-            column_identifier = case_insensitive_getter(
-                table.column_names, column_first_level
-            )
-            data[column_first_level] = table.column(column_identifier).to_pylist()
-    for i in range(table.num_rows):
-        values_array = []
-        for identifier in identifiers:
-            segments = identifier.split(".")
-            current = data[segments[0].lower()][i]
-            for j in range(1, len(segments)):
-                next_segment = case_insensitive_getter(
-                    list(current.keys()), segments[j]
+    segments = identifier.split(".")
+    name = case_insensitive_getter(schema.names, segments[0])
+    value_type = schema.field(name).type
+    path = []
+    for segment in segments[1:]:
+        if not pa.types.is_struct(value_type):
+            raise ValueError(
+                "Column {} is not a struct and cannot contain {}".format(
+                    identifier, segment
                 )
-                current = current[next_segment]
-            values_array.append(current)
-        indexes.append(values_array in to_delete)
-    return np.array(indexes)
+            )
+        child = case_insensitive_getter([f.name for f in value_type], segment)
+        index = value_type.get_field_index(child)
+        path.append(index)
+        value_type = value_type[index].type
+    return name, path, value_type
+
+
+def get_column(table, identifier):
+    """
+    Returns the values of a simple or complex column identifier as an Arrow
+    array. Nested fields are accessed from the struct arrays directly, without
+    converting any row to Python objects. Rows where any parent struct is null
+    have a null value.
+    """
+    name, path, value_type = resolve_field(table.schema, identifier)
+    column = table.column(name)
+    for index in path:
+        column = pa.chunked_array(
+            [chunk.flatten()[index] for chunk in column.chunks],
+            type=column.type[index].type,
+        )
+    return column
+
+
+def encode_composite_match_ids(value_types, match_ids):
+    """
+    Encodes composite MatchIds like [["john", "doe"], ["jane", "doe"]] as a
+    value set for each column and, for each column, the position of every
+    MatchId value inside the column value set. Positions are -1 where the
+    value can't be represented with the column type.
+    """
+    value_sets = []
+    positions = []
+    for i, value_type in enumerate(value_types):
+        values = [match_id[i] for match_id in match_ids]
+        value_set = build_value_set(list(dict.fromkeys(values)), value_type)
+        lookup = {}
+        for j, value in enumerate(value_set.to_pylist()):
+            lookup.setdefault(value, j)
+        value_sets.append(value_set)
+        positions.append(np.array([lookup.get(v, -1) for v in values], dtype=np.int64))
+    return value_sets, positions
+
+
+def densify_keys(keys, distinct_keys):
+    """
+    Maps each key to its position in the sorted array of distinct keys,
+    or -1 if the key isn't found
+    """
+    positions = np.searchsorted(distinct_keys, keys)
+    found = np.zeros(len(keys), dtype=bool)
+    in_bounds = (keys >= 0) & (positions < len(distinct_keys))
+    found[in_bounds] = distinct_keys[positions[in_bounds]] == keys[in_bounds]
+    return np.where(found, positions, -1)
+
+
+def get_row_indexes_to_delete_for_composite(
+    table, identifiers, to_delete, encoded=None
+):
+    """
+    Returns a boolean mask identifying the rows to delete. The column
+    identifier is a list of simple or complex identifiers, like
+    ["user_first_name", "user.last_name"].
+    Each column is encoded as the position of its values inside the column
+    value set, and the positions are combined one column at a time into a
+    composite key which is compared with the keys of the MatchIds. After each
+    column, keys are renumbered against the distinct MatchId keys so they
+    never grow beyond rows * number of MatchIds.
+    """
+    if encoded is None:
+        value_types = [
+            unwrap_dictionary(resolve_field(table.schema, identifier)[2])
+            for identifier in identifiers
+        ]
+        encoded = encode_composite_match_ids(value_types, to_delete)
+    value_sets, positions = encoded
+    row_keys = None
+    match_keys = None
+    for identifier, value_set, match_positions in zip(
+        identifiers, value_sets, positions
+    ):
+        column = get_column(table, identifier)
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        column_positions = pc.index_in(
+            column, options=get_set_lookup_options(value_set)
+        )
+        column_positions = pc.fill_null(column_positions, -1)
+        column_positions = np.asarray(column_positions.to_numpy(), dtype=np.int64)
+        if row_keys is None:
+            row_keys, match_keys = column_positions, match_positions
+        else:
+            size = len(value_set)
+            row_keys = np.where(
+                (row_keys >= 0) & (column_positions >= 0),
+                row_keys * size + column_positions,
+                -1,
+            )
+            match_keys = np.where(
+                (match_keys >= 0) & (match_positions >= 0),
+                match_keys * size + match_positions,
+                -1,
+            )
+        distinct_keys = np.unique(match_keys[match_keys >= 0])
+        row_keys = densify_keys(row_keys, distinct_keys)
+        match_keys = densify_keys(match_keys, distinct_keys)
+    return pa.array(row_keys >= 0, type=pa.bool_())
+
+
+def build_value_set(match_ids, value_type):
+    """
+    Builds an Arrow array containing the MatchIds typed as the column they
+    are going to be compared with, so that the lookup can be done natively
+    by Arrow. MatchIds which can't be represented with the column type (for
+    instance a string MatchId for an integer column) can never match any
+    value and are therefore dropped.
+    """
+    if isinstance(match_ids, pa.Array) and match_ids.type == value_type:
+        return match_ids
+    try:
+        return pa.array(match_ids, type=value_type)
+    except (pa.ArrowException, TypeError, ValueError, OverflowError):
+        compatible = []
+        for match_id in match_ids:
+            try:
+                pa.array([match_id], type=value_type)
+                compatible.append(match_id)
+            except (pa.ArrowException, TypeError, ValueError, OverflowError):
+                logger.debug("Skipping MatchId incompatible with %s", value_type)
+        return pa.array(compatible, type=value_type)
+
+
+def get_value_sets(schema, to_delete):
+    """
+    Prebuilds the value sets for the Simple and Composite columns, so that
+    they are built only once per file instead of once per row group
+    """
+    result = []
+    for column in to_delete:
+        if column["Type"] == "Simple":
+            _, _, value_type = resolve_field(schema, column["Column"])
+            column = {
+                **column,
+                "MatchIds": build_value_set(
+                    column["MatchIds"], unwrap_dictionary(value_type)
+                ),
+            }
+        else:
+            value_types = [
+                unwrap_dictionary(resolve_field(schema, identifier)[2])
+                for identifier in column["Columns"]
+            ]
+            column = {
+                **column,
+                "Encoded": encode_composite_match_ids(value_types, column["MatchIds"]),
+            }
+        result.append(column)
+    return result
+
+
+def unwrap_dictionary(value_type):
+    return value_type.value_type if pa.types.is_dictionary(value_type) else value_type
+
+
+def get_set_lookup_options(value_set):
+    """
+    Returns the options of the is_in and index_in kernels. The option to
+    match nulls is named skip_null and is mandatory in pyarrow 2.0, while
+    later versions renamed it skip_nulls and made it optional.
+    """
+    try:
+        return pc.SetLookupOptions(value_set=value_set, skip_null=False)
+    except TypeError:
+        return pc.SetLookupOptions(value_set=value_set)
+
+
+def is_in(column, match_ids):
+    """
+    Returns a boolean mask identifying the values of an Arrow array which are
+    found in the given MatchIds. Null values are never matched.
+    """
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    value_set = build_value_set(match_ids, column.type)
+    mask = pc.is_in(column, options=get_set_lookup_options(value_set))
+    return pc.fill_null(mask, False)
 
 
 def get_row_indexes_to_delete(table, identifier, to_delete):
     """
-    Iterates over the values of a particular column and returns a
-    numpy mask identifying the rows to delete. The column identifier
-    can be simple like "customer_id" or complex like "user.info.id"
+    Returns a boolean mask identifying the rows to delete. The column
+    identifier can be simple like "customer_id" or complex like
+    "user.info.id". Values are matched natively by Arrow without converting
+    them to Python objects.
     """
-    indexes = []
-    segments = identifier.split(".")
-    column_identifier = case_insensitive_getter(table.column_names, segments[0])
-    for obj in table.column(column_identifier).to_pylist():
-        current = obj
-        for i in range(1, len(segments)):
-            next_segment = case_insensitive_getter(list(current.keys()), segments[i])
-            current = current[next_segment]
-        indexes.append(current in to_delete)
-    return np.array(indexes)
+    return is_in(get_column(table, identifier), to_delete)
 
 
-def delete_from_table(table, to_delete):
+def get_identifiers(column):
+    return [column["Column"]] if column["Type"] == "Simple" else column["Columns"]
+
+
+def get_probe_columns(schema, to_delete):
     """
-    Deletes rows from a Arrow Table where any of the MatchIds is found as
-    value in any of the columns
+    Returns the column paths needed to search a row group for the MatchIds,
+    using the actual case of each column name. Nested identifiers are
+    returned as full paths (for instance "user.info.id") so that only the
+    leaf column is read, rather than the whole struct.
     """
-    initial_rows = table.num_rows
+    columns = []
+    for column in to_delete:
+        for identifier in get_identifiers(column):
+            name, path, _ = resolve_field(schema, identifier)
+            segments = [name]
+            value_type = schema.field(name).type
+            for index in path:
+                segments.append(value_type[index].name)
+                value_type = value_type[index].type
+            columns.append(".".join(segments))
+    return list(dict.fromkeys(columns))
+
+
+def get_deletion_mask(table, to_delete):
+    """
+    Returns a boolean mask identifying the rows of an Arrow Table where any
+    of the MatchIds is found as value in any of the columns
+    """
+    mask = None
     for column in to_delete:
         indexes = (
             get_row_indexes_to_delete(table, column["Column"], column["MatchIds"])
             if column["Type"] == "Simple"
             else get_row_indexes_to_delete_for_composite(
-                table, column["Columns"], column["MatchIds"]
+                table, column["Columns"], column["MatchIds"], column.get("Encoded")
             )
         )
-        table = table.filter(~indexes)
-    deleted_rows = initial_rows - table.num_rows
-    return table, deleted_rows
+        mask = indexes if mask is None else pc.or_(mask, indexes)
+    if mask is None:
+        return pa.array([False] * table.num_rows, type=pa.bool_())
+    return mask
+
+
+def count_matches(mask):
+    return pc.sum(mask).as_py() or 0
+
+
+def delete_from_table(table, to_delete):
+    """
+    Deletes rows from a Arrow Table where any of the MatchIds is found as
+    value in any of the columns
+    """
+    mask = get_deletion_mask(table, to_delete)
+    return table.filter(pc.invert(mask)), count_matches(mask)
+
+
+def get_sorted_values(value_set):
+    """
+    Returns the sorted values of a value set, or None if they can't be
+    compared with the column statistics (for instance because the value set
+    contains nulls, which aren't accounted for in min/max statistics)
+    """
+    if value_set.null_count > 0:
+        return None
+    try:
+        return sorted(value_set.to_pylist())
+    except TypeError:
+        return None
+
+
+def get_statistics_filters(parquet_schema, to_delete):
+    """
+    For each column to delete from, returns a list of (column chunk index,
+    sorted MatchId values, EncodedValues of the MatchIds) tuples that can be
+    compared with the statistics, the dictionary page and the bloom filter
+    of each row group. Composite columns have a tuple for each of their
+    columns. Identifiers which don't map to a leaf column of the Parquet
+    schema (and therefore don't have statistics) are omitted, and the
+    encoded values are None when the MatchIds can't be encoded.
+    """
+    chunk_indexes = {
+        parquet_schema.column(i).path.lower(): i for i in range(len(parquet_schema))
+    }
+    filters = []
+    for column in to_delete:
+        value_sets = (
+            [column["MatchIds"]] if column["Type"] == "Simple" else column["Encoded"][0]
+        )
+        column_filters = []
+        for identifier, value_set in zip(get_identifiers(column), value_sets):
+            index = chunk_indexes.get(identifier.lower())
+            values = get_sorted_values(value_set)
+            if index is not None and values is not None:
+                physical_type = parquet_schema.column(index).physical_type
+                encoded = encode_plain_values(values, physical_type)
+                if encoded is not None:
+                    encoded = EncodedValues(encoded)
+                column_filters.append((index, values, encoded))
+        filters.append(column_filters)
+    return filters
 
 
-def delete_matches_from_parquet_file(input_file, to_delete):
+def may_contain_values(statistics, sorted_values):
+    """
+    Checks whether the min/max statistics of a column chunk leave open the
+    possibility of any of the given values being in the column chunk
+    """
+    if statistics is None or not statistics.has_min_max:
+        return True
+    try:
+        i = bisect_left(sorted_values, statistics.min)
+        return i < len(sorted_values) and sorted_values[i] <= statistics.max
+    except TypeError:
+        return True
+
+
+def get_chunk_filter(source, file_metadata, row_group):
+    """
+    Returns a function checking whether the dictionary page or the bloom
+    filter of a column chunk of the row group may contain any of the given
+    EncodedValues, or None if the footer couldn't be read
+    """
+    if file_metadata is None:
+        return None
+    column_chunks = get_column_chunks(get_row_groups(file_metadata)[row_group])
+    return lambda index, encoded: encoded is None or may_contain_encoded_values(
+        source, column_chunks[index], encoded
+    )
+
+
+def may_contain_matches(row_group_metadata, statistics_filters, chunk_filter=None):
+    """
+    Checks whether a row group may contain any MatchId according to the
+    column statistics and, when chunk_filter is given, to the dictionary
+    pages and bloom filters. A row group is excluded only if, for every
+    column to delete from, at least one identifier excludes all the
+    MatchIds. Dictionary pages and bloom filters are only read for the
+    column chunks whose statistics don't already exclude the MatchIds.
+    """
+    for column_filters in statistics_filters:
+        if all(
+            may_contain_values(row_group_metadata.column(index).statistics, values)
+            and (chunk_filter is None or chunk_filter(index, encoded))
+            for index, values, encoded in column_filters
+        ):
+            return True
+    return False
+
+
+def get_native_file(input_file):
+    if isinstance(input_file, pa.NativeFile):
+        return input_file
+    return pa.PythonFile(input_file, mode="r")
+
+
+def copy_range(source, out_stream, offset, length):
+    end = offset + length
+    while offset < end:
+        size = min(COPY_BLOCK_SIZE, end - offset)
+        out_stream.write(source.read_at(size, offset))
+        offset += size
+
+
+def get_codec(compression):
+    codec = WRITER_CODECS.get(compression, compression)
+    return codec if codec in SUPPORTED_CODECS else DEFAULT_CODEC
+
+
+def get_writer_options(file_metadata, overrides=None):
+    """
+    Returns the options of the Arrow Parquet writer inferred from the metadata
+    of the source file, so that the rewritten row groups keep the format
+    version, and for each column the codec, the dictionary encoding and the
+    statistics of the source column chunks. Codecs which can't be written are
+    replaced with Snappy. Options set in the ParquetWriterOptions of the data
+    mapper take precedence over the inferred ones. The compression level is
+    only applied to the columns whose codec supports one.
+    """
+    options = {"version": file_metadata.format_version}
+    if file_metadata.num_row_groups > 0:
+        row_group = file_metadata.row_group(0)
+        columns = [row_group.column(i) for i in range(row_group.num_columns)]
+        # pyarrow 2.0 only accepts bytes as column paths of the codecs
+        options["compression"] = {
+            c.path_in_schema.encode(): get_codec(c.compression) for c in columns
+        }
+        options["use_dictionary"] = [
+            c.path_in_schema for c in columns if c.has_dictionary_page
+        ]
+        options["write_statistics"] = [
+            c.path_in_schema for c in columns if c.is_stats_set
+        ]
+    for key, value in (overrides or {}).items():
+        options[WRITER_OPTIONS[key]] = value
+    level = options.pop("compression_level", None)
+    if level is not None:
+        compression = options.get("compression", DEFAULT_CODEC)
+        if isinstance(compression, dict):
+            levels = {
+                path: level
+                for path, codec in compression.items()
+                if codec in LEVEL_CODECS
+            }
+            if levels:
+                options["compression_level"] = levels
+        elif compression.upper() in LEVEL_CODECS:
+            options["compression_level"] = level
+    return options
+
+
+def write_row_group(writer, table):
+    writer.write_table(table, row_group_size=max(table.num_rows, 1))
+
+
+def encode_table(table, schema, options):
+    with pa.BufferOutputStream() as buf:
+        with pq.ParquetWriter(buf, schema, **options) as writer:
+            if table is not None:
+                write_row_group(writer, table)
+        return pa.BufferReader(buf.getvalue())
+
+
+class ArrowRowGroupWriter:
+    """
+    Writes every row group with the Arrow Parquet writer, so row groups
+    copied from the source file are decoded and encoded again
+    """
+
+    def __init__(self, out_stream, parquet_file, schema, options):
+        self.parquet_file = parquet_file
+        self.writer = pq.ParquetWriter(out_stream, schema, **options)
+
+    def copy_row_group(self, index):
+        write_row_group(self.writer, self.parquet_file.read_row_group(index))
+
+    def encode(self, table):
+        return table
+
+    def write_encoded(self, table):
+        write_row_group(self.writer, table)
+
+    def write_table(self, table):
+        self.write_encoded(self.encode(table))
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SplicingRowGroupWriter:
+    """
+    Writes row groups copied byte-for-byte from the source file alongside row
+    groups encoded by the Arrow Parquet writer. Only the footer is generated,
+    from the footer of the source file with the row groups replaced, so that
+    the schema, the key-value metadata and the created_by of the source file
+    are kept. created_by in particular tells readers which known writer bugs
+    (like incorrect statistics) to work around for the copied column chunks.
+    """
+
+    def __init__(self, out_stream, source, file_metadata, schema, options):
+        self.out_stream = out_stream
+        self.source = source
+        self.file_metadata = file_metadata
+        self.schema = schema
+        self.options = options
+        self.row_groups = []
+        self.position = len(MAGIC)
+        out_stream.write(MAGIC)
+
+    def append_row_group(self, source, row_group):
+        column_chunks = []
+        for column_chunk in get_column_chunks(row_group):
+            offset, length = get_chunk_range(column_chunk)
+            column_chunks.append(relocate_column_chunk(column_chunk, self.position))
+            copy_range(source, self.out_stream, offset, length)
+            self.position += length
+        row_group = {k: v for k, v in row_group.items() if k != ROW_GROUP_ORDINAL}
+        row_group[ROW_GROUP_COLUMNS] = (LIST, (STRUCT, column_chunks))
+        if column_chunks:
+            offset, _ = get_chunk_range(column_chunks[0])
+            row_group[ROW_GROUP_FILE_OFFSET] = (I64, offset)
+        self.row_groups.append(row_group)
+
+    def copy_row_group(self, index):
+        self.append_row_group(self.source, get_row_groups(self.file_metadata)[index])
+
+    def encode(self, table):
+        return encode_table(table, self.schema, self.options)
+
+    def write_encoded(self, encoded):
+        for row_group in get_row_groups(read_footer(encoded)):
+            self.append_row_group(encoded, row_group)
+
+    def write_table(self, table):
+        self.write_encoded(self.encode(table))
+
+    def close(self):
+        self.out_stream.write(serialize_footer(self.file_metadata, self.row_groups))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_file_metadata(source):
+    """
+    Reads the footer of the source file, returning None when it can't be
+    parsed (for instance for files with an encrypted footer)
+    """
+    try:
+        return read_footer(source)
+    except ValueError as e:
+        logger.info("Unable to read the Parquet footer: %s", str(e))
+        return None
+
+
+def is_encoding_overridden(file_metadata, options):
+    """
+    Checks whether the writer options change the codec or the dictionary
+    encoding of any column compared to the source file, in which case the
+    copied row groups would not be encoded like the rewritten ones
+    """
+    inferred = get_writer_options(file_metadata)
+    codecs = inferred.get("compression", {})
+    compression = options.get("compression")
+    if isinstance(compression, str) and any(
+        codec != compression.upper() for codec in codecs.values()
+    ):
+        return True
+    use_dictionary = options.get("use_dictionary")
+    if isinstance(use_dictionary, bool):
+        expected = {c.decode() for c in codecs} if use_dictionary else set()
+        return set(inferred.get("use_dictionary", [])) != expected
+    return False
+
+
+def open_writer(out_stream, source, parquet_file, file_metadata, schema, options):
+    """
+    Returns a writer which copies untouched row groups byte-for-byte when
+    the column chunks of the source file can be combined with the ones
+    written by Arrow, falling back to rewriting every row group otherwise
+    (for instance for encrypted files or files with INT96 timestamps, or
+    when the ParquetWriterOptions change the codec or dictionary encoding).
+    """
+    if file_metadata is None:
+        return ArrowRowGroupWriter(out_stream, parquet_file, schema, options)
+    if is_encoding_overridden(parquet_file.metadata, options):
+        logger.info("Rewriting every row group to apply the writer options")
+        return ArrowRowGroupWriter(out_stream, parquet_file, schema, options)
+    if is_self_contained(file_metadata) and is_schema_compatible(
+        file_metadata, read_footer(encode_table(None, schema, options))
+    ):
+        return SplicingRowGroupWriter(
+            out_stream, source, file_metadata, schema, options
+        )
+    logger.info("Row groups can't be copied from the source file as they are")
+    return ArrowRowGroupWriter(out_stream, parquet_file, schema, options)
+
+
+class ThreadLocalReader(threading.local):
+    """
+    Gives each thread its own reader of the source Parquet file, so that row
+    groups can be decoded concurrently. The metadata of the source file is
+    reused rather than parsed again by each reader.
+    """
+
+    def __init__(self, source, parquet_file):
+        self.parquet_file = (
+            parquet_file
+            if threading.current_thread() is threading.main_thread()
+            else load_parquet(source, metadata=parquet_file.metadata)
+        )
+
+
+def search_row_group(
+    reader,
+    row_group,
+    to_delete,
+    statistics_filters,
+    probe_columns,
+    encode,
+    chunk_filter=None,
+):
+    """
+    Searches a row group for the MatchIds, returning the number of matches
+    and, when there are any, the row group without the matches encoded by
+    the given function. Row groups whose column statistics, dictionary pages
+    or bloom filters exclude every MatchId aren't searched.
+    """
+    parquet_file = reader.parquet_file
+    logger.info("Row group %s/%s", str(row_group + 1), str(parquet_file.num_row_groups))
+    if not may_contain_matches(
+        parquet_file.metadata.row_group(row_group), statistics_filters, chunk_filter
+    ):
+        logger.info("Row group excludes all MatchIds. Skipping search")
+        return 0, None
+    probe = parquet_file.read_row_group(row_group, columns=probe_columns)
+    mask = get_deletion_mask(probe, to_delete)
+    deleted_rows = count_matches(mask)
+    if deleted_rows == 0:
+        return 0, None
+    table = parquet_file.read_row_group(row_group)
+    return deleted_rows, encode(table.filter(pc.invert(mask)))
+
+
+def delete_matches_from_parquet_file(
+    input_file,
+    to_delete,
+    writer_options=None,
+    out_stream=None,
+    max_workers=1,
+    max_in_flight=None,
+):
     """
     Deletes matches from Parquet file where to_delete is a list of dicts where
     each dict contains a column to search and the MatchIds to search for in
-    that particular column
+    that particular column. Row groups whose column statistics, dictionary
+    pages or bloom filters exclude every MatchId are written back without
+    being searched. The other row groups are
+    first searched reading only the identifier columns, and they are fully
+    read and filtered only when at least a match is found. Row groups without
+    matches are copied to the new file without being decoded, the others are
+    written with the settings of the source file unless overridden by
+    writer_options (the ParquetWriterOptions of the data mapper). The new
+    file is written to out_stream as each row group is completed, or to an
+    in-memory buffer when out_stream isn't given.
+    With max_workers greater than 1, row groups are searched, filtered and
+    encoded concurrently, with at most max_in_flight row groups held in
+    memory, and written in their original order.
     """
-    parquet_file = load_parquet(input_file)
+    source = get_native_file(input_file)
+    parquet_file = load_parquet(source)
     schema = parquet_file.metadata.schema.to_arrow_schema().remove_metadata()
+    to_delete = get_value_sets(schema, to_delete)
+    statistics_filters = get_statistics_filters(parquet_file.metadata.schema, to_delete)
+    probe_columns = get_probe_columns(schema, to_delete)
     total_rows = parquet_file.metadata.num_rows
     stats = Counter({"ProcessedRows": total_rows, "DeletedRows": 0})
-    with pa.BufferOutputStream() as out_stream:
-        with pq.ParquetWriter(out_stream, schema) as writer:
-            for row_group in range(parquet_file.num_row_groups):
-                logger.info(
-                    "Row group %s/%s",
-                    str(row_group + 1),
-                    str(parquet_file.num_row_groups),
-                )
-                table = parquet_file.read_row_group(row_group)
-                table, deleted_rows = delete_from_table(table, to_delete)
-                writer.write_table(table)
-                stats.update({"DeletedRows": deleted_rows})
-        return out_stream, stats
+    options = get_writer_options(parquet_file.metadata, writer_options)
+    reader = ThreadLocalReader(source, parquet_file)
+    file_metadata = read_file_metadata(source)
+    if out_stream is None:
+        out_stream = pa.BufferOutputStream()
+    with open_writer(
+        out_stream, source, parquet_file, file_metadata, schema, options
+    ) as writer:
+        results = map_in_order(
+            lambda row_group: search_row_group(
+                reader,
+                row_group,
+                to_delete,
+                statistics_filters,
+                probe_columns,
+                writer.encode,
+                get_chunk_filter(source, file_metadata, row_group),
+            ),
+            range(parquet_file.num_row_groups),
+            max_workers,
+            max_in_flight,
+        )
+        for row_group, (deleted_rows, encoded) in enumerate(results):
+            if deleted_rows > 0:
+                writer.write_encoded(encoded)
+            else:
+                writer.copy_row_group(row_group)
+            stats.update({"DeletedRows": deleted_rows})
+    return out_stream, stats
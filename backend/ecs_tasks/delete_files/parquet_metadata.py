@@ -0,0 +1,365 @@
+"""
+Minimal reader and writer for the Parquet footer (FileMetaData), which is
+serialised with the Thrift compact protocol. Structs are decoded generically
+as dicts of field id -> (type, value), so fields which aren't used here (or
+which are added by newer versions of the format) are preserved as they are.
+"""
+import struct
+
+MAGIC = b"PAR1"
+MAGIC_ENCRYPTED = b"PARE"
+
+# Thrift compact protocol types
+STOP = 0
+TRUE = 1
+FALSE = 2
+BYTE = 3
+I16 = 4
+I32 = 5
+I64 = 6
+DOUBLE = 7
+BINARY = 8
+LIST = 9
+SET = 10
+MAP = 11
+STRUCT = 12
+
+# FileMetaData fields
+FILE_SCHEMA = 2
+FILE_NUM_ROWS = 3
+FILE_ROW_GROUPS = 4
+FILE_ENCRYPTION_ALGORITHM = 8
+
+# SchemaElement fields
+SCHEMA_TYPE = 1
+SCHEMA_TYPE_LENGTH = 2
+SCHEMA_REPETITION_TYPE = 3
+SCHEMA_NAME = 4
+SCHEMA_NUM_CHILDREN = 5
+SCHEMA_CONVERTED_TYPE = 6
+SCHEMA_SCALE = 7
+SCHEMA_PRECISION = 8
+SCHEMA_LOGICAL_TYPE = 10
+
+# RowGroup fields
+ROW_GROUP_COLUMNS = 1
+ROW_GROUP_NUM_ROWS = 3
+ROW_GROUP_FILE_OFFSET = 5
+ROW_GROUP_ORDINAL = 7
+
+# ColumnChunk fields
+CHUNK_FILE_PATH = 1
+CHUNK_FILE_OFFSET = 2
+CHUNK_META_DATA = 3
+CHUNK_PAGE_INDEX_FIELDS = [4, 5, 6, 7]
+CHUNK_CRYPTO_METADATA = 8
+
+# ColumnMetaData fields
+META_TOTAL_COMPRESSED_SIZE = 7
+META_DATA_PAGE_OFFSET = 9
+META_INDEX_PAGE_OFFSET = 10
+META_DICTIONARY_PAGE_OFFSET = 11
+META_BLOOM_FILTER_FIELDS = [14, 15]
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def zigzag_decode(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def zigzag_encode(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def read_value(buf, pos, ttype):
+    if ttype in (TRUE, FALSE):
+        # Booleans inside containers are encoded as a byte
+        return buf[pos] == TRUE, pos + 1
+    if ttype == BYTE:
+        return struct.unpack_from("<b", buf, pos)[0], pos + 1
+    if ttype in (I16, I32, I64):
+        value, pos = read_varint(buf, pos)
+        return zigzag_decode(value), pos
+    if ttype == DOUBLE:
+        return struct.unpack_from("<d", buf, pos)[0], pos + 8
+    if ttype == BINARY:
+        size, pos = read_varint(buf, pos)
+        return bytes(buf[pos : pos + size]), pos + size
+    if ttype in (LIST, SET):
+        header = buf[pos]
+        pos += 1
+        size = header >> 4
+        element_type = header & 0x0F
+        if size == 15:
+            size, pos = read_varint(buf, pos)
+        values = []
+        for _ in range(size):
+            value, pos = read_value(buf, pos, element_type)
+            values.append(value)
+        return (element_type, values), pos
+    if ttype == MAP:
+        size, pos = read_varint(buf, pos)
+        if size == 0:
+            return (None, None, []), pos
+        key_type = buf[pos] >> 4
+        value_type = buf[pos] & 0x0F
+        pos += 1
+        items = []
+        for _ in range(size):
+            key, pos = read_value(buf, pos, key_type)
+            value, pos = read_value(buf, pos, value_type)
+            items.append((key, value))
+        return (key_type, value_type, items), pos
+    if ttype == STRUCT:
+        return read_struct(buf, pos)
+    raise ValueError("Unsupported Thrift type {}".format(ttype))
+
+
+def read_struct(buf, pos=0):
+    """
+    Reads a struct, returning a dict of field id -> (type, value) and the
+    position of the first byte after the struct
+    """
+    result = {}
+    last_field_id = 0
+    while True:
+        header = buf[pos]
+        pos += 1
+        ttype = header & 0x0F
+        if ttype == STOP:
+            return result, pos
+        delta = header >> 4
+        if delta:
+            field_id = last_field_id + delta
+        else:
+            field_id, pos = read_varint(buf, pos)
+            field_id = zigzag_decode(field_id)
+        last_field_id = field_id
+        if ttype in (TRUE, FALSE):
+            result[field_id] = (TRUE, ttype == TRUE)
+        else:
+            value, pos = read_value(buf, pos, ttype)
+            result[field_id] = (ttype, value)
+
+
+def write_value(out, ttype, value):
+    if ttype in (TRUE, FALSE):
+        out.append(TRUE if value else FALSE)
+    elif ttype == BYTE:
+        out.extend(struct.pack("<b", value))
+    elif ttype in (I16, I32, I64):
+        write_varint(out, zigzag_encode(value))
+    elif ttype == DOUBLE:
+        out.extend(struct.pack("<d", value))
+    elif ttype == BINARY:
+        write_varint(out, len(value))
+        out.extend(value)
+    elif ttype in (LIST, SET):
+        element_type, values = value
+        if len(values) < 15:
+            out.append((len(values) << 4) | element_type)
+        else:
+            out.append(0xF0 | element_type)
+            write_varint(out, len(values))
+        for element in values:
+            write_value(out, element_type, element)
+    elif ttype == MAP:
+        key_type, value_type, items = value
+        write_varint(out, len(items))
+        if items:
+            out.append((key_type << 4) | value_type)
+            for key, item in items:
+                write_value(out, key_type, key)
+                write_value(out, value_type, item)
+    elif ttype == STRUCT:
+        write_struct(out, value)
+    else:
+        raise ValueError("Unsupported Thrift type {}".format(ttype))
+
+
+def write_struct(out, fields):
+    last_field_id = 0
+    for field_id in sorted(fields):
+        ttype, value = fields[field_id]
+        header_type = (TRUE if value else FALSE) if ttype == TRUE else ttype
+        delta = field_id - last_field_id
+        if 0 < delta <= 15:
+            out.append((delta << 4) | header_type)
+        else:
+            out.append(header_type)
+            write_varint(out, zigzag_encode(field_id))
+        if ttype != TRUE:
+            write_value(out, ttype, value)
+        last_field_id = field_id
+    out.append(STOP)
+
+
+def serialize_struct(fields):
+    out = bytearray()
+    write_struct(out, fields)
+    return bytes(out)
+
+
+def get_field(fields, field_id, default=None):
+    return fields[field_id][1] if field_id in fields else default
+
+
+def read_footer(source):
+    """
+    Reads the FileMetaData of a Parquet file from a pyarrow NativeFile
+    """
+    size = source.size()
+    tail = source.read_at(8, size - 8)
+    if tail[4:] == MAGIC_ENCRYPTED:
+        raise ValueError("Parquet files with encrypted footers are not supported")
+    if tail[4:] != MAGIC:
+        raise ValueError("Not a Parquet file")
+    footer_length = struct.unpack("<I", tail[:4])[0]
+    footer = source.read_at(footer_length, size - 8 - footer_length)
+    file_metadata, _ = read_struct(footer)
+    return file_metadata
+
+
+def get_row_groups(file_metadata):
+    return get_field(file_metadata, FILE_ROW_GROUPS, (STRUCT, []))[1]
+
+
+def get_column_chunks(row_group):
+    return get_field(row_group, ROW_GROUP_COLUMNS)[1]
+
+
+def get_chunk_range(column_chunk):
+    """
+    Returns the offset and the length of the pages of a column chunk. The
+    dictionary page, when present, is the first page of the chunk.
+    """
+    meta_data = get_field(column_chunk, CHUNK_META_DATA)
+    start = get_field(meta_data, META_DATA_PAGE_OFFSET)
+    dictionary_offset = get_field(meta_data, META_DICTIONARY_PAGE_OFFSET)
+    if dictionary_offset and dictionary_offset < start:
+        start = dictionary_offset
+    return start, get_field(meta_data, META_TOTAL_COMPRESSED_SIZE)
+
+
+def relocate_column_chunk(column_chunk, offset):
+    """
+    Returns a copy of the column chunk metadata with the page offsets moved
+    to the given position. Page indexes and bloom filters are stored outside
+    of the column chunk pages, so references to them are dropped.
+    """
+    start, _ = get_chunk_range(column_chunk)
+    delta = offset - start
+    meta_data = {
+        k: v
+        for k, v in get_field(column_chunk, CHUNK_META_DATA).items()
+        if k not in META_BLOOM_FILTER_FIELDS
+    }
+    for field_id in [
+        META_DATA_PAGE_OFFSET,
+        META_INDEX_PAGE_OFFSET,
+        META_DICTIONARY_PAGE_OFFSET,
+    ]:
+        value = get_field(meta_data, field_id)
+        if value:
+            meta_data[field_id] = (I64, value + delta)
+    chunk = {k: v for k, v in column_chunk.items() if k not in CHUNK_PAGE_INDEX_FIELDS}
+    chunk[CHUNK_FILE_OFFSET] = (I64, offset)
+    chunk[CHUNK_META_DATA] = (STRUCT, meta_data)
+    return chunk
+
+
+def is_self_contained(file_metadata):
+    """
+    Checks that the pages of every column chunk are stored in the file
+    itself, unencrypted, and that the column chunks of each row group don't
+    overlap, so that they can be safely copied to another file.
+    """
+    if FILE_ENCRYPTION_ALGORITHM in file_metadata:
+        return False
+    for row_group in get_row_groups(file_metadata):
+        end = 0
+        for column_chunk in get_column_chunks(row_group):
+            if CHUNK_FILE_PATH in column_chunk or CHUNK_CRYPTO_METADATA in column_chunk:
+                return False
+            start, length = get_chunk_range(column_chunk)
+            if start is None or length is None or start < end:
+                return False
+            end = start + length
+    return True
+
+
+def get_schema_signature(file_metadata):
+    """
+    Returns the properties of each element of the schema which define how
+    values are stored in the column chunks, excluding the root element
+    """
+    elements = get_field(file_metadata, FILE_SCHEMA)[1][1:]
+    return [
+        tuple(
+            get_field(element, field_id)
+            for field_id in [
+                SCHEMA_TYPE,
+                SCHEMA_TYPE_LENGTH,
+                SCHEMA_REPETITION_TYPE,
+                SCHEMA_NAME,
+                SCHEMA_NUM_CHILDREN,
+                SCHEMA_CONVERTED_TYPE,
+                SCHEMA_SCALE,
+                SCHEMA_PRECISION,
+            ]
+        )
+        + (get_field(element, SCHEMA_LOGICAL_TYPE),)
+        for element in elements
+    ]
+
+
+def is_schema_compatible(file_metadata, other_file_metadata):
+    """
+    Checks whether column chunks from two files can be combined in a single
+    file. Logical types are only compared when both files have them, as
+    older writers only set converted types.
+    """
+    signature = get_schema_signature(file_metadata)
+    other_signature = get_schema_signature(other_file_metadata)
+    if len(signature) != len(other_signature):
+        return False
+    for element, other_element in zip(signature, other_signature):
+        if element[:-1] != other_element[:-1]:
+            return False
+        if element[-1] and other_element[-1] and element[-1] != other_element[-1]:
+            return False
+    return True
+
+
+def serialize_footer(file_metadata, row_groups):
+    """
+    Serialises the FileMetaData of a file made of the given row groups,
+    followed by the footer length and the magic number
+    """
+    num_rows = sum(get_field(row_group, ROW_GROUP_NUM_ROWS) for row_group in row_groups)
+    footer = serialize_struct(
+        {
+            **file_metadata,
+            FILE_NUM_ROWS: (I64, num_rows),
+            FILE_ROW_GROUPS: (LIST, (STRUCT, row_groups)),
+        }
+    )
+    return footer + struct.pack("<I", len(footer)) + MAGIC
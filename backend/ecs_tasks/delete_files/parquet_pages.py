@@ -0,0 +1,338 @@
+"""
+Checks whether the dictionary page or the bloom filter of a Parquet column
+chunk may contain any of a set of values, without decoding the data pages.
+Values are compared in their PLAIN encoding (without the length prefix for
+byte arrays), which is the form hashed by bloom filters.
+"""
+import logging
+import struct
+
+import numpy as np
+import pyarrow as pa
+
+from parquet_metadata import (
+    CHUNK_CRYPTO_METADATA,
+    CHUNK_FILE_PATH,
+    CHUNK_META_DATA,
+    get_chunk_range,
+    get_field,
+    read_struct,
+)
+
+logger = logging.getLogger(__name__)
+
+# ColumnMetaData fields
+META_TYPE = 1
+META_CODEC = 4
+META_ENCODING_STATS = 13
+META_BLOOM_FILTER_OFFSET = 14
+META_BLOOM_FILTER_LENGTH = 15
+
+# PageHeader fields
+PAGE_TYPE = 1
+PAGE_UNCOMPRESSED_SIZE = 2
+PAGE_COMPRESSED_SIZE = 3
+PAGE_DICTIONARY_HEADER = 7
+DICTIONARY_NUM_VALUES = 1
+DICTIONARY_ENCODING = 2
+
+# PageEncodingStats fields
+STATS_PAGE_TYPE = 1
+STATS_ENCODING = 2
+
+# BloomFilterHeader fields
+BLOOM_NUM_BYTES = 1
+BLOOM_ALGORITHM = 2
+BLOOM_HASH = 3
+BLOOM_COMPRESSION = 4
+BLOOM_BLOCK = 1
+BLOOM_XXHASH = 1
+BLOOM_UNCOMPRESSED = 1
+
+# Enums
+TYPE_INT32 = 1
+TYPE_INT64 = 2
+TYPE_BYTE_ARRAY = 6
+PAGE_DATA = 0
+PAGE_DICTIONARY = 2
+PAGE_DATA_V2 = 3
+ENCODING_PLAIN = 0
+ENCODING_PLAIN_DICTIONARY = 2
+ENCODING_RLE_DICTIONARY = 8
+CODECS = {1: "snappy", 2: "gzip", 4: "brotli", 6: "zstd", 7: "lz4_raw"}
+
+FIXED_WIDTHS = {TYPE_INT32: 4, TYPE_INT64: 8}
+MAX_HEADER_SIZE = 1024
+
+BLOOM_SALT = [
+    0x47B6137B,
+    0x44974D91,
+    0x8824AD5B,
+    0xA2B7289D,
+    0x705495C7,
+    0x2DF1424B,
+    0x9EFC4947,
+    0x5C6BFB31,
+]
+BLOOM_BLOCK_SIZE = 32
+
+# XXH64 primes
+P1 = 0x9E3779B185EBCA87
+P2 = 0xC2B2AE3D27D4EB4F
+P3 = 0x165667B19E3779F9
+P4 = 0x85EBCA77C2B2AE63
+P5 = 0x27D4EB2F165667C5
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+def encode_plain_values(values, physical_type):
+    """
+    Returns the PLAIN encoding of the given MatchIds for a column with the
+    given physical type (as named by pyarrow), or None if the values can't be
+    encoded, for instance because they are dates rather than integers.
+    """
+    if physical_type == "BYTE_ARRAY":
+        if all(isinstance(v, bytes) for v in values):
+            return values
+        if all(isinstance(v, str) for v in values):
+            return [v.encode("utf-8") for v in values]
+        return None
+    if physical_type in ("INT32", "INT64"):
+        if not all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            return None
+        width = 4 if physical_type == "INT32" else 8
+        return [(v % (1 << (8 * width))).to_bytes(width, "little") for v in values]
+    return None
+
+
+class EncodedValues:
+    """
+    PLAIN encoded MatchIds of a column, with the forms in which they are
+    looked up in dictionary pages and bloom filters, built once per file
+    rather than for every row group
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.value_set = frozenset(values)
+        self.joined = b"".join(values)
+        self.hashes = [xxh64(v) for v in values]
+
+
+def rotl64(value, bits):
+    return ((value << bits) | (value >> (64 - bits))) & MASK_64
+
+
+def xxh64_round(acc, lane):
+    acc = (acc + lane * P2) & MASK_64
+    return (rotl64(acc, 31) * P1) & MASK_64
+
+
+def xxh64_merge(acc, value):
+    acc ^= xxh64_round(0, value)
+    return (acc * P1 + P4) & MASK_64
+
+
+def xxh64(data, seed=0):
+    """
+    XXH64 hash of a bytes-like object, as used by Parquet bloom filters
+    """
+    length = len(data)
+    pos = 0
+    if length >= 32:
+        v1 = (seed + P1 + P2) & MASK_64
+        v2 = (seed + P2) & MASK_64
+        v3 = seed
+        v4 = (seed - P1) & MASK_64
+        while pos + 32 <= length:
+            a, b, c, d = struct.unpack_from("<4Q", data, pos)
+            v1 = xxh64_round(v1, a)
+            v2 = xxh64_round(v2, b)
+            v3 = xxh64_round(v3, c)
+            v4 = xxh64_round(v4, d)
+            pos += 32
+        h = (rotl64(v1, 1) + rotl64(v2, 7) + rotl64(v3, 12) + rotl64(v4, 18)) & MASK_64
+        for v in (v1, v2, v3, v4):
+            h = xxh64_merge(h, v)
+    else:
+        h = (seed + P5) & MASK_64
+    h = (h + length) & MASK_64
+    while pos + 8 <= length:
+        h ^= xxh64_round(0, struct.unpack_from("<Q", data, pos)[0])
+        h = (rotl64(h, 27) * P1 + P4) & MASK_64
+        pos += 8
+    if pos + 4 <= length:
+        h ^= (struct.unpack_from("<I", data, pos)[0] * P1) & MASK_64
+        h = (rotl64(h, 23) * P2 + P3) & MASK_64
+        pos += 4
+    while pos < length:
+        h ^= (data[pos] * P5) & MASK_64
+        h = (rotl64(h, 11) * P1) & MASK_64
+        pos += 1
+    h ^= h >> 33
+    h = (h * P2) & MASK_64
+    h ^= h >> 29
+    h = (h * P3) & MASK_64
+    h ^= h >> 32
+    return h
+
+
+def get_bloom_filter_bits(bitset, value_hash):
+    """
+    Returns the position of the block of a split block bloom filter, and the
+    bit set in each of its 8 words, for the given hash
+    """
+    num_blocks = len(bitset) // BLOOM_BLOCK_SIZE
+    block = ((value_hash >> 32) * num_blocks) >> 32
+    key = value_hash & 0xFFFFFFFF
+    return (
+        block * BLOOM_BLOCK_SIZE,
+        [((key * salt) & 0xFFFFFFFF) >> 27 for salt in BLOOM_SALT],
+    )
+
+
+def bloom_filter_contains(bitset, value):
+    return bloom_filter_contains_hash(bitset, xxh64(value))
+
+
+def bloom_filter_contains_hash(bitset, value_hash):
+    offset, bits = get_bloom_filter_bits(bitset, value_hash)
+    words = struct.unpack_from("<8I", bitset, offset)
+    return all(word & (1 << bit) for word, bit in zip(words, bits))
+
+
+def read_page_header(source, offset, limit):
+    """
+    Reads the Thrift page header starting at the given offset, returning the
+    header and the offset of the page data
+    """
+    size = min(MAX_HEADER_SIZE, limit)
+    buf = source.read_at(size, offset)
+    header, length = read_struct(buf)
+    return header, offset + length
+
+
+def is_fully_dictionary_encoded(meta_data):
+    """
+    Checks, from the encoding stats, whether every data page of a column
+    chunk is dictionary encoded, so that the dictionary page contains every
+    value of the column chunk. Writers which don't produce encoding stats may
+    have fallen back to PLAIN encoding.
+    """
+    encoding_stats = get_field(meta_data, META_ENCODING_STATS)
+    if not encoding_stats:
+        return False
+    return all(
+        get_field(stats, STATS_ENCODING)
+        in (ENCODING_PLAIN_DICTIONARY, ENCODING_RLE_DICTIONARY)
+        for stats in encoding_stats[1]
+        if get_field(stats, STATS_PAGE_TYPE) in (PAGE_DATA, PAGE_DATA_V2)
+    )
+
+
+def read_dictionary(source, column_chunk):
+    """
+    Returns the decompressed content of the dictionary page of a column
+    chunk and the number of values it contains, or None if the column chunk
+    isn't entirely dictionary encoded
+    """
+    meta_data = get_field(column_chunk, CHUNK_META_DATA)
+    if not is_fully_dictionary_encoded(meta_data):
+        return None
+    codec = get_field(meta_data, META_CODEC)
+    if codec and codec not in CODECS:
+        return None
+    start, length = get_chunk_range(column_chunk)
+    header, data_offset = read_page_header(source, start, length)
+    dictionary_header = get_field(header, PAGE_DICTIONARY_HEADER)
+    if get_field(header, PAGE_TYPE) != PAGE_DICTIONARY or not dictionary_header:
+        return None
+    if get_field(dictionary_header, DICTIONARY_ENCODING) not in (
+        ENCODING_PLAIN,
+        ENCODING_PLAIN_DICTIONARY,
+    ):
+        return None
+    data = source.read_at(get_field(header, PAGE_COMPRESSED_SIZE), data_offset)
+    if codec:
+        data = pa.decompress(
+            data,
+            decompressed_size=get_field(header, PAGE_UNCOMPRESSED_SIZE),
+            codec=CODECS[codec],
+            asbytes=True,
+        )
+    return data, get_field(dictionary_header, DICTIONARY_NUM_VALUES)
+
+
+def dictionary_may_contain(dictionary, num_values, physical_type, values):
+    """
+    Checks whether a PLAIN encoded dictionary contains any of the encoded
+    values. Byte arrays are looked up in the set of values while the
+    dictionary is parsed, stopping at the first match.
+    """
+    if physical_type == TYPE_BYTE_ARRAY:
+        pos = 0
+        for _ in range(num_values):
+            (length,) = struct.unpack_from("<I", dictionary, pos)
+            pos += 4
+            if dictionary[pos : pos + length] in values.value_set:
+                return True
+            pos += length
+        return False
+    dtype = "<i{}".format(FIXED_WIDTHS[physical_type])
+    entries = np.frombuffer(dictionary, dtype=dtype, count=num_values)
+    return bool(np.isin(np.frombuffer(values.joined, dtype=dtype), entries).any())
+
+
+def read_bloom_filter(source, column_chunk):
+    """
+    Returns the bitset of the split block bloom filter of a column chunk, or
+    None if the column chunk doesn't have a supported bloom filter
+    """
+    meta_data = get_field(column_chunk, CHUNK_META_DATA)
+    offset = get_field(meta_data, META_BLOOM_FILTER_OFFSET)
+    if offset is None:
+        return None
+    limit = get_field(meta_data, META_BLOOM_FILTER_LENGTH, source.size() - offset)
+    header, bitset_offset = read_page_header(source, offset, limit)
+    supported = all(
+        expected in (get_field(header, field_id) or {})
+        for field_id, expected in [
+            (BLOOM_ALGORITHM, BLOOM_BLOCK),
+            (BLOOM_HASH, BLOOM_XXHASH),
+            (BLOOM_COMPRESSION, BLOOM_UNCOMPRESSED),
+        ]
+    )
+    num_bytes = get_field(header, BLOOM_NUM_BYTES)
+    if not supported or not num_bytes or num_bytes % BLOOM_BLOCK_SIZE:
+        return None
+    return source.read_at(num_bytes, bitset_offset)
+
+
+def may_contain_encoded_values(source, column_chunk, values):
+    """
+    Checks whether the dictionary page or the bloom filter of a column chunk
+    leave open the possibility of any of the EncodedValues being in the
+    column chunk. Column chunks which can't be checked, for instance
+    because they are encrypted, may contain any value.
+    """
+    if CHUNK_FILE_PATH in column_chunk or CHUNK_CRYPTO_METADATA in column_chunk:
+        return True
+    physical_type = get_field(get_field(column_chunk, CHUNK_META_DATA), META_TYPE)
+    if physical_type not in (TYPE_INT32, TYPE_INT64, TYPE_BYTE_ARRAY):
+        return True
+    try:
+        dictionary = read_dictionary(source, column_chunk)
+        if dictionary is not None:
+            if not dictionary_may_contain(*dictionary, physical_type, values):
+                logger.info("Dictionary page excludes all MatchIds")
+                return False
+            return True
+        bitset = read_bloom_filter(source, column_chunk)
+        if bitset is not None and not any(
+            bloom_filter_contains_hash(bitset, h) for h in values.hashes
+        ):
+            logger.info("Bloom filter excludes all MatchIds")
+            return False
+    except (pa.ArrowException, IndexError, ValueError, struct.error) as e:
+        logger.info("Unable to check the column chunk pages: %s", str(e))
+    return True
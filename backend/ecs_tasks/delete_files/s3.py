@@ -1,4 +1,7 @@
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 from urllib.parse import urlencode, quote_plus
 
@@ -10,11 +13,17 @@ from utils import remove_none, retry_wrapper
 logger = logging.getLogger(__name__)
 
 
-def save(s3, client, buf, bucket, key, metadata, source_version=None):
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+
+
+def get_save_args(client, bucket, key, metadata, source_version=None):
     """
-    Save a buffer to S3, preserving any existing properties on the object
+    Generates the args used to upload a new version of an object preserving
+    any existing properties on the object
+    :returns tuple containing the upload args, the request payer args, the
+        ACL args and the raw ACL response
     """
-    # Get Object Settings
     request_payer_args, _ = get_requester_payment(client, bucket)
     object_info_args, _ = get_object_info(client, bucket, key, source_version)
     tagging_args, _ = get_object_tags(client, bucket, key, source_version)
@@ -27,14 +36,12 @@ def save(s3, client, buf, bucket, key, metadata, source_version=None):
         **{"Metadata": metadata},
     }
     logger.info("Object settings: %s", extra_args)
-    # Write Object Back to S3
-    logger.info("Saving updated object to s3://%s/%s", bucket, key)
-    contents = buf.read()
-    with s3.open("s3://{}/{}".format(bucket, key), "wb", **extra_args) as f:
-        f.write(contents)
-    s3.invalidate_cache()  # TODO: remove once https://github.com/dask/s3fs/issues/294 is resolved
-    new_version_id = f.version_id
-    logger.info("Object uploaded to S3")
+    return extra_args, request_payer_args, acl_args, acl_resp
+
+
+def restore_write_grantees(
+    client, bucket, key, version_id, request_payer_args, acl_args, acl_resp
+):
     # GrantWrite cannot be set whilst uploading therefore ACLs need to be restored separately
     write_grantees = ",".join(get_grantees(acl_resp, "WRITE"))
     if write_grantees:
@@ -42,11 +49,286 @@ def save(s3, client, buf, bucket, key, metadata, source_version=None):
         client.put_object_acl(
             Bucket=bucket,
             Key=key,
-            VersionId=new_version_id,
+            VersionId=version_id,
             **{**request_payer_args, **acl_args, "GrantWrite": write_grantees,}
         )
+
+
+def save_stream(client, bucket, key, metadata, write, source_version=None):
+    """
+    Streams an object to S3, preserving any existing properties on the object.
+    write is called with a writable stream and the content written to it is
+    uploaded part by part while it is being generated. The upload is aborted
+    if write raises.
+    :returns tuple containing the new version ID and the result of write
+    """
+    extra_args, request_payer_args, acl_args, acl_resp = get_save_args(
+        client, bucket, key, metadata, source_version
+    )
+    logger.info("Streaming updated object to s3://%s/%s", bucket, key)
+    stream = MultipartUploadStream(client, bucket, key, extra_args, UPLOAD_PART_SIZE)
+    try:
+        result = write(stream)
+        new_version_id = stream.complete()
+    except Exception:
+        stream.abort()
+        raise
+    logger.info("Object uploaded to S3")
+    restore_write_grantees(
+        client, bucket, key, new_version_id, request_payer_args, acl_args, acl_resp
+    )
     logger.info("Processing of file s3://%s/%s complete", bucket, key)
-    return new_version_id
+    return new_version_id, result
+
+
+class MultipartUploadStream:
+    """
+    Writable stream uploading the content written to it as the parts of a
+    multipart upload, so that at most a part is held in memory. The multipart
+    upload is only created once the first part is full: smaller objects are
+    uploaded with a single PutObject call on completion. Closing the stream
+    only stops accepting writes, the upload is finalised by complete or abort.
+    """
+
+    def __init__(self, client, bucket, key, extra_args, part_size=UPLOAD_PART_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.extra_args = extra_args
+        self.request_payer_args = {
+            k: v for k, v in extra_args.items() if k == "RequestPayer"
+        }
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed stream")
+        size = memoryview(data).nbytes
+        self.buffer += data
+        self.position += size
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return size
+
+    def upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra_args
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        logger.debug("Uploading part %s", part_number)
+        resp = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+            **self.request_payer_args
+        )
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": part_number})
+
+    def set_metadata(self, metadata):
+        """
+        Replaces the user metadata of the object. The metadata of a multipart
+        upload is set when it's created, so it can only be replaced while the
+        content written so far fits in a single part.
+        :returns whether the metadata will be stored with the object
+        """
+        if self.upload_id is not None:
+            return False
+        self.extra_args = {**self.extra_args, "Metadata": metadata}
+        return True
+
+    def complete(self):
+        """
+        Uploads the remaining content and completes the upload
+        :returns the version ID of the uploaded object
+        """
+        self.closed = True
+        if self.upload_id is None:
+            resp = self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.buffer),
+                **self.extra_args
+            )
+        else:
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+            resp = self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+                **self.request_payer_args
+            )
+        self.buffer = bytearray()
+        return resp.get("VersionId")
+
+    def abort(self):
+        self.closed = True
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            logger.info(
+                "Aborting multipart upload of s3://%s/%s", self.bucket, self.key
+            )
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                **self.request_payer_args
+            )
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def open_object_version(
+    client, bucket, key, version_id, part_size=DOWNLOAD_PART_SIZE, max_workers=4
+):
+    """
+    Opens an object version for reading with concurrent byte-range GETs
+    """
+    request_payer_args, _ = get_requester_payment(client, bucket)
+    _, object_info = get_object_info(client, bucket, key, version_id)
+    return RangedDownloadStream(
+        client,
+        bucket,
+        key,
+        version_id,
+        object_info["ContentLength"],
+        request_payer_args,
+        part_size,
+        max_workers,
+    )
+
+
+class RangedDownloadStream:
+    """
+    Seekable stream reading an object version with concurrent byte-range
+    GETs, so that reads aren't bound to the throughput of a single GET. The
+    object is split in parts of part_size bytes: reading a part downloads
+    the max_workers parts which follow it ahead of time, and the parts are
+    served in order. At most max_workers + 1 parts are held in memory, and
+    seeking outside of them discards the parts downloaded ahead.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket,
+        key,
+        version_id,
+        size,
+        extra_args=None,
+        part_size=DOWNLOAD_PART_SIZE,
+        max_workers=4,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.version_id = version_id
+        self.extra_args = extra_args or {}
+        self.object_size = size
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.num_parts = -(-size // part_size)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.parts = {}
+        self.position = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def download_part(self, index):
+        start = index * self.part_size
+        end = min(start + self.part_size, self.object_size) - 1
+        logger.debug("Downloading bytes %s-%s", start, end)
+        resp = self.client.get_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            VersionId=self.version_id,
+            Range="bytes={}-{}".format(start, end),
+            **self.extra_args
+        )
+        return resp["Body"].read()
+
+    def get_part(self, index):
+        last = min(index + self.max_workers, self.num_parts - 1)
+        for i in list(self.parts):
+            if i < index or i > last:
+                self.parts.pop(i).cancel()
+        for i in range(index, last + 1):
+            if i not in self.parts:
+                self.parts[i] = self.executor.submit(self.download_part, i)
+        return self.parts[index].result()
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed stream")
+        with self.lock:
+            remaining = self.object_size - self.position
+            size = remaining if size is None or size < 0 else min(size, remaining)
+            chunks = []
+            while size > 0:
+                index, offset = divmod(self.position, self.part_size)
+                part = memoryview(self.get_part(index))[offset : offset + size]
+                chunks.append(part)
+                self.position += len(part)
+                size -= len(part)
+            return b"".join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.object_size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def size(self):
+        return self.object_size
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def close(self):
+        self.closed = True
+        for part in self.parts.values():
+            part.cancel()
+        self.parts = {}
+        self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 @lru_cache()
@@ -1,4 +1,7 @@
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from botocore.exceptions import ClientError
 
 
@@ -28,3 +31,38 @@ def retry_wrapper(fn, retry_wait_seconds=2, retry_factor=2, max_retries=5):
         raise last_error
 
     return wrapper
+
+
+def map_in_order(
+    fn,
+    items,
+    max_workers=1,
+    max_in_flight=None,
+    executor_class=ThreadPoolExecutor,
+    **executor_kwargs
+):
+    """
+    Applies fn to every item, yielding the results in the order of the items.
+    With more than one worker, items are processed on a bounded thread pool
+    and at most max_in_flight items (twice the workers by default) are being
+    processed or waiting to be consumed at any time, to bound memory usage.
+    CPU bound work can be given to a ProcessPoolExecutor instead, created
+    with executor_kwargs (such as an initializer).
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    max_in_flight = max(max_in_flight or 2 * max_workers, 1)
+    with executor_class(max_workers=max_workers, **executor_kwargs) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                if len(pending) >= max_in_flight:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(fn, item))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
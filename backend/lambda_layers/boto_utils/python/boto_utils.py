@@ -3,6 +3,7 @@ import decimal
 import logging
 import json
 import os
+import re
 import uuid
 from functools import lru_cache, reduce
 
@@ -11,10 +12,18 @@ from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.types import TypeDeserializer
 from botocore.exceptions import ClientError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 deserializer = TypeDeserializer()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 batch_size = 10  # SQS Max Batch Size
+# Integer literals which may not fit in 64 bits
+LONG_INTEGER = re.compile(r"(?<![.0-9])[0-9]{19,}(?![.eE0-9])")
+LONG_INTEGER_BYTES = re.compile(LONG_INTEGER.pattern.encode())
 
 s3 = boto3.resource("s3")
 ssm = boto3.client("ssm")
@@ -244,13 +253,33 @@ def fetch_job_manifest(path):
     return s3.Object(bucket, obj).get().get("Body").read().decode("utf-8")
 
 
+def json_loads(content):
+    """
+    Parses a JSON document (str or bytes) with orjson when it's installed,
+    falling back to the standard library json module otherwise. Documents
+    rejected by orjson but accepted by json (such as NaN or lone surrogates)
+    are parsed again with json, which also gives the same error messages
+    whatever the backend. orjson parses integers outside of the 64 bit range
+    as floats, losing precision, so documents with integer literals of 19
+    digits or more are parsed with json.
+    """
+    if orjson is not None:
+        pattern = LONG_INTEGER_BYTES if isinstance(content, bytes) else LONG_INTEGER
+        if not pattern.search(content):
+            try:
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(content)
+
+
 def json_lines_iterator(content, include_unparsed=False):
     lines = content.split("\n")
     if lines[-1] == "":
         lines.pop()
     for i, line in enumerate(lines):
         try:
-            parsed = json.loads(line)
+            parsed = json_loads(line)
         except (json.JSONDecodeError) as e:
             raise ValueError(
                 "Serialization error when parsing JSON lines: {}".format(
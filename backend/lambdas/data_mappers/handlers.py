@@ -84,6 +84,8 @@ def put_data_mapper_handler(event, context):
         "Format": body.get("Format", "parquet"),
         "DeleteOldVersions": body.get("DeleteOldVersions", True),
     }
+    if body.get("ParquetWriterOptions"):
+        item["ParquetWriterOptions"] = body["ParquetWriterOptions"]
     table.put_item(Item=item)
 
     return {"statusCode": 201, "body": json.dumps(item)}
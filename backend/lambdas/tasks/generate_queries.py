@@ -156,6 +156,11 @@ def generate_athena_queries(data_mapper, deletion_items, job_id):
     }
     if data_mapper.get("RoleArn", None):
         msg["RoleArn"] = data_mapper["RoleArn"]
+    if data_mapper.get("ParquetWriterOptions", None):
+        # Integer options are deserialized from DynamoDB as Decimals
+        msg["ParquetWriterOptions"] = json.loads(
+            json.dumps(data_mapper["ParquetWriterOptions"], cls=DecimalEncoder)
+        )
 
     # Workout which deletion items should be included in this query
     applicable_match_ids = [
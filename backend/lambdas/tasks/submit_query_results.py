@@ -41,6 +41,7 @@ def handler(event, context):
             "DeleteOldVersions": event.get("DeleteOldVersions", True),
             "Format": event.get("Format"),
             "Manifest": event.get("Manifest"),
+            "ParquetWriterOptions": event.get("ParquetWriterOptions"),
         }
         messages.append({k: v for k, v in msg.items() if v is not None})
 
@@ -89,6 +89,37 @@ def test_it_creates_data_mapper(validate_mapper, table):
     } == json.loads(response["body"])
 
 
+@patch("backend.lambdas.data_mappers.handlers.table")
+@patch("backend.lambdas.data_mappers.handlers.validate_mapper")
+def test_it_creates_data_mapper_with_parquet_writer_options(validate_mapper, table):
+    response = handlers.put_data_mapper_handler(
+        {
+            "pathParameters": {"data_mapper_id": "test"},
+            "body": json.dumps(
+                {
+                    "Columns": ["column"],
+                    "QueryExecutor": "athena",
+                    "QueryExecutorParameters": {
+                        "DataCatalogProvider": "glue",
+                        "Database": "test",
+                        "Table": "test",
+                    },
+                    "RoleArn": "arn:aws:iam::accountid:role/S3F2DataAccessRole",
+                    "ParquetWriterOptions": {"Compression": "ZSTD"},
+                }
+            ),
+            "requestContext": autorization_mock,
+        },
+        SimpleNamespace(),
+    )
+
+    assert 201 == response["statusCode"]
+    assert {"Compression": "ZSTD"} == json.loads(response["body"])[
+        "ParquetWriterOptions"
+    ]
+    table.put_item.assert_called_with(Item=json.loads(response["body"]))
+
+
 @patch("backend.lambdas.data_mappers.handlers.table")
 @patch("backend.lambdas.data_mappers.handlers.validate_mapper")
 def test_it_gets_data_mapper(validate_mapper, table):
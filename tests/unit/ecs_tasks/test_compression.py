@@ -0,0 +1,99 @@
+import bz2
+import gzip
+from io import BufferedReader, BytesIO
+
+import pyarrow as pa
+import pytest
+import snappy
+
+from backend.ecs_tasks.delete_files.compression import (
+    get_compression_from_key,
+    get_compression_from_magic_bytes,
+    iter_gzip_members,
+    open_input,
+    open_output,
+)
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+class UnseekableBytesIO(BytesIO):
+    def seekable(self):
+        return False
+
+
+def compress(data, compression):
+    out = pa.BufferOutputStream()
+    writer = open_output(out, compression, 6)
+    writer.write(memoryview(data))
+    writer.close()
+    return out.getvalue().to_pybytes()
+
+
+@pytest.mark.parametrize(
+    "key,compression",
+    [
+        ("s3://bucket/a.json.gz", "gzip"),
+        ("s3://bucket/a.JSON.GZ", "gzip"),
+        ("s3://bucket/a.json.zst", "zstd"),
+        ("s3://bucket/a.json.bz2", "bz2"),
+        ("s3://bucket/a.json.sz", "snappy"),
+        ("s3://bucket/a.json", None),
+    ],
+)
+def test_it_gets_the_compression_from_the_key(key, compression):
+    assert compression == get_compression_from_key(key)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd", "bz2", "snappy", None])
+def test_it_gets_the_compression_from_magic_bytes(compression):
+    data = compress(b'{"a": 1}\n', compression)
+    input_file = BytesIO(data)
+    assert compression == get_compression_from_magic_bytes(input_file)
+    assert data == input_file.read()
+
+
+def test_it_peeks_at_magic_bytes_of_buffered_streams():
+    data = compress(b'{"a": 1}\n', "zstd")
+    input_file = BufferedReader(UnseekableBytesIO(data))
+    assert "zstd" == get_compression_from_magic_bytes(input_file)
+    assert data == input_file.read()
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd", "bz2", "snappy", None])
+def test_it_streams_each_codec(compression):
+    data = b"".join(b'{"customer_id": "%d"}\n' % i for i in range(50000))
+    compressed = compress(data, compression)
+    reader = open_input(BytesIO(compressed), compression)
+    chunks = iter(lambda: reader.read(4096), b"")
+    assert data == b"".join(chunks)
+
+
+def test_it_writes_standard_streams():
+    data = b'{"a": 1}\n'
+    assert data == gzip.decompress(compress(data, "gzip"))
+    assert data == bz2.decompress(compress(data, "bz2"))
+    assert data == snappy.StreamDecompressor().decompress(compress(data, "snappy"))
+
+
+def test_it_reads_gzip_members_with_their_compressed_bytes():
+    members = [gzip.compress(b"a\n" * 1000), gzip.compress(b""), gzip.compress(b"b\n")]
+    input_file = BytesIO(b"".join(members) + b"\x00" * 4)
+    pieces = list(iter_gzip_members(input_file, 100))
+    compressed = []
+    data = []
+    for piece, decompressed, member_end in pieces:
+        compressed[-1:] = [compressed[-1] + piece] if compressed else [piece]
+        data[-1:] = [data[-1] + decompressed] if data else [decompressed]
+        assert len(decompressed) <= 100
+        if member_end:
+            compressed.append(b"")
+            data.append(b"")
+    assert members + [b""] == compressed
+    assert [b"a\n" * 1000, b"", b"b\n", b""] == data
+
+
+def test_it_raises_for_truncated_gzip_members():
+    data = gzip.compress(b"a\n" * 1000)
+    with pytest.raises(EOFError):
+        list(iter_gzip_members(BytesIO(data + data[:-4]), 100))
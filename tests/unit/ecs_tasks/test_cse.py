@@ -10,9 +10,19 @@ import os
 from cryptography.hazmat.primitives.ciphers import Cipher
 from cryptography.hazmat.primitives.ciphers.algorithms import AES
 from cryptography.hazmat.primitives.padding import PKCS7
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.modes import ECB, GCM
 
-from backend.ecs_tasks.delete_files.cse import is_kms_cse_encrypted, encrypt, decrypt
+from backend.ecs_tasks.delete_files.cse import (
+    DataKeyCache,
+    DataKeyPool,
+    decrypt,
+    encrypt,
+    get_decryption_aes_key,
+    get_encryption_aes_key,
+    is_kms_cse_encrypted,
+)
+from backend.ecs_tasks.delete_files.s3 import MultipartUploadStream
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
@@ -47,6 +57,16 @@ class KmsMock:
         return {"Plaintext": self.plaintext}
 
 
+def encrypt_content(content, metadata, kms_client):
+    new_metadata, encrypt_stream = encrypt(metadata, kms_client)
+    encrypted = BytesIO()
+    writer = encrypt_stream(encrypted)
+    writer.write(content)
+    writer.close()
+    encrypted.seek(0)
+    return encrypted, writer.get_metadata()
+
+
 def test_it_recognises_supported_kms_cse_object():
     valid_cbc = {
         "x-amz-key-v2": "key",
@@ -108,7 +128,7 @@ def test_it_encrypts_and_decrypts_data_cbc():
         "x-amz-unencrypted-content-length": "890",
     }
     content = b'{"customer_id":12345}\n'
-    encrypted, new_metadata = encrypt(BytesIO(content), metadata, kms_client)
+    encrypted, new_metadata = encrypt_content(content, metadata, kms_client)
     decrypted = decrypt(encrypted, new_metadata, kms_client)
     assert new_metadata == {
         "x-amz-key-v2": ANY,
@@ -147,7 +167,7 @@ def test_it_encrypts_and_decrypts_data_gcm():
         "x-amz-tag-len": "111",
     }
     content = b'{"customer_id":12345}\n'
-    encrypted, new_metadata = encrypt(BytesIO(content), metadata, kms_client)
+    encrypted, new_metadata = encrypt_content(content, metadata, kms_client)
     decrypted = decrypt(encrypted, new_metadata, kms_client)
     assert new_metadata == {
         "x-amz-key-v2": ANY,
@@ -169,3 +189,188 @@ def test_it_encrypts_and_decrypts_data_gcm():
         CiphertextBlob=base64.b64decode(new_metadata["x-amz-key-v2"]),
         EncryptionContext={"kms_cmk_id": key_id},
     )
+
+
+@pytest.mark.parametrize("alg", ["AES/CBC/PKCS5Padding", "AES/GCM/NoPadding"])
+def test_it_decrypts_data_while_it_is_read(alg):
+    key_id = "1234abcd-12ab-34cd-56ef-1234567890ab"
+    kms_client = MagicMock()
+    kms_mock = KmsMock(key_id)
+    kms_client.generate_data_key.return_value = kms_mock.generate_data_key()
+    kms_client.decrypt.return_value = kms_mock.decrypt()
+    metadata = {
+        "x-amz-matdesc": json.dumps({"kms_cmk_id": key_id}),
+        "x-amz-cek-alg": alg,
+    }
+    content = b"".join(b'{"customer_id":%d}\n' % i for i in range(100000))
+    encrypted, new_metadata = encrypt_content(content, metadata, kms_client)
+    file_input = MagicMock(wraps=encrypted)
+    with patch("backend.ecs_tasks.delete_files.cse.READ_CHUNK_SIZE", 1000):
+        decrypted = decrypt(file_input, new_metadata, kms_client)
+        chunks = list(iter(lambda: decrypted.read(777), b""))
+    assert content == b"".join(chunks)
+    assert all(c[0] == (1000,) for c in file_input.read.call_args_list)
+
+
+def test_it_verifies_the_gcm_tag_at_the_end_of_the_data():
+    key_id = "1234abcd-12ab-34cd-56ef-1234567890ab"
+    kms_client = MagicMock()
+    kms_mock = KmsMock(key_id)
+    kms_client.generate_data_key.return_value = kms_mock.generate_data_key()
+    kms_client.decrypt.return_value = kms_mock.decrypt()
+    metadata = {
+        "x-amz-matdesc": json.dumps({"kms_cmk_id": key_id}),
+        "x-amz-cek-alg": "AES/GCM/NoPadding",
+    }
+    encrypted, new_metadata = encrypt_content(b"a" * 100, metadata, kms_client)
+    tampered = bytearray(encrypted.read())
+    tampered[-1] ^= 1
+    decrypted = decrypt(BytesIO(tampered), new_metadata, kms_client)
+    with pytest.raises(InvalidTag):
+        decrypted.read()
+
+
+@pytest.mark.parametrize("alg", ["AES/CBC/PKCS5Padding", "AES/GCM/NoPadding"])
+def test_it_encrypts_data_while_it_is_uploaded(alg):
+    key_id = "1234abcd-12ab-34cd-56ef-1234567890ab"
+    kms_client = MagicMock()
+    kms_mock = KmsMock(key_id)
+    kms_client.generate_data_key.return_value = kms_mock.generate_data_key()
+    kms_client.decrypt.return_value = kms_mock.decrypt()
+    metadata = {
+        "x-amz-matdesc": json.dumps({"kms_cmk_id": key_id}),
+        "x-amz-cek-alg": alg,
+        "x-amz-unencrypted-content-length": "890",
+    }
+    s3_client = MagicMock()
+    s3_client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    s3_client.upload_part.return_value = {"ETag": "etag"}
+    new_metadata, encrypt_stream = encrypt(metadata, kms_client)
+    assert "x-amz-unencrypted-content-length" not in new_metadata
+    stream = MultipartUploadStream(
+        s3_client, "bucket", "key", {"Metadata": new_metadata}, 1000
+    )
+    writer = encrypt_stream(stream)
+    content = b"".join(b'{"customer_id":%d}\n' % i for i in range(1000))
+    for i in range(0, len(content), 100):
+        writer.write(memoryview(content)[i : i + 100])
+        assert len(stream.buffer) < 1000
+    writer.close()
+    final_metadata = writer.get_metadata()
+    assert str(len(content)) == final_metadata["x-amz-unencrypted-content-length"]
+    assert "x-amz-unencrypted-content-length" not in new_metadata
+    assert not stream.set_metadata(final_metadata)
+    stream.complete()
+    encrypted = b"".join(c[1]["Body"] for c in s3_client.upload_part.call_args_list)
+    assert content == decrypt(BytesIO(encrypted), final_metadata, kms_client).read()
+
+
+def test_it_stores_the_unencrypted_length_of_single_part_uploads():
+    key_id = "1234abcd-12ab-34cd-56ef-1234567890ab"
+    kms_client = MagicMock()
+    kms_client.generate_data_key.return_value = KmsMock(key_id).generate_data_key()
+    metadata = {
+        "x-amz-matdesc": json.dumps({"kms_cmk_id": key_id}),
+        "x-amz-cek-alg": "AES/GCM/NoPadding",
+    }
+    s3_client = MagicMock()
+    s3_client.put_object.return_value = {"VersionId": "v1"}
+    new_metadata, encrypt_stream = encrypt(metadata, kms_client)
+    stream = MultipartUploadStream(
+        s3_client, "bucket", "key", {"Metadata": new_metadata}, 1000
+    )
+    writer = encrypt_stream(stream)
+    with pytest.raises(ValueError):
+        writer.get_metadata()
+    writer.write(b"abc")
+    writer.close()
+    assert stream.set_metadata(writer.get_metadata())
+    assert "v1" == stream.complete()
+    stored = s3_client.put_object.call_args[1]["Metadata"]
+    assert "3" == stored["x-amz-unencrypted-content-length"]
+    assert "x-amz-unencrypted-content-length" not in new_metadata
+
+
+@patch("backend.ecs_tasks.delete_files.cse.time")
+def test_it_caches_unwrapped_data_keys(mock_time):
+    mock_time.monotonic.return_value = 1000
+    kms_client = MagicMock()
+    kms_client.decrypt.side_effect = lambda **kwargs: {
+        "Plaintext": kwargs["CiphertextBlob"].upper()
+    }
+    cache = DataKeyCache(10, 60)
+    context = {"kms_cmk_id": "key"}
+    assert b"A" == get_decryption_aes_key(b"a", context, kms_client, cache)
+    assert b"A" == get_decryption_aes_key(b"a", context, kms_client, cache)
+    assert b"B" == get_decryption_aes_key(b"b", context, kms_client, cache)
+    assert b"A" == get_decryption_aes_key(b"a", {"other": "1"}, kms_client, cache)
+    assert b"A" == get_decryption_aes_key(b"a", context, kms_client, cache.scope("r"))
+    assert 4 == kms_client.decrypt.call_count
+    assert {"Hits": 1, "Misses": 4} == cache.counts
+    mock_time.monotonic.return_value = 1060
+    get_decryption_aes_key(b"a", context, kms_client, cache)
+    assert 5 == kms_client.decrypt.call_count
+
+
+@patch("backend.ecs_tasks.delete_files.cse.time")
+def test_it_evicts_the_data_keys_closest_to_expiry(mock_time):
+    cache = DataKeyCache(2, 60)
+    for i, key in enumerate([b"a", b"b", b"c"]):
+        mock_time.monotonic.return_value = 1000 + i
+        cache.get(key, {}, lambda: key.upper())
+    assert [b"B", b"C"] == sorted(plaintext for plaintext, _ in cache.entries.values())
+    mock_time.monotonic.return_value = 1100
+    cache.get(b"d", {}, lambda: b"D")
+    assert [b"D"] == [plaintext for plaintext, _ in cache.entries.values()]
+
+
+def test_it_hands_out_pre_generated_data_keys():
+    kms_client = MagicMock()
+    kms_client.generate_data_key.side_effect = [
+        {"Plaintext": str(i).encode(), "CiphertextBlob": b"wrapped"} for i in range(6)
+    ]
+    pool = DataKeyPool(2)
+    keys = [get_encryption_aes_key("cmk", kms_client, pool)[0]]
+    pool.join()
+    assert 3 == kms_client.generate_data_key.call_count
+    keys.append(get_encryption_aes_key("cmk", kms_client, pool)[0])
+    pool.join()
+    keys.append(get_encryption_aes_key("cmk", kms_client, pool)[0])
+    pool.join()
+    assert [b"0", b"1", b"2"] == keys
+    assert 5 == kms_client.generate_data_key.call_count
+    kms_client.generate_data_key.assert_called_with(
+        KeyId="cmk", EncryptionContext={"kms_cmk_id": "cmk"}, KeySpec="AES_256"
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.cse.threading.Thread")
+def test_it_refills_data_keys_in_daemon_threads(mock_thread):
+    pool = DataKeyPool(2)
+    assert b"a" == pool.get("cmk", lambda: b"a")
+    mock_thread.assert_called_with(
+        target=pool.refill, args=((None, "cmk"), ANY), daemon=True
+    )
+    mock_thread.return_value.start.assert_called()
+    mock_thread.return_value.join.assert_not_called()
+
+
+def test_it_reuses_pooled_data_keys_up_to_the_limit():
+    generate = MagicMock(side_effect=[b"a", b"b", b"c"])
+    pool = DataKeyPool(1, max_reuse=2)
+    keys = []
+    for _ in range(4):
+        keys.append(pool.get("cmk", generate))
+        pool.join()
+    assert [b"a", b"a", b"b", b"b"] == keys
+    assert 3 == generate.call_count
+    assert b"scoped" == pool.scope("role").get("cmk", lambda: b"scoped")
+    pool.join()
+
+
+def test_it_generates_data_keys_on_demand_when_the_pool_fails():
+    generate = MagicMock(side_effect=[b"a", ClientError({}, "GenerateDataKey"), b"b"])
+    pool = DataKeyPool(2)
+    assert b"a" == pool.get("cmk", generate)
+    pool.join()
+    assert b"b" == pool.get("cmk", generate)
@@ -1,4 +1,5 @@
-from mock import patch
+from io import BytesIO
+from mock import patch, MagicMock
 
 import gzip
 import pyarrow as pa
@@ -6,7 +7,20 @@ import pyarrow.parquet as pq
 import pytest
 import pandas as pd
 import tempfile
-from backend.ecs_tasks.delete_files.json_handler import delete_matches_from_json_file
+from backend.ecs_tasks.delete_files.json_handler import (
+    build_prefilter,
+    compile_key_path,
+    delete_matches_from_json_file,
+    get_trie_pattern,
+    iter_chunks,
+    parse_line,
+)
+from backend.ecs_tasks.delete_files.compression import (
+    get_compression_from_magic_bytes,
+    open_input,
+    open_output,
+)
+from backend.ecs_tasks.delete_files.s3 import MultipartUploadStream
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
@@ -40,7 +54,7 @@ def test_it_handles_json_with_gzip_compression():
     )
     out_stream = to_compressed_json_file(data)
     # Act
-    out, stats = delete_matches_from_json_file(out_stream, to_delete, True)
+    out, stats = delete_matches_from_json_file(out_stream, to_delete, "gzip")
     assert isinstance(out, pa.BufferOutputStream)
     assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
     assert to_decompressed_json_string(out) == (
@@ -49,6 +63,141 @@ def test_it_handles_json_with_gzip_compression():
     )
 
 
+def test_it_writes_compressed_json_to_output_streams():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = (
+        '{"customer_id": "12345", "x": 7, "d":"2001-01-01"}\n'
+        '{"customer_id": "23456", "x": 8, "d":"2001-01-03"}\n'
+        '{"customer_id": "34567", "x": 9, "d":"2001-01-05"}\n'
+    )
+    mock_client = MagicMock()
+    mock_client.put_object.return_value = {"VersionId": "v1"}
+    stream = MultipartUploadStream(mock_client, "bucket", "key", {})
+    # Act
+    out, stats = delete_matches_from_json_file(
+        to_compressed_json_file(data), to_delete, "gzip", stream
+    )
+    stream.complete()
+    # Assert
+    assert out is stream
+    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert gzip.decompress(mock_client.put_object.call_args[1]["Body"]) == (
+        b'{"customer_id": "12345", "x": 7, "d":"2001-01-01"}\n'
+        b'{"customer_id": "34567", "x": 9, "d":"2001-01-05"}\n'
+    )
+
+
+@pytest.mark.parametrize("level,xfl", [(1, 4), (6, 0), (9, 2)])
+def test_it_recompresses_with_the_given_level(level, xfl):
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = '{"customer_id": "12345"}\n{"customer_id": "23456"}\n'
+    # Act
+    out, _ = delete_matches_from_json_file(
+        to_compressed_json_file(data), to_delete, "gzip", compression_level=level
+    )
+    # Assert
+    assert xfl == out.getvalue().to_pybytes()[8]
+    assert to_decompressed_json_string(out) == '{"customer_id": "12345"}\n'
+
+
+@pytest.mark.parametrize("compression", ["zstd", "bz2", "snappy", "gzip"])
+def test_it_preserves_the_codec_detected_from_magic_bytes(compression):
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = b'{"customer_id": "12345"}\n{"customer_id": "23456"}\n'
+    compressed = pa.BufferOutputStream()
+    writer = open_output(compressed, compression, 6)
+    writer.write(data)
+    writer.close()
+    input_file = BytesIO(compressed.getvalue().to_pybytes())
+    # Act
+    out, stats = delete_matches_from_json_file(input_file, to_delete)
+    # Assert
+    assert {"ProcessedRows": 2, "DeletedRows": 1} == stats
+    res = BytesIO(out.getvalue().to_pybytes())
+    assert compression == get_compression_from_magic_bytes(res)
+    assert b'{"customer_id": "12345"}\n' == open_input(res, compression).read(1024)
+
+
+def test_it_copies_gzip_members_without_deleted_lines():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    members = [
+        gzip.compress(b'{"customer_id": "12345"}\n{"customer_id": "12346"}\n', 1),
+        gzip.compress(b'{"customer_id": "23456"}\n{"customer_id": "23457"}\n', 1),
+        gzip.compress(b'{"customer_id": "34567"}\n', 1),
+    ]
+    # Act
+    out, stats = delete_matches_from_json_file(
+        BytesIO(b"".join(members)), to_delete, "gzip", compression_level=9
+    )
+    # Assert
+    assert {"ProcessedRows": 5, "DeletedRows": 1} == stats
+    res = out.getvalue().to_pybytes()
+    assert res.startswith(members[0])
+    assert res.endswith(members[2])
+    assert gzip.decompress(res[len(members[0]) : -len(members[2])]) == (
+        b'{"customer_id": "23457"}\n'
+    )
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+@patch("backend.ecs_tasks.delete_files.json_handler.READ_CHUNK_SIZE", 16)
+def test_it_recompresses_gzip_members_split_within_lines(max_workers):
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    members = [
+        gzip.compress(b'{"customer_id": "12345"}\n{"customer_'),
+        gzip.compress(b'id": "34567"}\n'),
+        gzip.compress(b'{"customer_id": "23456"}\n'),
+        gzip.compress(b'{"customer_id": "45678"}\n' * 10),
+    ]
+    # Act
+    out, stats = delete_matches_from_json_file(
+        BytesIO(b"".join(members) + b"\x00" * 8), to_delete, "gzip", None, max_workers
+    )
+    # Assert
+    assert {"ProcessedRows": 13, "DeletedRows": 1} == stats
+    res = out.getvalue().to_pybytes()
+    assert res.endswith(members[3])
+    assert gzip.decompress(res) == (
+        b'{"customer_id": "12345"}\n{"customer_id": "34567"}\n'
+        + b'{"customer_id": "45678"}\n' * 10
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.MAX_PASSTHROUGH_MEMBER_SIZE", 100)
+@patch("backend.ecs_tasks.delete_files.json_handler.READ_CHUNK_SIZE", 50)
+def test_it_recompresses_gzip_members_too_large_to_hold():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = b'{"customer_id": "12345"}\n' * 20
+    # Act
+    out, stats = delete_matches_from_json_file(
+        BytesIO(gzip.compress(data, 1)), to_delete, "gzip", compression_level=9
+    )
+    # Assert
+    assert {"ProcessedRows": 20, "DeletedRows": 0} == stats
+    res = out.getvalue().to_pybytes()
+    assert 2 == res[8]
+    assert data == gzip.decompress(res)
+
+
+def test_it_writes_an_empty_gzip_member_when_every_line_is_deleted():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = '{"customer_id": "23456"}\n'
+    # Act
+    out, stats = delete_matches_from_json_file(
+        to_compressed_json_file(data), to_delete, "gzip"
+    )
+    # Assert
+    assert {"ProcessedRows": 1, "DeletedRows": 1} == stats
+    assert "" == to_decompressed_json_string(out)
+
+
 def test_delete_correct_rows_when_missing_newline_at_the_end():
     # Arrange
     to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
@@ -309,6 +458,190 @@ def test_it_throws_meaningful_error_for_serialization_issues():
     )
 
 
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1024])
+def test_it_reads_chunks_of_complete_lines(chunk_size):
+    data = b'{"a": 1}\n{"b": "\xe2\x80\xa8"}\n\n{"c": 3}'
+    chunks = list(iter_chunks(BytesIO(data), chunk_size))
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+    assert data + b"\n" == b"".join(chunks)
+    assert [b"a\n"] == list(iter_chunks(BytesIO(b"a\n"), chunk_size))
+
+
+def test_it_writes_runs_of_kept_lines_at_once():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = "".join('{{"customer_id": "{}"}}\n'.format(i) for i in range(23450, 23460))
+    out_stream = MagicMock()
+    # Act
+    out, stats = delete_matches_from_json_file(
+        to_json_file(data), to_delete, out_stream=out_stream
+    )
+    # Assert
+    assert {"ProcessedRows": 10, "DeletedRows": 1} == stats
+    assert [6 * 25, 3 * 25] == [
+        memoryview(c[0][0]).nbytes for c in out_stream.write.call_args_list
+    ]
+
+
+def test_it_streams_the_input_in_chunks():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = "".join('{{"customer_id": "{}"}}\n'.format(i) for i in range(20000, 30000))
+    input_file = MagicMock(wraps=BytesIO(gzip.compress(data.encode())))
+    # Act
+    out, stats = delete_matches_from_json_file(input_file, to_delete, "gzip")
+    # Assert
+    assert {"ProcessedRows": 10000, "DeletedRows": 1} == stats
+    assert all(c[0] and c[0][0] > 0 for c in input_file.read.call_args_list)
+    assert len(to_decompressed_json_string(out)) == len(data) - 25
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.parse_line")
+def test_it_only_parses_lines_which_may_contain_match_ids(mock_parse):
+    # Arrange
+    mock_parse.side_effect = parse_line
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = (
+        '{"customer_id": "12345", "x": 1.2}\n'
+        '{"customer_id": "23456", "x": 2.3}\n'
+        "not json\n"
+        '{"customer_id": "34567", "x": "23456"}\n'
+    )
+    # Act
+    out, stats = delete_matches_from_json_file(to_json_file(data), to_delete)
+    # Assert
+    assert {"ProcessedRows": 4, "DeletedRows": 1} == stats
+    assert 2 == mock_parse.call_count
+    assert to_json_string(out) == (
+        '{"customer_id": "12345", "x": 1.2}\n'
+        "not json\n"
+        '{"customer_id": "34567", "x": "23456"}\n'
+    )
+
+
+def test_it_deletes_values_not_written_verbatim():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": ["23456", 1234], "Type": "Simple"},
+        {"Columns": ["a", "b"], "MatchIds": [["x/y", 1]], "Type": "Composite"},
+    ]
+    data = (
+        '{"customer_id": "\\u0032\\u0033456"}\n'
+        '{"customer_id": 1.234e3}\n'
+        '{"customer_id": 1233.9999999999999999}\n'
+        '{"a": "x\\/y", "b": true}\n'
+        '{"customer_id": "12345"}\n'
+    )
+    # Act
+    out, stats = delete_matches_from_json_file(to_json_file(data), to_delete)
+    # Assert
+    assert {"ProcessedRows": 5, "DeletedRows": 4} == stats
+    assert to_json_string(out) == '{"customer_id": "12345"}\n'
+
+
+@pytest.mark.parametrize("prefilter", [True, False])
+def test_it_deletes_long_numbers_rounding_to_match_ids(prefilter):
+    # Arrange
+    to_delete = [
+        {"Column": "id", "MatchIds": [12345, 9007199254740991], "Type": "Simple"}
+    ]
+    data = (
+        '{"id": 12344.9999999999999}\n'
+        '{"id": 9007199254740990.9}\n'
+        '{"id": 12344.99}\n'
+    )
+    # Act
+    with patch(
+        "backend.ecs_tasks.delete_files.json_handler.build_prefilter",
+        side_effect=None if prefilter else lambda to_delete: None,
+        wraps=build_prefilter,
+    ):
+        out, stats = delete_matches_from_json_file(to_json_file(data), to_delete)
+    # Assert
+    assert {"ProcessedRows": 3, "DeletedRows": 2} == stats
+    assert to_json_string(out) == '{"id": 12344.99}\n'
+
+
+def test_it_builds_prefilters_only_for_supported_match_ids():
+    def prefilter(*match_ids):
+        return build_prefilter(
+            [{"Column": "a", "MatchIds": list(match_ids), "Type": "Simple"}]
+        )
+
+    assert b"(?:ab(?:c|d)|x)" == get_trie_pattern([b"abc", b"abd", b"x", b"xyz"])
+    assert prefilter("abc").search(b'{"a": "abc"}')
+    assert not prefilter("abc").search(b'{"a": "ab"}')
+    assert not prefilter("", 0, None).search(b'{"a": ""}')
+    assert prefilter('"/') is None
+    assert prefilter(1.5) is None
+    assert prefilter({"a": 1}) is None
+    assert (
+        build_prefilter([{"Columns": ["a"], "MatchIds": [[]], "Type": "Composite"}])
+        is None
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.find_key")
+def test_it_resolves_key_paths_with_the_spelling_seen_in_the_data(mock_find_key):
+    mock_find_key.side_effect = lambda key, obj: next(
+        (k for k in obj if k.lower() == key.lower()), None
+    )
+    get_value = compile_key_path("user.customerid")
+    assert 1 == get_value({"User": {"customerId": 1}})
+    assert 2 == get_value({"User": {"customerId": 2}})
+    assert 2 == mock_find_key.call_count
+    assert 3 == get_value({"user": {"CustomerID": 3}})
+    assert 4 == mock_find_key.call_count
+    assert get_value({"user": "customerid"}) is None
+    assert get_value({"user": {"id": 5}}) is None
+    assert get_value({}) is None
+
+
+def test_it_matches_integers_and_strings_as_athena_casts_them():
+    # Arrange
+    to_delete = [
+        {"Column": "customer_id", "MatchIds": ["12345", 23456], "Type": "Simple"},
+        {"Columns": ["a", "b"], "MatchIds": [["1", 2]], "Type": "Composite"},
+    ]
+    data = (
+        '{"customer_id": 12345}\n'
+        '{"customer_id": "23456"}\n'
+        '{"customer_id": "012345"}\n'
+        '{"customer_id": {"id": 12345}}\n'
+        '{"a": 1, "b": "2"}\n'
+    )
+    # Act
+    out, stats = delete_matches_from_json_file(to_json_file(data), to_delete)
+    # Assert
+    assert {"ProcessedRows": 5, "DeletedRows": 3} == stats
+    assert to_json_string(out) == (
+        '{"customer_id": "012345"}\n' '{"customer_id": {"id": 12345}}\n'
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.READ_CHUNK_SIZE", 100)
+def test_it_searches_chunks_on_a_process_pool():
+    # Arrange
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = "".join('{{"customer_id": "{}"}}\n'.format(i) for i in range(23000, 24000))
+    # Act
+    out, stats = delete_matches_from_json_file(
+        to_json_file(data), to_delete, max_workers=2
+    )
+    # Assert
+    assert {"ProcessedRows": 1000, "DeletedRows": 1} == stats
+    assert to_json_string(out) == data.replace('{"customer_id": "23456"}\n', "")
+
+
+@patch("backend.ecs_tasks.delete_files.json_handler.READ_CHUNK_SIZE", 100)
+def test_it_raises_errors_of_the_process_pool_with_line_numbers():
+    to_delete = [{"Column": "customer_id", "MatchIds": ["23456"], "Type": "Simple"}]
+    data = '{"customer_id": "12345"}\n' * 50 + '{"customer_id": "23456\n'
+    with pytest.raises(ValueError) as e:
+        delete_matches_from_json_file(to_json_file(data), to_delete, max_workers=2)
+    assert "line 51 column 17 (char 16)" in e.value.args[0]
+
+
 def to_json_file(data, compressed=False):
     mode = "wb" if compressed else "w+t"
     tmp = tempfile.NamedTemporaryFile(mode=mode)
@@ -10,6 +10,7 @@ import pyarrow as pa
 import pytest
 from pyarrow.lib import ArrowException
 
+from cse import DataKeyCache
 from s3 import DeleteOldVersionsError, IntegrityCheckFailedError
 
 with patch.dict(
@@ -17,11 +18,13 @@ with patch.dict(
 ):
     from backend.ecs_tasks.delete_files.main import (
         build_matches,
+        emit_data_key_cache_metrics,
         kill_handler,
         execute,
         handle_error,
         get_queue,
         main,
+        NonDaemonicProcess,
         parse_args,
         delete_matches_from_file,
     )
@@ -29,6 +32,17 @@ with patch.dict(
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
 
+def save_stream_stub(version_id="new_version123", stream=None):
+    """
+    Writes to an in-memory stream where save_stream would stream to S3
+    """
+
+    def save_stream(client, bucket, key, metadata, write, source_version=None):
+        return version_id, write(pa.BufferOutputStream() if stream is None else stream)
+
+    return save_stream
+
+
 def get_list_object_versions_error():
     return ClientError(
         {
@@ -53,7 +67,7 @@ def get_list_object_versions_error():
 @patch("backend.ecs_tasks.delete_files.main.s3fs")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.build_matches")
 def test_happy_path_when_queue_not_empty(
     mock_build_matches,
@@ -69,7 +83,7 @@ def test_happy_path_when_queue_not_empty(
     mock_build_matches.return_value = [column]
     mock_s3.S3FileSystem.return_value = mock_s3
     mock_file = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
+    mock_save.side_effect = save_stream_stub()
     mock_s3.open.return_value = mock_s3
     mock_s3.metadata.return_value = {}
     mock_s3.__enter__.return_value = mock_file
@@ -80,18 +94,67 @@ def test_happy_path_when_queue_not_empty(
         "receipt_handle",
     )
     mock_s3.open.assert_called_with("s3://bucket/path/basic.parquet", "rb")
-    mock_delete.assert_called_with(mock_file, [column], "parquet", False)
-    mock_save.assert_called_with(
-        ANY, ANY, ANY, "bucket", "path/basic.parquet", {}, "abc123"
-    )
+    mock_delete.assert_called_with(mock_file, [column], "parquet", None, None, ANY)
+    mock_save.assert_called_with(ANY, "bucket", "path/basic.parquet", {}, ANY, "abc123")
     mock_emit.assert_called()
     mock_session.assert_called_with(None)
     mock_verify_integrity.assert_called_with(
         ANY, "bucket", "path/basic.parquet", "abc123", "new_version123"
     )
-    buf = mock_save.call_args[0][2]
-    assert buf.read
-    assert isinstance(buf, pa.BufferReader)  # must be BufferReader for zero-copy
+    out_stream = mock_delete.call_args[0][5]
+    assert out_stream.write
+
+
+@patch.dict(os.environ, {"JobTable": "test"})
+@patch(
+    "backend.ecs_tasks.delete_files.main.validate_bucket_versioning",
+    MagicMock(return_value=True),
+)
+@patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.verify_object_versions_integrity")
+@patch("backend.ecs_tasks.delete_files.main.get_session")
+@patch("backend.ecs_tasks.delete_files.main.s3fs")
+@patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
+@patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
+@patch("backend.ecs_tasks.delete_files.main.build_matches")
+@patch("backend.ecs_tasks.delete_files.main.open_object_version")
+@patch("backend.ecs_tasks.delete_files.main.DOWNLOAD_WORKERS", 8)
+def test_it_reads_source_versions_with_ranged_gets(
+    mock_open_version,
+    mock_build_matches,
+    mock_save,
+    mock_delete,
+    mock_s3,
+    mock_session,
+    mock_verify_integrity,
+    message_stub,
+):
+    column = {"Column": "customer_id", "MatchIds": ["12345", "23456"]}
+    mock_build_matches.return_value = [column]
+    mock_s3.S3FileSystem.return_value = mock_s3
+    mock_file = MagicMock(version_id="abc123")
+    mock_save.side_effect = save_stream_stub()
+    mock_s3.open.return_value = mock_s3
+    mock_s3.metadata.return_value = {}
+    mock_s3.__enter__.return_value = mock_file
+    mock_stream = MagicMock()
+    mock_open_version.return_value.__enter__.return_value = mock_stream
+    mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
+    execute(
+        "https://queue/url",
+        message_stub(Object="s3://bucket/path/basic.parquet"),
+        "receipt_handle",
+    )
+    mock_open_version.assert_called_with(
+        ANY, "bucket", "path/basic.parquet", "abc123", 16 * 1024 * 1024, 8
+    )
+    mock_delete.assert_called_with(mock_stream, [column], "parquet", None, None, ANY)
+    mock_open_version.return_value.__exit__.assert_called()
+    mock_verify_integrity.assert_called_with(
+        ANY, "bucket", "path/basic.parquet", "abc123", "new_version123"
+    )
 
 
 @patch.dict(os.environ, {"JobTable": "test"})
@@ -106,7 +169,7 @@ def test_happy_path_when_queue_not_empty(
 @patch("backend.ecs_tasks.delete_files.main.s3fs")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.build_matches")
 def test_happy_path_when_queue_not_empty_for_compressed_json(
     mock_build_matches,
@@ -122,7 +185,7 @@ def test_happy_path_when_queue_not_empty_for_compressed_json(
     mock_build_matches.return_value = [column]
     mock_s3.S3FileSystem.return_value = mock_s3
     mock_file = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
+    mock_save.side_effect = save_stream_stub()
     mock_s3.open.return_value = mock_s3
     mock_s3.metadata.return_value = {}
     mock_s3.__enter__.return_value = mock_file
@@ -133,18 +196,15 @@ def test_happy_path_when_queue_not_empty_for_compressed_json(
         "receipt_handle",
     )
     mock_s3.open.assert_called_with("s3://bucket/path/basic.json.gz", "rb")
-    mock_delete.assert_called_with(mock_file, [column], "json", True)
-    mock_save.assert_called_with(
-        ANY, ANY, ANY, "bucket", "path/basic.json.gz", {}, "abc123"
-    )
+    mock_delete.assert_called_with(mock_file, [column], "json", "gzip", None, ANY)
+    mock_save.assert_called_with(ANY, "bucket", "path/basic.json.gz", {}, ANY, "abc123")
     mock_emit.assert_called()
     mock_session.assert_called_with(None)
     mock_verify_integrity.assert_called_with(
         ANY, "bucket", "path/basic.json.gz", "abc123", "new_version123"
     )
-    buf = mock_save.call_args[0][2]
-    assert buf.read
-    assert isinstance(buf, pa.BufferReader)  # must be BufferReader for zero-copy
+    out_stream = mock_delete.call_args[0][5]
+    assert out_stream.write
 
 
 @patch.dict(os.environ, {"JobTable": "test"})
@@ -159,7 +219,7 @@ def test_happy_path_when_queue_not_empty_for_compressed_json(
 @patch("backend.ecs_tasks.delete_files.main.s3fs")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.build_matches")
 @patch("backend.ecs_tasks.delete_files.main.is_kms_cse_encrypted")
 @patch("backend.ecs_tasks.delete_files.main.encrypt")
@@ -183,34 +243,35 @@ def test_cse_kms_encrypted(
     mock_s3.S3FileSystem.return_value = mock_s3
     mock_file = MagicMock(version_id="abc123")
     mock_file_decrypted = BytesIO(b"")
-    mock_save.return_value = "new_version123"
+    upload_stream = MagicMock()
+    mock_save.side_effect = save_stream_stub(stream=upload_stream)
     mock_s3.open.return_value = mock_s3
     mock_is_encrypted.return_value = True
     mock_s3.metadata.return_value = metadata
     mock_s3.__enter__.return_value = mock_file
-    redacted = pa.BufferOutputStream()
-    redacted_encrypted = BytesIO(b"")
-    mock_delete.return_value = redacted, {"DeletedRows": 1}
+    encrypting_stream = MagicMock()
+    mock_delete.return_value = encrypting_stream, {"DeletedRows": 1}
     mock_decrypt.return_value = mock_file_decrypted
-    mock_encrypt.return_value = redacted_encrypted, {"new_metadata": "foo"}
+    mock_encrypt.return_value = {"new_metadata": "foo"}, lambda out: encrypting_stream
     execute(
         "https://queue/url",
         message_stub(Object="s3://bucket/path/basic.parquet"),
         "receipt_handle",
     )
     mock_is_encrypted.assert_called_with(metadata)
-    mock_decrypt.assert_called_with(mock_file, metadata, ANY)
+    mock_decrypt.assert_called_with(mock_file, metadata, ANY, None)
     mock_s3.open.assert_called_with("s3://bucket/path/basic.parquet", "rb")
-    mock_delete.assert_called_with(mock_file_decrypted, [column], "parquet", False)
-    mock_encrypt.assert_called_with(ANY, metadata, ANY)
+    mock_delete.assert_called_with(
+        ANY, [column], "parquet", None, None, encrypting_stream
+    )
+    assert isinstance(mock_delete.call_args[0][0], pa.BufferReader)
+    mock_encrypt.assert_called_with(metadata, ANY, None)
+    encrypting_stream.close.assert_called()
+    upload_stream.set_metadata.assert_called_with(
+        encrypting_stream.get_metadata.return_value
+    )
     mock_save.assert_called_with(
-        mock_s3,
-        ANY,
-        redacted_encrypted,
-        "bucket",
-        "path/basic.parquet",
-        {"new_metadata": "foo"},
-        "abc123",
+        ANY, "bucket", "path/basic.parquet", {"new_metadata": "foo"}, ANY, "abc123"
     )
     mock_emit.assert_called()
     mock_session.assert_called_with(None)
@@ -231,7 +292,10 @@ def test_cse_kms_encrypted(
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.save", MagicMock())
+@patch(
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=save_stream_stub()),
+)
 @patch("backend.ecs_tasks.delete_files.main.build_matches", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_session")
 @patch("backend.ecs_tasks.delete_files.main.s3fs")
@@ -265,7 +329,7 @@ def test_it_assumes_role(mock_delete, mock_s3, mock_session, message_stub):
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.delete_old_versions")
 @patch("backend.ecs_tasks.delete_files.main.s3fs")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
@@ -276,7 +340,7 @@ def test_it_removes_old_versions(
     mock_s3.S3FileSystem.return_value = mock_s3
     mock_s3.open.return_value = mock_s3
     mock_s3.__enter__.return_value = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
+    mock_save.side_effect = save_stream_stub()
     mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
     execute(
         "https://queue/url",
@@ -303,7 +367,7 @@ def test_it_removes_old_versions(
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.delete_old_versions")
 @patch("backend.ecs_tasks.delete_files.main.s3fs")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
@@ -315,7 +379,7 @@ def test_it_handles_old_version_delete_failures(
     mock_s3.S3FileSystem.return_value = mock_s3
     mock_s3.open.return_value = mock_s3
     mock_s3.__enter__.return_value = MagicMock(version_id="abc123")
-    mock_save.return_value = "new_version123"
+    mock_save.side_effect = save_stream_stub()
     mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 1}
     mock_delete_versions.side_effect = DeleteOldVersionsError(errors=["access denied"])
     execute(
@@ -343,13 +407,14 @@ def test_it_handles_old_version_delete_failures(
 @patch("backend.ecs_tasks.delete_files.main.s3fs")
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.emit_deletion_event")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
 @patch("backend.ecs_tasks.delete_files.main.build_matches", MagicMock())
 def test_it_handles_no_deletions(
     mock_handle, mock_save, mock_emit, mock_delete, mock_s3, message_stub,
 ):
     mock_s3.S3FileSystem.return_value = mock_s3
+    mock_save.side_effect = save_stream_stub()
     mock_delete.return_value = pa.BufferOutputStream(), {"DeletedRows": 0}
     execute(
         "https://queue/url",
@@ -357,7 +422,6 @@ def test_it_handles_no_deletions(
         "receipt_handle",
     )
     mock_s3.open.assert_called_with("s3://bucket/path/basic.parquet", "rb")
-    mock_save.assert_not_called()
     mock_emit.assert_not_called()
     mock_handle.assert_called_with(
         ANY,
@@ -558,7 +622,7 @@ def test_it_handles_unversioned_buckets(
 @patch("backend.ecs_tasks.delete_files.main.get_session", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.delete_matches_from_file")
 @patch("backend.ecs_tasks.delete_files.main.handle_error")
-@patch("backend.ecs_tasks.delete_files.main.save")
+@patch("backend.ecs_tasks.delete_files.main.save_stream")
 @patch("backend.ecs_tasks.delete_files.main.build_matches", MagicMock())
 def test_it_provides_logs_for_acl_fail(
     mock_save, mock_error_handler, mock_delete, message_stub
@@ -582,7 +646,8 @@ def test_it_provides_logs_for_acl_fail(
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=save_stream_stub("new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
@@ -617,7 +682,8 @@ def test_it_provides_logs_for_failed_version_integrity_check_and_performs_rollba
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=save_stream_stub("new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue", MagicMock())
@@ -649,7 +715,8 @@ def test_it_provides_logs_for_get_latest_version_fail(
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=save_stream_stub("new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
@@ -689,7 +756,8 @@ def test_it_provides_logs_for_failed_rollback_client_error(
     MagicMock(return_value=True),
 )
 @patch(
-    "backend.ecs_tasks.delete_files.main.save", MagicMock(return_value="new_version")
+    "backend.ecs_tasks.delete_files.main.save_stream",
+    MagicMock(side_effect=save_stream_stub("new_version")),
 )
 @patch("backend.ecs_tasks.delete_files.main.validate_message", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.s3fs", MagicMock())
@@ -829,6 +897,36 @@ def test_it_gracefully_handles_cleanup_issues(mock_error_handler):
         mock_pool.terminate.assert_called()
 
 
+@patch("backend.ecs_tasks.delete_files.main.emit_data_key_cache_metrics")
+@patch("backend.ecs_tasks.delete_files.main.handle_error", MagicMock())
+def test_kill_handler_emits_data_key_cache_metrics(mock_emit_metrics):
+    data_key_cache = DataKeyCache(10, 60)
+    with pytest.raises(SystemExit):
+        kill_handler([], MagicMock(), data_key_cache)
+    mock_emit_metrics.assert_called_once_with(data_key_cache)
+
+
+@patch("backend.ecs_tasks.delete_files.main.boto3")
+def test_it_publishes_data_key_cache_hit_rate(mock_boto):
+    data_key_cache = DataKeyCache(10, 60, counts={"Hits": 3, "Misses": 1})
+    emit_data_key_cache_metrics(data_key_cache)
+    mock_boto.client.assert_called_once_with("cloudwatch")
+    mock_boto.client().put_metric_data.assert_called_once_with(
+        Namespace="S3F2",
+        MetricData=[
+            {"MetricName": "DataKeyCacheHitRate", "Value": 75.0, "Unit": "Percent"},
+            {"MetricName": "DataKeyCacheHits", "Value": 3, "Unit": "Count"},
+            {"MetricName": "DataKeyCacheMisses", "Value": 1, "Unit": "Count"},
+        ],
+    )
+
+
+@patch("backend.ecs_tasks.delete_files.main.boto3")
+def test_it_skips_data_key_cache_metrics_without_lookups(mock_boto):
+    emit_data_key_cache_metrics(DataKeyCache(10, 60))
+    mock_boto.client.assert_not_called()
+
+
 @patch.dict(os.environ, {"DELETE_OBJECTS_QUEUE": "https://queue/url"})
 def test_it_inits_arg_parser_with_defaults():
     res = parse_args([])
@@ -868,6 +966,7 @@ def test_it_does_not_override_user_supplied_endpoint_url(mock_boto):
 
 
 @patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.Manager", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.Pool")
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
 def test_it_starts_subprocesses(mock_queue, mock_pool):
@@ -882,13 +981,37 @@ def test_it_starts_subprocesses(mock_queue, mock_pool):
         main("https://queue/url", 1, 1, 1)
     mock_pool.assert_called_with(maxtasksperchild=1)
     mock_pool.starmap.assert_called_with(
-        ANY, [("https://queue/url", mock_message.body, mock_message.receipt_handle)]
+        ANY,
+        [
+            (
+                "https://queue/url",
+                mock_message.body,
+                mock_message.receipt_handle,
+                ANY,
+                None,
+            )
+        ],
     )
+    assert isinstance(mock_pool.starmap.call_args[0][1][0][3], DataKeyCache)
     mock_queue.receive_messages.assert_called_with(
         WaitTimeSeconds=1, MaxNumberOfMessages=1
     )
 
 
+@patch("backend.ecs_tasks.delete_files.main.JSON_CHUNK_WORKERS", 4)
+@patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.Manager", MagicMock())
+@patch("backend.ecs_tasks.delete_files.main.NonDaemonicContext")
+@patch("backend.ecs_tasks.delete_files.main.get_queue")
+def test_it_starts_non_daemonic_subprocesses_for_json_workers(mock_queue, mock_ctx):
+    mock_queue.return_value = mock_queue
+    mock_queue.receive_messages.side_effect = RuntimeError("Break loop")
+    with pytest.raises(RuntimeError):
+        main("https://queue/url", 1, 1, 1)
+    mock_ctx.return_value.Pool.assert_called_with(maxtasksperchild=1)
+    assert not NonDaemonicProcess().daemon
+
+
 @patch("backend.ecs_tasks.delete_files.main.Pool", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.signal", MagicMock())
 @patch("backend.ecs_tasks.delete_files.main.get_queue")
@@ -922,7 +1045,7 @@ def test_it_deletes_from_json_file(mock_parquet, mock_json):
     f = MagicMock()
     cols = MagicMock()
     delete_matches_from_file(f, cols, "json", False)
-    mock_json.assert_called_with(f, cols, False)
+    mock_json.assert_called_with(f, cols, False, None, 1, 6)
     mock_parquet.assert_not_called()
 
 
@@ -932,7 +1055,7 @@ def test_it_deletes_from_parquet_file(mock_parquet, mock_json):
     f = MagicMock()
     cols = MagicMock()
     delete_matches_from_file(f, cols, "parquet")
-    mock_parquet.assert_called_with(f, cols)
+    mock_parquet.assert_called_with(f, cols, None, None, max_workers=1)
     mock_json.assert_not_called()
 
 
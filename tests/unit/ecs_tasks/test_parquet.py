@@ -1,5 +1,5 @@
 from io import BytesIO
-from mock import patch
+from mock import call, patch, MagicMock
 
 import pyarrow as pa
 import pyarrow.json as pj
@@ -8,17 +8,27 @@ import pytest
 import pandas as pd
 import tempfile
 from backend.ecs_tasks.delete_files.parquet_handler import (
+    build_value_set,
     delete_matches_from_parquet_file,
     delete_from_table,
+    encode_composite_match_ids,
+    get_deletion_mask,
+    get_row_indexes_to_delete,
+    get_row_indexes_to_delete_for_composite,
+    get_statistics_filters,
+    get_value_sets,
+    get_writer_options,
     load_parquet,
+    may_contain_matches,
 )
+from backend.ecs_tasks.delete_files.s3 import MultipartUploadStream
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
 
 @patch("backend.ecs_tasks.delete_files.parquet_handler.load_parquet")
-@patch("backend.ecs_tasks.delete_files.parquet_handler.delete_from_table")
-def test_it_generates_new_parquet_file_without_matches(mock_delete, mock_load_parquet):
+@patch("backend.ecs_tasks.delete_files.parquet_handler.get_deletion_mask")
+def test_it_generates_new_parquet_file_without_matches(mock_mask, mock_load_parquet):
     # Arrange
     column = {
         "Column": "customer_id",
@@ -31,16 +41,16 @@ def test_it_generates_new_parquet_file_without_matches(mock_delete, mock_load_pa
     df.to_parquet(buf)
     br = pa.BufferReader(buf.getvalue())
     f = pq.ParquetFile(br, memory_map=False)
-    mock_df = pd.DataFrame([{"customer_id": "12345"}])
-    mock_delete.return_value = [pa.Table.from_pandas(mock_df), 1]
+    mock_mask.return_value = pa.array([True, False])
     mock_load_parquet.return_value = f
     # Act
-    out, stats = delete_matches_from_parquet_file("input_file.parquet", column)
+    out, stats = delete_matches_from_parquet_file(br, [column])
     assert isinstance(out, pa.BufferOutputStream)
     assert {"ProcessedRows": 2, "DeletedRows": 1} == stats
     res = pa.BufferReader(out.getvalue())
     newf = pq.ParquetFile(res, memory_map=False)
     assert 1 == newf.read().num_rows
+    assert ["34567"] == newf.read().column("customer_id").to_pylist()
 
 
 @patch("backend.ecs_tasks.delete_files.parquet_handler.load_parquet")
@@ -64,7 +74,7 @@ def test_it_handles_files_with_multiple_row_groups_and_pandas_indexes(
     f = pq.ParquetFile(br, memory_map=False)
     mock_load_parquet.return_value = f
     # Act
-    out, stats = delete_matches_from_parquet_file("input_file.parquet", columns)
+    out, stats = delete_matches_from_parquet_file(br, columns)
     # Assert
     assert {"ProcessedRows": 6, "DeletedRows": 3} == stats
     res = pa.BufferReader(out.getvalue())
@@ -73,6 +83,356 @@ def test_it_handles_files_with_multiple_row_groups_and_pandas_indexes(
     assert 3 == newf.read().num_rows
 
 
+@patch("backend.ecs_tasks.delete_files.parquet_handler.get_deletion_mask")
+def test_it_skips_row_groups_excluded_by_statistics(mock_mask):
+    # Arrange
+    mock_mask.side_effect = get_deletion_mask
+    columns = [{"Column": "customer_id", "MatchIds": [3, 100], "Type": "Simple"}]
+    table = pa.table({"customer_id": [1, 2, 3, 4, 5, 6]})
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=2)
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns
+    )
+    # Assert
+    assert {"ProcessedRows": 6, "DeletedRows": 1} == stats
+    assert 1 == mock_mask.call_count
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    assert 3 == res.num_row_groups
+    assert [1, 2, 4, 5, 6] == res.read().column("customer_id").to_pylist()
+
+
+@patch("backend.ecs_tasks.delete_files.parquet_handler.load_parquet")
+def test_it_reads_only_identifier_columns_when_there_are_no_matches(mock_load_parquet,):
+    # Arrange
+    columns = [
+        {"Column": "User.Id", "MatchIds": ["23456"], "Type": "Simple"},
+        {"Columns": ["name", "user.id"], "MatchIds": [["a", "b"]], "Type": "Composite"},
+    ]
+    table = pa.table(
+        {
+            "user": [
+                {"id": "12345", "age": 1},
+                {"id": "34567", "age": 3},
+                {"id": "23456", "age": 2},
+            ],
+            "name": ["john", "mary", "jane"],
+            "payload": ["foo", "baz", "bar"],
+        }
+    )
+    buf = BytesIO()
+    # Row groups are written as separate tables as pyarrow 2.0 doesn't write
+    # slices of struct columns correctly
+    with pq.ParquetWriter(buf, table.schema, use_dictionary=False) as writer:
+        for offset in [0, 2]:
+            rows = table.slice(offset, 2).to_pydict()
+            writer.write_table(pa.table(rows, schema=table.schema))
+    br = pa.BufferReader(buf.getvalue())
+    f = pq.ParquetFile(br)
+    mock_load_parquet.return_value = MagicMock(wraps=f, metadata=f.metadata)
+    mock_load_parquet.return_value.num_row_groups = 2
+    # Act
+    out, stats = delete_matches_from_parquet_file(br, columns)
+    # Assert
+    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    assert mock_load_parquet.return_value.read_row_group.call_args_list == [
+        call(0, columns=["user.id", "name"]),
+        call(1, columns=["user.id", "name"]),
+        call(1),
+    ]
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue())).read()
+    assert res.to_pydict() == {
+        "user": [{"id": "12345", "age": 1}, {"id": "34567", "age": 3}],
+        "name": ["john", "mary"],
+        "payload": ["foo", "baz"],
+    }
+
+
+def test_it_copies_row_groups_without_matches_byte_for_byte():
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": [4], "Type": "Simple"}]
+    table = pa.table({"customer_id": [1, 2, 3, 4, 5, 6], "name": list("abcdef")})
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=2, compression="gzip")
+    source = pq.ParquetFile(pa.BufferReader(buf.getvalue()))
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns
+    )
+    # Assert
+    assert {"ProcessedRows": 6, "DeletedRows": 1} == stats
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    assert res.metadata.created_by == source.metadata.created_by
+    assert [2, 1, 2] == [
+        res.metadata.row_group(i).num_rows for i in range(res.num_row_groups)
+    ]
+    assert res.read().to_pydict() == {
+        "customer_id": [1, 2, 3, 5, 6],
+        "name": ["a", "b", "c", "e", "f"],
+    }
+    for i in [0, 2]:
+        for j in range(2):
+            original = source.metadata.row_group(i).column(j)
+            copied = res.metadata.row_group(i).column(j)
+            assert copied.compression == original.compression
+            assert copied.total_compressed_size == original.total_compressed_size
+            assert copied.statistics == original.statistics
+    first_chunk_size = source.metadata.row_group(0).column(0).total_compressed_size
+    assert (
+        buf.getvalue()[: 4 + first_chunk_size]
+        == out.getvalue().to_pybytes()[: 4 + first_chunk_size]
+    )
+
+
+@pytest.mark.parametrize("use_deprecated_int96_timestamps", [False, True])
+def test_it_processes_row_groups_concurrently_in_order(
+    use_deprecated_int96_timestamps,
+):
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": [4, 9, 15], "Type": "Simple"}]
+    table = pa.table(
+        {
+            "customer_id": list(range(20)),
+            "created": pa.array(list(range(20)), type=pa.timestamp("ms")),
+        }
+    )
+    buf = BytesIO()
+    pq.write_table(
+        table,
+        buf,
+        row_group_size=2,
+        use_deprecated_int96_timestamps=use_deprecated_int96_timestamps,
+    )
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns, max_workers=4, max_in_flight=2
+    )
+    # Assert
+    assert {"ProcessedRows": 20, "DeletedRows": 3} == stats
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    assert 10 == res.num_row_groups
+    assert [x for x in range(20) if x not in [4, 9, 15]] == res.read().column(
+        "customer_id"
+    ).to_pylist()
+
+
+def test_it_keeps_the_writer_settings_of_the_source_file():
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": [2], "Type": "Simple"}]
+    table = pa.table({"customer_id": [1, 2, 3], "name": list("abc")})
+    buf = BytesIO()
+    pq.write_table(
+        table,
+        buf,
+        compression={b"customer_id": "ZSTD", b"name": "GZIP"},
+        use_dictionary=["name"],
+        write_statistics=["customer_id"],
+    )
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns
+    )
+    # Assert
+    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    customer_id = res.metadata.row_group(0).column(0)
+    name = res.metadata.row_group(0).column(1)
+    assert "ZSTD" == customer_id.compression
+    assert "GZIP" == name.compression
+    assert not customer_id.has_dictionary_page
+    assert name.has_dictionary_page
+    assert customer_id.is_stats_set
+    assert not name.is_stats_set
+    assert [1, 3] == res.read().column("customer_id").to_pylist()
+
+
+def test_it_overrides_the_writer_settings_of_the_source_file():
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": [2], "Type": "Simple"}]
+    table = pa.table({"customer_id": [1, 2, 3], "name": list("abc")})
+    buf = BytesIO()
+    pq.write_table(table, buf, compression="ZSTD", row_group_size=1)
+    # Act
+    out, _ = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()),
+        columns,
+        {"Compression": "GZIP", "UseDictionary": False},
+    )
+    # Assert
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    for row_group in range(res.num_row_groups):
+        for i in range(2):
+            column = res.metadata.row_group(row_group).column(i)
+            assert "GZIP" == column.compression
+            assert not column.has_dictionary_page
+
+
+def test_it_copies_row_groups_when_overrides_match_the_source_file():
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": [2], "Type": "Simple"}]
+    table = pa.table({"customer_id": [1, 2, 3], "name": list("abc")})
+    buf = BytesIO()
+    pq.write_table(table, buf, compression="GZIP", row_group_size=1)
+    source = pq.ParquetFile(pa.BufferReader(buf.getvalue()))
+    # Act
+    out, _ = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()),
+        columns,
+        {"Compression": "GZIP", "UseDictionary": True},
+    )
+    # Assert
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    assert res.metadata.created_by == source.metadata.created_by
+    first_chunk_size = source.metadata.row_group(0).column(0).total_compressed_size
+    assert (
+        buf.getvalue()[: 4 + first_chunk_size]
+        == out.getvalue().to_pybytes()[: 4 + first_chunk_size]
+    )
+
+
+def test_it_infers_writer_options_from_file_metadata():
+    table = pa.table({"user": [{"id": 1}], "name": ["a"]})
+    buf = BytesIO()
+    pq.write_table(
+        table, buf, compression={b"user.id": "ZSTD", b"name": "NONE"}, version="1.0"
+    )
+    metadata = pq.ParquetFile(pa.BufferReader(buf.getvalue())).metadata
+    options = get_writer_options(metadata, {"DataPageSize": 1024})
+    assert "1.0" == options["version"]
+    assert {b"user.id": "ZSTD", b"name": "NONE"} == options["compression"]
+    assert ["user.id", "name"] == options["use_dictionary"]
+    assert ["user.id", "name"] == options["write_statistics"]
+    assert 1024 == options["data_page_size"]
+
+
+def test_it_applies_compression_levels_only_to_codecs_supporting_them():
+    columns = [{"Column": "customer_id", "MatchIds": [2], "Type": "Simple"}]
+    table = pa.table({"customer_id": [1, 2, 3], "name": list("abc")})
+    buf = BytesIO()
+    pq.write_table(table, buf, compression={b"customer_id": "SNAPPY", b"name": "ZSTD"})
+    metadata = pq.ParquetFile(pa.BufferReader(buf.getvalue())).metadata
+    options = get_writer_options(metadata, {"CompressionLevel": 5})
+    assert {b"name": 5} == options["compression_level"]
+    options = get_writer_options(
+        metadata, {"Compression": "SNAPPY", "CompressionLevel": 5}
+    )
+    assert "compression_level" not in options
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns, {"CompressionLevel": 5}
+    )
+    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    assert [1, 3] == res.read().column("customer_id").to_pylist()
+
+
+@pytest.mark.parametrize("use_deprecated_int96_timestamps", [False, True])
+def test_it_writes_row_groups_to_output_streams(use_deprecated_int96_timestamps):
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": [4], "Type": "Simple"}]
+    table = pa.table(
+        {
+            "customer_id": [1, 2, 3, 4, 5, 6],
+            "created": pa.array([1, 2, 3, 4, 5, 6], type=pa.timestamp("ms")),
+        }
+    )
+    buf = BytesIO()
+    pq.write_table(
+        table,
+        buf,
+        row_group_size=2,
+        use_deprecated_int96_timestamps=use_deprecated_int96_timestamps,
+    )
+    mock_client = MagicMock()
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.upload_part.return_value = {"ETag": "a"}
+    stream = MultipartUploadStream(mock_client, "bucket", "key", {}, 64)
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns, out_stream=stream
+    )
+    stream.complete()
+    # Assert
+    assert out is stream
+    assert {"ProcessedRows": 6, "DeletedRows": 1} == stats
+    assert mock_client.upload_part.call_count > 1
+    content = b"".join(c[1]["Body"] for c in mock_client.upload_part.call_args_list)
+    res = pq.ParquetFile(pa.BufferReader(content))
+    assert [1, 2, 3, 5, 6] == res.read().column("customer_id").to_pylist()
+
+
+def test_it_rewrites_all_row_groups_when_chunks_cannot_be_copied():
+    # Arrange
+    columns = [{"Column": "customer_id", "MatchIds": [4], "Type": "Simple"}]
+    table = pa.table(
+        {
+            "customer_id": [1, 4, 5],
+            # Format version 1.0 files store timestamps in microseconds
+            "created": pa.array([1000, 2000, 3000], type=pa.timestamp("ns")),
+        }
+    )
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=1, use_deprecated_int96_timestamps=True)
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns
+    )
+    # Assert
+    assert {"ProcessedRows": 3, "DeletedRows": 1} == stats
+    res = pq.ParquetFile(pa.BufferReader(out.getvalue()))
+    assert [1, 0, 1] == [
+        res.metadata.row_group(i).num_rows for i in range(res.num_row_groups)
+    ]
+    assert [1, 5] == res.read().column("customer_id").to_pylist()
+
+
+def test_it_skips_row_groups_only_when_all_columns_are_excluded():
+    table = pa.table(
+        {"first_name": ["john", "jane"], "last_name": ["doe", "doe"], "age": [1, 2]}
+    )
+    buf = BytesIO()
+    pq.write_table(table, buf)
+    metadata = pq.ParquetFile(pa.BufferReader(buf.getvalue())).metadata
+    schema = table.schema
+
+    def may_contain(columns):
+        to_delete = get_value_sets(schema, columns)
+        filters = get_statistics_filters(metadata.schema, to_delete)
+        return may_contain_matches(metadata.row_group(0), filters)
+
+    simple = {"Column": "age", "MatchIds": [3, 4], "Type": "Simple"}
+    composite = {
+        "Columns": ["first_name", "last_name"],
+        "MatchIds": [["mary", "doe"]],
+        "Type": "Composite",
+    }
+    assert not may_contain([simple])
+    assert not may_contain([simple, composite])
+    assert may_contain([{**simple, "MatchIds": [2]}, composite])
+    assert may_contain([simple, {**composite, "MatchIds": [["jane", "doe"]]}])
+    assert not may_contain([{**composite, "MatchIds": [["jane", "smith"]]}])
+    assert may_contain([{**simple, "MatchIds": [None]}])
+
+
+@patch("backend.ecs_tasks.delete_files.parquet_handler.get_deletion_mask")
+def test_it_skips_row_groups_whose_dictionaries_exclude_all_match_ids(mock_mask):
+    mock_mask.side_effect = get_deletion_mask
+    ids = ["8c2d6a1e-{:04}".format(i) for i in range(6)]
+    table = pa.table({"customer_id": ids, "age": list(range(6))})
+    buf = BytesIO()
+    pq.write_table(table, buf, row_group_size=2, write_statistics=False)
+    columns = [{"Column": "customer_id", "MatchIds": [ids[3]], "Type": "Simple"}]
+    # Act
+    out, stats = delete_matches_from_parquet_file(
+        pa.BufferReader(buf.getvalue()), columns
+    )
+    # Assert
+    assert {"ProcessedRows": 6, "DeletedRows": 1} == stats
+    assert 1 == mock_mask.call_count
+    res = pq.read_table(pa.BufferReader(out.getvalue()))
+    assert ids[:3] + ids[4:] == res.column("customer_id").to_pylist()
+
+
 def test_delete_correct_rows_from_table():
     data = [
         {"customer_id": "12345"},
@@ -91,6 +451,31 @@ def test_delete_correct_rows_from_table():
     assert table.to_pydict() == {"customer_id": ["34567"]}
 
 
+def test_it_builds_value_sets_typed_as_the_column():
+    value_set = build_value_set([12345, 23456], pa.int32())
+    assert value_set.type == pa.int32()
+    assert value_set.to_pylist() == [12345, 23456]
+
+
+def test_it_drops_match_ids_incompatible_with_the_column_type():
+    value_set = build_value_set(["12345", 23456, "abc"], pa.int64())
+    assert value_set.type == pa.int64()
+    assert value_set.to_pylist() == [23456]
+
+
+def test_it_matches_simple_columns_natively():
+    table = pa.table(
+        {
+            "customer_id": pa.chunked_array([[12345, None], [23456, 34567]]),
+            "category": pa.array(["a", "b", "a", "c"]).dictionary_encode(),
+        }
+    )
+    mask = get_row_indexes_to_delete(table, "customer_id", [23456, "12345"])
+    assert mask.to_pylist() == [False, False, True, False]
+    mask = get_row_indexes_to_delete(table, "category", ["a"])
+    assert mask.to_pylist() == [True, False, True, False]
+
+
 def test_handles_lower_cased_column_names():
     data = [
         {"userData": {"customerId": "12345"}},
@@ -113,6 +498,28 @@ def test_handles_lower_cased_column_names():
     assert table.to_pydict() == {"userData": [{"customerId": "34567"}]}
 
 
+def test_it_matches_nested_fields_without_converting_rows():
+    table = pa.table(
+        {
+            "user": [
+                {"info": {"Id": "12345"}},
+                None,
+                {"info": None},
+                {"info": {"Id": "23456"}},
+            ]
+        }
+    )
+    mask = get_row_indexes_to_delete(table, "user.info.id", ["23456", "12345"])
+    assert mask.to_pylist() == [True, False, False, True]
+
+
+def test_it_throws_for_nested_identifiers_of_non_struct_columns():
+    table = pa.table({"user": [[1, 2], [3]]})
+    with pytest.raises(ValueError) as e:
+        get_row_indexes_to_delete(table, "user.id", [1])
+    assert e.value.args[0] == "Column user.id is not a struct and cannot contain id"
+
+
 def test_it_handles_data_with_pandas_indexes():
     data = [
         {"customer_id": "12345"},
@@ -222,6 +629,30 @@ def test_delete_correct_rows_from_parquet_table_with_composite_types_multiple_ty
     assert res["customer_id"].values[1] == 34567
 
 
+def test_it_encodes_composite_match_ids_by_column():
+    value_sets, positions = encode_composite_match_ids(
+        [pa.string(), pa.int64()], [["john", 12], ["jane", 12], ["john", "abc"]]
+    )
+    assert [v.to_pylist() for v in value_sets] == [["john", "jane"], [12]]
+    assert [p.tolist() for p in positions] == [[0, 1, 0], [0, 0, -1]]
+
+
+def test_it_matches_composite_columns_on_whole_tuples_only():
+    table = pa.table(
+        {
+            "first_name": ["john", "jane", "john", None, "jane"],
+            "last_name": ["doe", "smith", "smith", "doe", "doe"],
+            "age": [11, 12, 13, 14, 15],
+        }
+    )
+    mask = get_row_indexes_to_delete_for_composite(
+        table,
+        ["first_name", "last_name", "age"],
+        [["john", "doe", 11], ["jane", "smith", 12], ["john", "smith", "13"]],
+    )
+    assert mask.to_pylist() == [True, True, False, False, False]
+
+
 def test_delete_correct_rows_from_parquet_table_with_complex_composite_types():
     data = {
         "customer_id": [12345, 23456, 34567],
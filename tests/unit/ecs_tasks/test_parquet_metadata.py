@@ -0,0 +1,73 @@
+from io import BytesIO
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from backend.ecs_tasks.delete_files.parquet_metadata import (
+    FILE_NUM_ROWS,
+    I32,
+    LIST,
+    STRUCT,
+    TRUE,
+    get_chunk_range,
+    get_column_chunks,
+    get_field,
+    get_row_groups,
+    is_schema_compatible,
+    is_self_contained,
+    read_footer,
+    read_struct,
+    relocate_column_chunk,
+    serialize_struct,
+)
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+def get_footer(table, **kwargs):
+    buf = BytesIO()
+    pq.write_table(table, buf, **kwargs)
+    return read_footer(pa.BufferReader(buf.getvalue()))
+
+
+def test_it_reads_the_footer():
+    table = pa.table({"customer_id": [1, 2, 3], "user": [{"id": "a"}] * 3})
+    footer = get_footer(table, row_group_size=2)
+    assert 3 == get_field(footer, FILE_NUM_ROWS)
+    assert 2 == len(get_row_groups(footer))
+    assert 2 == len(get_column_chunks(get_row_groups(footer)[0]))
+
+
+def test_it_serializes_structs_as_they_are_read():
+    footer = get_footer(pa.table({"customer_id": [1, 2, 3]}))
+    assert read_struct(serialize_struct(footer))[0] == footer
+
+
+def test_it_serializes_unknown_fields():
+    fields = {
+        1: (TRUE, False),
+        20: (I32, -7),
+        21: (LIST, (STRUCT, [{1: (TRUE, True)}] * 20)),
+    }
+    assert read_struct(serialize_struct(fields))[0] == fields
+
+
+def test_it_relocates_column_chunks():
+    footer = get_footer(pa.table({"customer_id": [1, 2, 3]}))
+    chunk = get_column_chunks(get_row_groups(footer)[0])[0]
+    start, length = get_chunk_range(chunk)
+    relocated = relocate_column_chunk(chunk, start + 100)
+    assert (start + 100, length) == get_chunk_range(relocated)
+    assert start + 100 == get_field(relocated, 2)
+
+
+def test_it_checks_whether_chunks_can_be_copied():
+    table = pa.table({"created": pa.array([1], type=pa.timestamp("ms"))})
+    footer = get_footer(table)
+    assert is_self_contained(footer)
+    assert is_schema_compatible(footer, get_footer(table))
+    assert not is_schema_compatible(
+        footer, get_footer(table, use_deprecated_int96_timestamps=True)
+    )
+    assert not is_schema_compatible(footer, get_footer(pa.table({"created": [1]})))
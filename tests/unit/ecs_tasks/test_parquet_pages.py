@@ -0,0 +1,113 @@
+from io import BytesIO
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from mock import patch
+
+from backend.ecs_tasks.delete_files.parquet_metadata import (
+    get_column_chunks,
+    get_row_groups,
+    read_footer,
+)
+from backend.ecs_tasks.delete_files.parquet_pages import (
+    bloom_filter_contains,
+    EncodedValues,
+    encode_plain_values,
+    may_contain_encoded_values,
+    read_bloom_filter,
+    read_dictionary,
+    xxh64,
+)
+
+pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
+
+
+# Files written with writer options which pyarrow 2.0 doesn't support
+DATA_DIR = Path(__file__).parent.joinpath("data")
+
+
+def get_column_chunk(table, column=0, **kwargs):
+    buf = BytesIO()
+    pq.write_table(table, buf, **kwargs)
+    return read_column_chunk(pa.BufferReader(buf.getvalue()), column)
+
+
+def read_column_chunk(source, column=0):
+    return source, get_column_chunks(get_row_groups(read_footer(source))[0])[column]
+
+
+def open_column_chunk(name, column=0):
+    data = DATA_DIR.joinpath(name).read_bytes()
+    return read_column_chunk(pa.BufferReader(data), column)
+
+
+def test_it_hashes_with_xxh64():
+    assert 0xEF46DB3751D8E999 == xxh64(b"")
+    assert 0xD24EC4F1A98C6E5B == xxh64(b"a")
+    assert 0x44BC2CF5AD770999 == xxh64(b"abc")
+    assert 0x6AC1E58032166597 == xxh64(bytes(range(100)))
+
+
+def test_it_encodes_match_ids_as_plain_values():
+    assert [b"a", b"\xc3\xa9"] == encode_plain_values(["a", "é"], "BYTE_ARRAY")
+    assert [b"\x01"] == encode_plain_values([b"\x01"], "BYTE_ARRAY")
+    assert [b"\xff\xff\xff\xff"] == encode_plain_values([-1], "INT32")
+    assert [(2 ** 63).to_bytes(8, "little")] == encode_plain_values([2 ** 63], "INT64")
+    assert encode_plain_values([1, "a"], "BYTE_ARRAY") is None
+    assert encode_plain_values([True], "INT32") is None
+    assert encode_plain_values([1.5], "DOUBLE") is None
+
+
+@pytest.mark.parametrize("compression", ["NONE", "SNAPPY", "GZIP", "ZSTD", "LZ4_RAW"])
+def test_it_checks_dictionary_pages(compression):
+    table = pa.table({"customer_id": ["a", "bb", "ccc"], "age": [1, 2, 3]})
+    for column, present, absent in [
+        (0, [b"bb"], [b"b", b"cc"]),
+        (1, [(3).to_bytes(8, "little")], [(4).to_bytes(8, "little")]),
+    ]:
+        if compression == "LZ4_RAW":
+            source, chunk = open_column_chunk("dictionary_lz4_raw.parquet", column)
+        else:
+            source, chunk = get_column_chunk(table, column, compression=compression)
+        assert read_dictionary(source, chunk)[1] == 3
+        assert may_contain_encoded_values(
+            source, chunk, EncodedValues(absent + present)
+        )
+        assert not may_contain_encoded_values(source, chunk, EncodedValues(absent))
+
+
+def test_it_ignores_dictionaries_when_data_pages_fall_back_to_plain():
+    source, chunk = open_column_chunk("dictionary_fallback.parquet")
+    assert read_dictionary(source, chunk) is None
+    assert may_contain_encoded_values(source, chunk, EncodedValues([b"00000999"]))
+    assert may_contain_encoded_values(source, chunk, EncodedValues([b"missing"]))
+
+
+def test_it_checks_bloom_filters():
+    values = ["{:08}".format(i) for i in range(1000)]
+    source, chunk = open_column_chunk("bloom_filter.parquet")
+    bitset = read_bloom_filter(source, chunk)
+    assert all(bloom_filter_contains(bitset, v.encode()) for v in values)
+    assert may_contain_encoded_values(source, chunk, EncodedValues([b"00000042"]))
+    assert not may_contain_encoded_values(source, chunk, EncodedValues([b"missing"]))
+
+
+def test_it_may_contain_any_value_without_dictionary_or_bloom_filter():
+    source, chunk = get_column_chunk(pa.table({"id": [1, 2]}), use_dictionary=False)
+    assert read_bloom_filter(source, chunk) is None
+    assert may_contain_encoded_values(
+        source, chunk, EncodedValues([(4).to_bytes(8, "little")])
+    )
+
+
+def test_it_reuses_value_hashes_across_bloom_filters():
+    source, chunk = open_column_chunk("bloom_filter.parquet")
+    present = EncodedValues([b"00000042", b"missing"])
+    absent = EncodedValues([b"missing"])
+    assert [xxh64(b"00000042"), xxh64(b"missing")] == present.hashes
+    with patch("backend.ecs_tasks.delete_files.parquet_pages.xxh64") as mock_hash:
+        assert may_contain_encoded_values(source, chunk, present)
+        assert not may_contain_encoded_values(source, chunk, absent)
+        mock_hash.assert_not_called()
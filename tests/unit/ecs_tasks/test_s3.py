@@ -4,6 +4,9 @@ import json
 from mock import patch, MagicMock, call, ANY
 from io import BytesIO
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 from botocore.exceptions import ClientError
 
@@ -18,8 +21,11 @@ from backend.ecs_tasks.delete_files.s3 import (
     get_object_info,
     get_object_tags,
     IntegrityCheckFailedError,
+    MultipartUploadStream,
+    open_object_version,
+    RangedDownloadStream,
     rollback_object_version,
-    save,
+    save_stream,
     validate_bucket_versioning,
     verify_object_versions_integrity,
 )
@@ -270,48 +276,201 @@ def test_it_gets_grantees_by_type():
     assert {"id=grantee6"} == get_grantees(acl, "WRITE_ACP")
 
 
+def get_uploaded_parts(mock_client):
+    return b"".join(c[1]["Body"] for c in mock_client.upload_part.call_args_list)
+
+
+def test_it_uploads_stream_in_parts():
+    mock_client = MagicMock()
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.upload_part.side_effect = [{"ETag": "a"}, {"ETag": "b"}, {"ETag": "c"}]
+    mock_client.complete_multipart_upload.return_value = {"VersionId": "v1"}
+    stream = MultipartUploadStream(
+        mock_client, "bucket", "key", {"RequestPayer": "requester", "Tagging": "a=b"}, 4
+    )
+    assert 3 == stream.write(b"abc")
+    stream.write(bytearray(b"defgh"))
+    stream.write(memoryview(b"ij"))
+    assert 10 == stream.tell()
+    assert 2 == mock_client.upload_part.call_count
+    assert "v1" == stream.complete()
+    mock_client.create_multipart_upload.assert_called_once_with(
+        Bucket="bucket", Key="key", RequestPayer="requester", Tagging="a=b"
+    )
+    assert b"abcdefghij" == get_uploaded_parts(mock_client)
+    mock_client.upload_part.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        UploadId="upload1",
+        PartNumber=3,
+        Body=b"ij",
+        RequestPayer="requester",
+    )
+    mock_client.complete_multipart_upload.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        UploadId="upload1",
+        MultipartUpload={
+            "Parts": [
+                {"ETag": "a", "PartNumber": 1},
+                {"ETag": "b", "PartNumber": 2},
+                {"ETag": "c", "PartNumber": 3},
+            ]
+        },
+        RequestPayer="requester",
+    )
+    mock_client.put_object.assert_not_called()
+
+
+def test_it_puts_streams_smaller_than_a_part():
+    mock_client = MagicMock()
+    mock_client.put_object.return_value = {"VersionId": "v1"}
+    stream = MultipartUploadStream(mock_client, "bucket", "key", {"Tagging": "a=b"})
+    stream.write(b"abc")
+    stream.close()
+    assert "v1" == stream.complete()
+    mock_client.put_object.assert_called_with(
+        Bucket="bucket", Key="key", Body=b"abc", Tagging="a=b"
+    )
+    mock_client.create_multipart_upload.assert_not_called()
+    with pytest.raises(ValueError):
+        stream.write(b"def")
+
+
+def test_it_aborts_stream_uploads():
+    mock_client = MagicMock()
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.upload_part.return_value = {"ETag": "a"}
+    stream = MultipartUploadStream(mock_client, "bucket", "key", {}, 2)
+    stream.write(b"abc")
+    stream.abort()
+    mock_client.abort_multipart_upload.assert_called_with(
+        Bucket="bucket", Key="key", UploadId="upload1"
+    )
+    mock_client.complete_multipart_upload.assert_not_called()
+
+
+def ranged_get_client(data):
+    def get_object(Range, **kwargs):
+        start, end = map(int, Range[len("bytes=") :].split("-"))
+        return {"Body": BytesIO(data[start : end + 1])}
+
+    mock_client = MagicMock()
+    mock_client.get_object.side_effect = get_object
+    return mock_client
+
+
+def test_it_reads_objects_with_ranged_gets():
+    data = bytes(range(256)) * 4
+    mock_client = ranged_get_client(data)
+    with RangedDownloadStream(
+        mock_client, "bucket", "key", "v1", len(data), {}, 100, 3
+    ) as stream:
+        assert data[:150] == stream.read(150)
+        assert data[150:700] == stream.read(550)
+        assert 700 == stream.tell()
+        stream.seek(-24, 2)
+        assert data[1000:] == stream.read()
+        assert b"" == stream.read(10)
+        stream.seek(50)
+        assert data[50:60] == stream.read(10)
+    mock_client.get_object.assert_any_call(
+        Bucket="bucket", Key="key", VersionId="v1", Range="bytes=1000-1023"
+    )
+    with pytest.raises(ValueError):
+        stream.read()
+
+
+def test_it_only_downloads_parts_ahead_of_the_position():
+    data = b"a" * 1000
+    mock_client = ranged_get_client(data)
+    stream = RangedDownloadStream(mock_client, "bucket", "key", "v1", 1000, {}, 100, 2)
+    stream.read(10)
+    assert [0, 1, 2] == sorted(stream.parts)
+    stream.seek(550)
+    stream.read(10)
+    assert [5, 6, 7] == sorted(stream.parts)
+    stream.seek(950)
+    stream.read(10)
+    assert [9] == sorted(stream.parts)
+    stream.close()
+
+
+def test_it_reads_parquet_files_with_ranged_gets():
+    df = pd.DataFrame({"customer_id": [str(i) for i in range(1000)]})
+    buf = BytesIO()
+    df.to_parquet(buf, row_group_size=100)
+    data = buf.getvalue()
+    stream = RangedDownloadStream(
+        ranged_get_client(data), "bucket", "key", "v1", len(data), {}, 256, 4
+    )
+    table = pq.read_table(pa.PythonFile(stream, mode="r"))
+    assert df["customer_id"].tolist() == table.column("customer_id").to_pylist()
+
+
+@patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
+@patch("backend.ecs_tasks.delete_files.s3.get_object_info")
+def test_it_opens_object_versions_with_ranged_gets(mock_standard, mock_requester):
+    mock_client = ranged_get_client(b"abcdef")
+    mock_requester.return_value = {"RequestPayer": "requester"}, {"Payer": "Requester"}
+    mock_standard.return_value = ({}, {"ContentLength": 6})
+    stream = open_object_version(mock_client, "bucket", "key", "v1", 4, 2)
+    assert b"abcdef" == stream.read()
+    mock_standard.assert_called_with(mock_client, "bucket", "key", "v1")
+    mock_client.get_object.assert_any_call(
+        Bucket="bucket",
+        Key="key",
+        VersionId="v1",
+        Range="bytes=4-5",
+        RequestPayer="requester",
+    )
+    stream.close()
+
+
+@patch("backend.ecs_tasks.delete_files.s3.UPLOAD_PART_SIZE", 2)
 @patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_info")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
 @patch("backend.ecs_tasks.delete_files.s3.get_grantees")
-def test_it_applies_settings_when_saving(
+def test_it_applies_settings_when_saving_streams(
     mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
 ):
-    mock_s3 = MagicMock()
-    mock_s3.S3FileSystem.return_value = mock_s3
     mock_client = MagicMock()
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.upload_part.return_value = {"ETag": "a"}
+    mock_client.complete_multipart_upload.return_value = {"VersionId": "v1"}
     mock_requester.return_value = {"RequestPayer": "requester"}, {"Payer": "Requester"}
     mock_standard.return_value = ({"Expires": "123", "Metadata": {}}, {})
-    mock_tagging.return_value = (
-        {"Tagging": "a=b"},
-        {"TagSet": [{"Key": "a", "Value": "b"}]},
+    mock_tagging.return_value = ({"Tagging": "a=b"}, {})
+    mock_acl.return_value = ({"GrantFullControl": "id=abc"}, {})
+    mock_grantees.return_value = {"id=123"}
+
+    def write(stream):
+        stream.write(b"abc")
+        return "result"
+
+    resp = save_stream(mock_client, "bucket", "key", {"foo": "bar"}, write, "abc123")
+    assert ("v1", "result") == resp
+    mock_standard.assert_called_with(mock_client, "bucket", "key", "abc123")
+    mock_client.create_multipart_upload.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        RequestPayer="requester",
+        Expires="123",
+        Metadata={"foo": "bar"},
+        Tagging="a=b",
+        GrantFullControl="id=abc",
     )
-    mock_acl.return_value = (
-        {"GrantFullControl": "id=abc", "GrantRead": "id=123",},
-        {
-            "Owner": {"ID": "owner_id"},
-            "Grants": [
-                {
-                    "Grantee": {"ID": "abc", "Type": "CanonicalUser"},
-                    "Permission": "FULL_CONTROL",
-                },
-                {
-                    "Grantee": {"ID": "123", "Type": "CanonicalUser"},
-                    "Permission": "READ",
-                },
-            ],
-        },
+    assert b"abc" == get_uploaded_parts(mock_client)
+    mock_client.put_object_acl.assert_called_with(
+        Bucket="bucket",
+        Key="key",
+        VersionId="v1",
+        RequestPayer="requester",
+        GrantFullControl="id=abc",
+        GrantWrite="id=123",
     )
-    mock_grantees.return_value = ""
-    buf = BytesIO()
-    mock_file = MagicMock(version_id="abc123")
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = mock_file
-    resp = save(mock_s3, mock_client, buf, "bucket", "key", {}, "abc123")
-    mock_file.write.assert_called_with(b"")
-    assert "abc123" == resp
-    mock_client.put_object_acl.assert_not_called()
 
 
 @patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
@@ -319,65 +478,51 @@ def test_it_applies_settings_when_saving(
 @patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
 @patch("backend.ecs_tasks.delete_files.s3.get_grantees")
-def test_it_passes_through_version(
+def test_it_does_not_restore_permissions_without_write_grantees(
     mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
 ):
-    mock_s3 = MagicMock()
     mock_client = MagicMock()
+    mock_client.put_object.return_value = {"VersionId": "v1"}
     mock_requester.return_value = {}, {}
     mock_standard.return_value = ({}, {})
     mock_tagging.return_value = ({}, {})
-    mock_acl.return_value = ({}, {})
+    mock_acl.return_value = ({"GrantFullControl": "id=abc"}, {})
     mock_grantees.return_value = ""
-    buf = BytesIO()
-    save(mock_s3, mock_client, buf, "bucket", "key", {}, "abc123")
+
+    resp = save_stream(mock_client, "bucket", "key", {}, lambda s: None, "abc123")
+    assert ("v1", None) == resp
     mock_acl.assert_called_with(mock_client, "bucket", "key", "abc123")
     mock_tagging.assert_called_with(mock_client, "bucket", "key", "abc123")
-    mock_standard.assert_called_with(mock_client, "bucket", "key", "abc123")
+    mock_client.put_object_acl.assert_not_called()
 
 
+@patch("backend.ecs_tasks.delete_files.s3.UPLOAD_PART_SIZE", 2)
 @patch("backend.ecs_tasks.delete_files.s3.get_requester_payment")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_info")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_tags")
 @patch("backend.ecs_tasks.delete_files.s3.get_object_acl")
-@patch("backend.ecs_tasks.delete_files.s3.get_grantees")
-def test_it_restores_write_permissions(
-    mock_grantees, mock_acl, mock_tagging, mock_standard, mock_requester
+def test_it_aborts_saving_streams_on_errors(
+    mock_acl, mock_tagging, mock_standard, mock_requester
 ):
-    mock_s3 = MagicMock()
-    mock_s3.S3FileSystem.return_value = mock_s3
     mock_client = MagicMock()
+    mock_client.create_multipart_upload.return_value = {"UploadId": "upload1"}
+    mock_client.upload_part.return_value = {"ETag": "a"}
     mock_requester.return_value = {}, {}
     mock_standard.return_value = ({}, {})
     mock_tagging.return_value = ({}, {})
-    mock_acl.return_value = (
-        {"GrantFullControl": "id=abc",},
-        {
-            "Owner": {"ID": "owner_id"},
-            "Grants": [
-                {
-                    "Grantee": {"ID": "abc", "Type": "CanonicalUser"},
-                    "Permission": "FULL_CONTROL",
-                },
-                {
-                    "Grantee": {"ID": "123", "Type": "CanonicalUser"},
-                    "Permission": "WRITE",
-                },
-            ],
-        },
-    )
-    mock_grantees.return_value = {"id=123"}
-    buf = BytesIO()
-    mock_s3.open.return_value = mock_s3
-    mock_s3.__enter__.return_value = MagicMock(version_id="new_version123")
-    save(mock_s3, mock_client, buf, "bucket", "key", "abc123")
-    mock_client.put_object_acl.assert_called_with(
-        Bucket="bucket",
-        Key="key",
-        VersionId="new_version123",
-        GrantFullControl="id=abc",
-        GrantWrite="id=123",
+    mock_acl.return_value = ({}, {})
+
+    def write(stream):
+        stream.write(b"abc")
+        raise ValueError("No rows deleted")
+
+    with pytest.raises(ValueError):
+        save_stream(mock_client, "bucket", "key", {}, write, "abc123")
+    mock_client.abort_multipart_upload.assert_called_with(
+        Bucket="bucket", Key="key", UploadId="upload1"
     )
+    mock_client.complete_multipart_upload.assert_not_called()
+    mock_client.put_object_acl.assert_not_called()
 
 
 def test_it_verifies_integrity_happy_path():
@@ -3,7 +3,14 @@ from mock import patch, MagicMock, call
 
 import pytest
 
-from backend.ecs_tasks.delete_files.utils import retry_wrapper, remove_none
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from backend.ecs_tasks.delete_files.utils import (
+    map_in_order,
+    retry_wrapper,
+    remove_none,
+)
 
 pytestmark = [pytest.mark.unit, pytest.mark.ecs_tasks]
 
@@ -74,3 +81,51 @@ def test_it_retries_and_gives_up_fn(sleep_mock):
 
 def test_it_removes_empty_keys():
     assert {"test": "value"} == remove_none({"test": "value", "none": None})
+
+
+def test_it_maps_in_order_sequentially():
+    assert [2, 4, 6] == list(map_in_order(lambda x: x * 2, [1, 2, 3]))
+
+
+def test_it_maps_in_order_on_a_bounded_thread_pool():
+    lock = threading.Lock()
+    in_flight = []
+    max_seen = []
+
+    def fn(x):
+        with lock:
+            in_flight.append(x)
+            max_seen.append(len(in_flight))
+        return x * 2
+
+    results = []
+    for result in map_in_order(fn, range(20), max_workers=4, max_in_flight=3):
+        with lock:
+            in_flight.remove(result // 2)
+        results.append(result)
+
+    assert [x * 2 for x in range(20)] == results
+    assert max(max_seen) <= 3
+
+
+def test_it_raises_errors_raised_on_the_thread_pool():
+    def fn(x):
+        if x == 3:
+            raise ValueError("Invalid")
+        return x
+
+    with pytest.raises(ValueError):
+        list(map_in_order(fn, range(10), max_workers=2))
+
+
+def test_it_maps_in_order_on_a_process_pool():
+    assert [1, 2, 3] == list(
+        map_in_order(
+            abs,
+            [-1, 2, -3],
+            max_workers=2,
+            executor_class=ProcessPoolExecutor,
+            initializer=abs,
+            initargs=(-1,),
+        )
+    )
@@ -5,6 +5,7 @@ import types
 import mock
 
 import pytest
+import boto_utils
 from boto3.session import Session
 from botocore.exceptions import ClientError
 from mock import MagicMock, ANY, patch
@@ -27,6 +28,7 @@ from boto_utils import (
     get_session,
     fetch_job_manifest,
     json_lines_iterator,
+    json_loads,
 )
 
 pytestmark = [pytest.mark.unit, pytest.mark.layers]
@@ -464,6 +466,26 @@ def test_it_iterates_over_json_lines_with_unparsed():
     ]
 
 
+@pytest.mark.parametrize("backend", [None, "orjson"])
+def test_it_parses_json_with_the_same_semantics_for_each_backend(backend):
+    with patch("boto_utils.orjson", None if backend is None else boto_utils.orjson):
+        assert {"a": 1, "B": 1.0} == json_loads(b'{"a": 1, "B": 1.0}')
+        assert isinstance(json_loads('{"a": 1}')["a"], int)
+        for value in [2 ** 70 + 1, -(2 ** 63) - 1, 2 ** 64 + 1]:
+            parsed = json_loads("[{}]".format(value))
+            assert [value] == parsed
+            assert type(parsed[0]) is int
+            assert [value] == json_loads("[{}]".format(value).encode())
+        assert [1.1234567890123456789] == json_loads("[1.1234567890123456789]")
+        assert "\ud800" == json_loads('"\\ud800"')
+        assert json_loads("NaN") != json_loads("NaN")
+        with pytest.raises(json.JSONDecodeError) as e:
+            json_loads('{"a": "b')
+        assert "Unterminated string starting at: line 1 column 7 (char 6)" == str(
+            e.value
+        )
+
+
 def test_it_raises_exception_for_invalid_json():
     json_content = '{"hello":123,"world":true}\nNOT_VALID\n'
     with pytest.raises(ValueError) as e:
@@ -9,6 +9,7 @@ from mock import patch, MagicMock
 with patch.dict(os.environ, {"QueryQueue": "test"}):
     from backend.lambdas.tasks.generate_queries import (
         cast_to_type,
+        deserialize_item,
         generate_athena_queries,
         get_data_mappers,
         get_deletion_queue,
@@ -980,6 +981,7 @@ class TestAthenaQueries:
                 },
                 "RoleArn": "arn:aws:iam::accountid:role/rolename",
                 "DeleteOldVersions": True,
+                "ParquetWriterOptions": {"Compression": "ZSTD"},
             },
             [
                 {
@@ -1005,6 +1007,7 @@ class TestAthenaQueries:
                 ],
                 "RoleArn": "arn:aws:iam::accountid:role/rolename",
                 "DeleteOldVersions": True,
+                "ParquetWriterOptions": {"Compression": "ZSTD"},
                 "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
             },
             {
@@ -1020,6 +1023,7 @@ class TestAthenaQueries:
                 ],
                 "RoleArn": "arn:aws:iam::accountid:role/rolename",
                 "DeleteOldVersions": True,
+                "ParquetWriterOptions": {"Compression": "ZSTD"},
                 "Manifest": "s3://S3F2-manifests-bucket/manifests/job_1234567890/a/manifest.json",
             },
         ]
@@ -1040,6 +1044,52 @@ class TestAthenaQueries:
             ),
         )
 
+    @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
+    @patch("backend.lambdas.tasks.generate_queries.get_table")
+    @patch("backend.lambdas.tasks.generate_queries.get_partitions")
+    def test_it_converts_integer_writer_options_from_ddb(
+        self, get_partitions_mock, get_table_mock, bucket_mock
+    ):
+        columns = [{"Name": "customer_id"}]
+        get_table_mock.return_value = table_stub(columns, [])
+        data_mapper = deserialize_item(
+            {
+                "DataMapperId": {"S": "a"},
+                "QueryExecutor": {"S": "athena"},
+                "Columns": {"L": [{"S": "customer_id"}]},
+                "Format": {"S": "parquet"},
+                "QueryExecutorParameters": {
+                    "M": {
+                        "DataCatalogProvider": {"S": "glue"},
+                        "Database": {"S": "test_db"},
+                        "Table": {"S": "test_table"},
+                    }
+                },
+                "ParquetWriterOptions": {
+                    "M": {
+                        "Compression": {"S": "ZSTD"},
+                        "CompressionLevel": {"N": "3"},
+                        "DataPageSize": {"N": "1048576"},
+                    }
+                },
+            }
+        )
+
+        resp = generate_athena_queries(
+            data_mapper,
+            [{"MatchId": "hi", "CreatedAt": 1614698440, "DeletionQueueItemId": "1"}],
+            "job_1234567890",
+        )
+
+        options = resp[0]["ParquetWriterOptions"]
+        assert {
+            "Compression": "ZSTD",
+            "CompressionLevel": 3,
+            "DataPageSize": 1048576,
+        } == options
+        assert int is type(options["CompressionLevel"])
+        json.dumps(resp)
+
     @patch("backend.lambdas.tasks.generate_queries.s3.Bucket")
     @patch("backend.lambdas.tasks.generate_queries.get_table")
     @patch("backend.lambdas.tasks.generate_queries.get_partitions")
@@ -83,6 +83,7 @@ def test_it_propagates_optional_properties(paginate_mock, batch_sqs_msgs_mock):
         {
             "RoleArn": "arn:aws:iam:accountid:role/rolename",
             "DeleteOldVersions": False,
+            "ParquetWriterOptions": {"Compression": "ZSTD"},
             "JobId": "1234",
             "QueryId": "123",
             "Columns": columns,
@@ -98,6 +99,7 @@ def test_it_propagates_optional_properties(paginate_mock, batch_sqs_msgs_mock):
                 "Object": "s3://mybucket/mykey1",
                 "RoleArn": "arn:aws:iam:accountid:role/rolename",
                 "DeleteOldVersions": False,
+                "ParquetWriterOptions": {"Compression": "ZSTD"},
             },
         ],
     )